@@ -0,0 +1,147 @@
+import os
+import json
+import numpy as np
+
+from src.embeddings import select_closest
+from src.instrumentation import stage
+
+####
+# Approximate nearest neighbour search using an inverted file (IVF) index. The (row normalised) embeddings are
+# clustered with spherical k-means into n_lists clusters. Each cluster keeps the list of row positions assigned to it.
+# A query is compared to the cluster centroids first and only the rows in the n_probe closest clusters are scored.
+#
+# The knobs are:
+#   - n_lists: more lists mean smaller lists to scan per probe (faster) but a higher chance that a close row sits in a
+#              cluster that was not probed (lower recall). A rule of thumb is around sqrt(number of rows)
+#   - n_probe: the number of lists scanned per query. n_probe == n_lists is an exact (brute force) search
+#
+# The exact search in EmbeddingIndex stays available as the fallback and as the ground truth for measure_recall.
+###
+IVF_INDEX_FORMAT_VERSION = 1
+
+
+class IVFIndex():
+    def __init__(self, embedding_index, centroids, list_offsets, list_positions, n_probe = 8):
+        self.embedding_index = embedding_index
+        self.centroids = centroids
+        # The inverted lists are stored as one array of row positions, sorted by cluster. The positions for cluster
+        # c are list_positions[list_offsets[c]:list_offsets[c+1]]
+        self.list_offsets = list_offsets
+        self.list_positions = list_positions
+        if n_probe < 1:
+            raise ValueError(f"n_probe must be at least 1 but is {n_probe}")
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    # The clustering is built from (and rebuilt with) the embedding index so they share a version
+    @property
+    def version(self):
+        return self.embedding_index.version
+
+    @classmethod
+    def build(cls, embedding_index, n_lists = None, n_probe = 8, iterations = 10, seed = 42):
+        embeddings = embedding_index.embeddings
+        n_rows = embeddings.shape[0]
+        if n_rows == 0:
+            raise ValueError("Unable to build an IVF index from an empty embedding index")
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n_rows)))
+        n_lists = min(n_lists, n_rows)
+
+        centroids, assignment = _spherical_kmeans(embeddings, n_lists, iterations, seed)
+        list_positions = np.argsort(assignment, kind='stable').astype(np.int64)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+        return cls(embedding_index, centroids, list_offsets, list_positions, n_probe=n_probe)
+
+    # Same interface as EmbeddingIndex.nearest. Set n_probe to override the default for one query
+    def nearest(self, question_embedding, threshold = 0.15, top_k = None, n_probe = None):
+        n_probe = self.n_probe if n_probe is None else n_probe
+        if n_probe < 1:
+            raise ValueError(f"n_probe must be at least 1 but is {n_probe}")
+        if n_probe >= self.n_lists:
+            return self.embedding_index.nearest(question_embedding, threshold=threshold, top_k=top_k)
+
+        question = np.asarray(question_embedding, dtype=np.float32)
+        norm = np.linalg.norm(question)
+        if norm == 0:
+            raise ValueError("Unable to compute cosine distances for a question embedding with zero length")
+        question = question / norm
+
+        centroid_scores = self.centroids @ question
+        probes = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        candidates = np.concatenate([self.list_positions[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probes])
+        candidates.sort() # keeps ties in the same order as the exact search
+        distances = 1.0 - self.embedding_index.embeddings[candidates] @ question
+        return select_closest(candidates, distances, threshold=threshold, top_k=top_k)
+
+    def search(self, question_embedding, threshold = 0.15, top_k = None, n_probe = None):
+        with stage('retrieve', index='ivf', rows=len(self.embedding_index)) as retrieve_stage:
+            positions, distances = self.nearest(question_embedding, threshold=threshold, top_k=top_k, n_probe=n_probe)
+            retrieve_stage.add('results', len(positions))
+            return self.embedding_index.get_rows(positions, distances)
+
+    # Only the clustering is saved. The embeddings themselves are saved with save_embedding_index
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'ivf_centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'ivf_list_offsets.npy'), self.list_offsets)
+        np.save(os.path.join(path, 'ivf_list_positions.npy'), self.list_positions)
+        header = {
+            'format_version': IVF_INDEX_FORMAT_VERSION,
+            'rows': int(len(self.list_positions)),
+            'n_lists': int(self.n_lists),
+            'n_probe': int(self.n_probe),
+        }
+        with open(os.path.join(path, 'ivf_header.json'), 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+
+
+def load_ivf_index(path, embedding_index):
+    with open(os.path.join(path, 'ivf_header.json'), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header['format_version'] != IVF_INDEX_FORMAT_VERSION:
+        raise ValueError(f"IVF index {path} has format version {header['format_version']} but version {IVF_INDEX_FORMAT_VERSION} is required")
+    if header['rows'] != len(embedding_index):
+        raise ValueError(f"IVF index {path} was built for {header['rows']} rows but the embedding index has {len(embedding_index)} rows")
+    centroids = np.load(os.path.join(path, 'ivf_centroids.npy'), mmap_mode='r')
+    list_offsets = np.load(os.path.join(path, 'ivf_list_offsets.npy'))
+    list_positions = np.load(os.path.join(path, 'ivf_list_positions.npy'), mmap_mode='r')
+    return IVFIndex(embedding_index, centroids, list_offsets, list_positions, n_probe=header['n_probe'])
+
+
+# Returns the average fraction of the exact top_k results that the approximate index also returns
+def measure_recall(ivf_index, question_embeddings, top_k = 10, n_probe = None):
+    recalls = []
+    for question_embedding in question_embeddings:
+        exact_positions, _ = ivf_index.embedding_index.nearest(question_embedding, threshold=np.inf, top_k=top_k)
+        approximate_positions, _ = ivf_index.nearest(question_embedding, threshold=np.inf, top_k=top_k, n_probe=n_probe)
+        if len(exact_positions) > 0:
+            recalls.append(len(np.intersect1d(exact_positions, approximate_positions)) / len(exact_positions))
+    return float(np.mean(recalls)) if recalls else 1.0
+
+
+# k-means on the unit sphere: rows are assigned to the centroid with the highest cosine similarity and the centroids
+# are re-normalised after every update. Empty clusters are re-seeded with a random row.
+def _spherical_kmeans(embeddings, n_clusters, iterations, seed, chunk_size = 8192):
+    rng = np.random.default_rng(seed)
+    n_rows = embeddings.shape[0]
+    centroids = np.array(embeddings[rng.choice(n_rows, size=n_clusters, replace=False)], dtype=np.float32)
+    assignment = np.zeros(n_rows, dtype=np.int64)
+    for _ in range(max(1, iterations)):
+        for start in range(0, n_rows, chunk_size):
+            assignment[start:start + chunk_size] = np.argmax(embeddings[start:start + chunk_size] @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, embeddings)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        for empty_cluster in np.flatnonzero(counts == 0):
+            sums[empty_cluster] = embeddings[rng.integers(n_rows)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    for start in range(0, n_rows, chunk_size):
+        assignment[start:start + chunk_size] = np.argmax(embeddings[start:start + chunk_size] @ centroids.T, axis=1)
+    return centroids, assignment
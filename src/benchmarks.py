@@ -0,0 +1,238 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from src.valid_index import get_banking_act_index
+from src.file_tools import process_regulations, add_full_reference, get_regulation_detail, RegulationIndex
+from src.tree_tools import build_tree_for_regulation, split_tree
+from src.embeddings import num_tokens_from_string, get_closest_nodes, clear_token_count_cache, set_encoding
+from src.fake_openai import FakeEncoding
+from src.synthetic_corpus import generate_synthetic_corpus
+
+####
+# Benchmarks for the ingestion, tree, chunking and retrieval hot paths. Each benchmark is run at several corpus sizes.
+# Size 1 is the corpus itself and size n is n copies of the corpus with the top level references renumbered so the
+# copies follow each other (i.e. the same structure as one n times longer regulation). With synthetic = True, size n is
+# instead a corpus from src.synthetic_corpus with n files of synthetic_sections_per_size top level sections each.
+#
+# For each function and corpus size the results record the minimum and median wall time over `repeat` runs and the
+# peak memory allocated by Python (from tracemalloc) during one extra run. Timing and memory are measured in separate
+# runs because tracemalloc slows down allocation heavy code. The results are saved as JSON with the git commit so runs
+# can be compared across commits with compare_benchmark_results.
+#
+# get_closest_nodes uses random (seeded) embeddings. Token counts (split_tree and num_tokens_from_string) use the
+# tiktoken encoding, which is downloaded the first time it is used (see TIKTOKEN_CACHE_DIR), unless an encoding is
+# passed, e.g. encoding=FakeEncoding() (--fake-tokenizer), in which case everything runs offline. Timings with the fake
+# encoding are not comparable with timings with tiktoken.
+#
+# Usage: python -m src.benchmarks --sizes 1 10 --output benchmark_results.json
+#        python -m src.benchmarks --synthetic --sizes 10 100 1000 --output synthetic_results.json
+#        python -m src.benchmarks --fake-tokenizer --sizes 1 --output offline_results.json
+###
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_CORPUS = ['./txt/reg23_sections_01_09.txt', './txt/reg23_sections_10_12.txt', './txt/reg23_sections_13_17.txt', './txt/reg23_sections_18_22.txt']
+DEFAULT_NON_TEXT_LABELS = ['Table', 'Formula', 'Example', 'Definition']
+
+_top_level_reference_pattern = re.compile(r'^\((\d+)\)')
+
+
+# Writes `size` copies of the corpus into output_directory and returns the new file list. Top level references, e.g.
+# (10) at indent 0, are renumbered in each copy so the references stay unique.
+def scale_corpus(file_list, size, output_directory):
+    contents = []
+    highest_reference = 0
+    for file in file_list:
+        with open(file, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        contents.append(lines)
+        for line in lines:
+            match = _top_level_reference_pattern.match(line)
+            if match:
+                highest_reference = max(highest_reference, int(match.group(1)))
+
+    def renumber(line, offset):
+        return _top_level_reference_pattern.sub(lambda match: f'({int(match.group(1)) + offset})', line)
+
+    scaled_files = []
+    for copy in range(size):
+        offset = copy * highest_reference
+        for file, lines in zip(file_list, contents):
+            name, extension = os.path.splitext(os.path.basename(file))
+            scaled_file = os.path.join(output_directory, f'{name}_copy_{copy:04d}{extension}')
+            with open(scaled_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(renumber(line, offset) if offset > 0 else line for line in lines))
+            scaled_files.append(scaled_file)
+    return scaled_files
+
+
+# Times function(*setup()) `repeat` times and measures its peak memory once. setup is not included in the timing
+def benchmark(function, setup = None, repeat = 3):
+    timings = []
+    for _ in range(repeat):
+        arguments = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        timings.append(time.perf_counter() - start)
+
+    arguments = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        function(*arguments)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds_min': min(timings),
+        'seconds_median': statistics.median(timings),
+        'peak_memory_bytes': peak_memory,
+        'repeat': repeat,
+    }
+
+
+def run_benchmarks(file_list = DEFAULT_CORPUS, sizes = (1, 10), valid_index_checker = None, non_text_labels = DEFAULT_NON_TEXT_LABELS,
+                   token_limit = 1000, repeat = 3, detail_sample_size = 50, embedding_dimension = 1536, seed = 42, print_progress = False,
+                   synthetic = False, synthetic_sections_per_size = 22, encoding = None):
+    if encoding is not None:
+        previous_encoding = set_encoding(encoding)
+        try:
+            benchmark_results = run_benchmarks(file_list, sizes=sizes, valid_index_checker=valid_index_checker, non_text_labels=non_text_labels,
+                                               token_limit=token_limit, repeat=repeat, detail_sample_size=detail_sample_size,
+                                               embedding_dimension=embedding_dimension, seed=seed, print_progress=print_progress,
+                                               synthetic=synthetic, synthetic_sections_per_size=synthetic_sections_per_size)
+        finally:
+            set_encoding(previous_encoding)
+        benchmark_results['tokenizer'] = type(encoding).__name__
+        return benchmark_results
+
+    if valid_index_checker is None:
+        valid_index_checker = get_banking_act_index()
+    rng = np.random.default_rng(seed)
+    results = []
+
+    corpus = 'synthetic' if synthetic else 'files'
+
+    def record(name, size, rows, result):
+        result.update({'function': name, 'corpus': corpus, 'corpus_size': size, 'rows': rows})
+        results.append(result)
+        if print_progress:
+            print(f"{name:<55} size {size:>5} rows {rows:>8}: {result['seconds_median']:.4f}s, peak {result['peak_memory_bytes'] / 1e6:.1f} MB")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            if synthetic:
+                size_directory = os.path.join(directory, f'synthetic_{size}')
+                os.makedirs(size_directory)
+                scaled_files = generate_synthetic_corpus(valid_index_checker, size_directory, number_of_files=size, sections_per_file=synthetic_sections_per_size, seed=seed)
+            elif size > 1:
+                scaled_files = scale_corpus(file_list, size, directory)
+            else:
+                scaled_files = list(file_list)
+            df, _ = process_regulations(scaled_files, valid_index_checker, non_text_labels)
+            rows = len(df)
+            record('process_regulations', size, rows, benchmark(lambda: process_regulations(scaled_files, valid_index_checker, non_text_labels), repeat=repeat))
+
+            df_without_full_reference = df.drop(columns=['full_reference', 'word_count'])
+            record('add_full_reference', size, rows, benchmark(lambda frame: add_full_reference(frame, valid_index_checker, "23"),
+                                                               setup=lambda: (df_without_full_reference.copy(),), repeat=repeat))
+
+            record('build_tree_for_regulation', size, rows, benchmark(lambda: build_tree_for_regulation('BA', df, valid_index_checker), repeat=repeat))
+
+            tree = build_tree_for_regulation('BA', df, valid_index_checker)
+            # the token counts are memoised so the cache is cleared before each run
+            record('split_tree', size, rows, benchmark(lambda: split_tree(tree.root, df, token_limit, valid_index_checker),
+                                                       setup=_clear_token_count_cache, repeat=repeat))
+
+            references = sorted(set(df['full_reference']))
+            sample = [references[i] for i in np.linspace(0, len(references) - 1, min(detail_sample_size, len(references))).astype(int)]
+            record('get_regulation_detail', size, rows, benchmark(lambda: [get_regulation_detail(reference, df, valid_index_checker) for reference in sample], repeat=repeat))
+            regulation_index = RegulationIndex(df, valid_index_checker)
+            record('RegulationIndex.get_regulation_detail (all references)', size, rows,
+                   benchmark(lambda: [regulation_index.get_regulation_detail(reference) for reference in references], repeat=repeat))
+
+            texts = [regulation_index.get_regulation_detail(reference) for reference in sample]
+            record('num_tokens_from_string', size, rows, benchmark(lambda: [num_tokens_from_string(text) for text in texts],
+                                                                   setup=_clear_token_count_cache, repeat=repeat))
+
+            # one embedding per row is an upper bound on the size of the sections, summaries and questions index
+            embeddings = rng.standard_normal((rows, embedding_dimension)).astype(np.float32)
+            index_df = pd.DataFrame({'section': df['full_reference'].to_numpy(), 'Embedding': list(embeddings)})
+            question_embedding = embeddings[0] + 0.1 * rng.standard_normal(embedding_dimension).astype(np.float32)
+            record('get_closest_nodes', size, rows, benchmark(lambda: get_closest_nodes(index_df, 'Embedding', question_embedding), repeat=repeat))
+
+    return {
+        'format_version': BENCHMARK_FORMAT_VERSION,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': _get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tokenizer': 'tiktoken',
+        'results': results,
+    }
+
+
+def _clear_token_count_cache():
+    clear_token_count_cache()
+    return ()
+
+
+def _get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_benchmark_results(benchmark_results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(benchmark_results, f, indent=2)
+
+
+def load_benchmark_results(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Returns a DataFrame with one row per (function, corpus, corpus_size) in both runs and the ratio new / baseline of the median
+# time and peak memory. A ratio below 1 is an improvement
+def compare_benchmark_results(baseline_results, new_results):
+    columns = ['function', 'corpus', 'corpus_size', 'seconds_median', 'peak_memory_bytes']
+    baseline = pd.DataFrame(baseline_results['results'])[columns]
+    new = pd.DataFrame(new_results['results'])[columns]
+    comparison = baseline.merge(new, on=['function', 'corpus', 'corpus_size'], suffixes=('_baseline', '_new'))
+    comparison['time_ratio'] = comparison['seconds_median_new'] / comparison['seconds_median_baseline']
+    comparison['memory_ratio'] = comparison['peak_memory_bytes_new'] / comparison['peak_memory_bytes_baseline']
+    return comparison
+
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description='Benchmark the ingestion, tree, chunking and retrieval hot paths')
+    parser.add_argument('--files', nargs='+', default=DEFAULT_CORPUS)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1, 10])
+    parser.add_argument('--synthetic', action='store_true', help='use synthetic corpora instead of copies of the files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--token-limit', type=int, default=1000)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='a previous results file to compare against')
+    parser.add_argument('--fake-tokenizer', action='store_true', help='count tokens with FakeEncoding so nothing is downloaded')
+    arguments = parser.parse_args(arguments)
+
+    benchmark_results = run_benchmarks(arguments.files, sizes=arguments.sizes, token_limit=arguments.token_limit, repeat=arguments.repeat,
+                                       print_progress=True, synthetic=arguments.synthetic,
+                                       encoding=FakeEncoding() if arguments.fake_tokenizer else None)
+    save_benchmark_results(benchmark_results, arguments.output)
+    if arguments.compare is not None:
+        print(compare_benchmark_results(load_benchmark_results(arguments.compare), benchmark_results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import os
+import json
+import re
+import numpy as np
+import pandas as pd
+
+from src.embeddings import get_ada_embedding
+from src.instrumentation import stage
+
+####
+# Lexical (BM25) retrieval over the regulation text. The documents are
+#   - each row of the regulation DataFrame from process_regulations ('Text', keyed by its 'full_reference'), and
+#   - each section from split_tree ('text', keyed by its 'section')
+# so defined terms ("specialised lending", "BA 200", "average daily balance") are matched directly and a query can be
+# answered without calling the embedding API.
+#
+# Terms are lower case words with a light plural stem, and adjacent word pairs (bigrams) so that phrases score higher
+# than the same words scattered through a section. The postings are stored as flat arrays (one block per term) so the
+# index can be saved next to the embedding index with the same .npy + header.json layout as the IVF index.
+#
+# hybrid_search answers from the lexical results alone when they are confident (every query term is found in the top
+# document and it clearly beats the next one), and otherwise embeds the question and fuses the lexical and vector
+# rankings with reciprocal rank fusion.
+###
+BM25_INDEX_FORMAT_VERSION = 1
+
+_token_pattern = re.compile(r'[a-z0-9]+')
+_STOP_WORDS = frozenset(['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'do', 'does', 'for', 'from', 'how', 'i', 'if',
+                         'in', 'is', 'it', 'its', 'me', 'my', 'of', 'on', 'or', 'say', 'says', 'shall', 'that', 'the',
+                         'their', 'this', 'to', 'was', 'what', 'when', 'which', 'who', 'will', 'with'])
+
+
+# Returns the (stemmed, stop word free) words of the text
+def tokenize(text):
+    words = []
+    for word in _token_pattern.findall(str(text).lower()):
+        if word in _STOP_WORDS:
+            continue
+        if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return words
+
+
+def get_terms(text, use_bigrams = True):
+    words = tokenize(text)
+    if use_bigrams:
+        return words + [first + ' ' + second for first, second in zip(words, words[1:])]
+    return words
+
+
+# Documents for build_bm25_index: the rows of the regulation DataFrame and / or the sections from split_tree
+def get_bm25_documents(df = None, sectioned_df = None):
+    documents = []
+    if df is not None:
+        documents.append(pd.DataFrame({'section': df['full_reference'].to_numpy(), 'source': 'regulation_text', 'text': df['Text'].fillna('').to_numpy()}))
+    if sectioned_df is not None:
+        documents.append(pd.DataFrame({'section': sectioned_df['section'].to_numpy(), 'source': 'section_text', 'text': sectioned_df['text'].fillna('').to_numpy()}))
+    if not documents:
+        raise ValueError("Either the regulation DataFrame or the sectioned DataFrame is required")
+    return pd.concat(documents, ignore_index=True)
+
+
+def build_bm25_index(df = None, sectioned_df = None, k1 = 1.5, b = 0.75, use_bigrams = True):
+    return BM25Index.build(get_bm25_documents(df, sectioned_df), k1=k1, b=b, use_bigrams=use_bigrams)
+
+
+class BM25Index():
+    def __init__(self, documents, vocabulary, posting_offsets, posting_documents, posting_frequencies, document_lengths,
+                 k1 = 1.5, b = 0.75, use_bigrams = True):
+        self.documents = documents # DataFrame with one row per document ('section', 'source', 'text')
+        self.vocabulary = vocabulary # term: term id
+        # the documents containing term t are posting_documents[posting_offsets[t]:posting_offsets[t+1]]
+        self.posting_offsets = posting_offsets
+        self.posting_documents = posting_documents
+        self.posting_frequencies = posting_frequencies
+        self.document_lengths = document_lengths
+        self.k1 = k1
+        self.b = b
+        self.use_bigrams = use_bigrams
+        self.average_document_length = float(np.mean(document_lengths)) if len(document_lengths) > 0 else 0.0
+        document_frequencies = np.diff(posting_offsets)
+        self.idf = np.log(1.0 + (len(documents) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+    def __len__(self):
+        return len(self.documents)
+
+    @classmethod
+    def build(cls, documents, k1 = 1.5, b = 0.75, use_bigrams = True):
+        documents = documents.reset_index(drop=True)
+        vocabulary = {}
+        postings = [] # for each term, a list of (document, frequency)
+        document_lengths = np.zeros(len(documents), dtype=np.int32)
+        for document, text in enumerate(documents['text']):
+            counts = {}
+            for term in get_terms(text, use_bigrams):
+                counts[term] = counts.get(term, 0) + 1
+            document_lengths[document] = len(tokenize(text))
+            for term, count in counts.items():
+                term_id = vocabulary.get(term)
+                if term_id is None:
+                    term_id = len(vocabulary)
+                    vocabulary[term] = term_id
+                    postings.append([])
+                postings[term_id].append((document, count))
+
+        posting_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        posting_offsets[1:] = np.cumsum([len(posting) for posting in postings])
+        posting_documents = np.fromiter((document for posting in postings for document, _ in posting), dtype=np.int32, count=posting_offsets[-1])
+        posting_frequencies = np.fromiter((count for posting in postings for _, count in posting), dtype=np.int32, count=posting_offsets[-1])
+        return cls(documents, vocabulary, posting_offsets, posting_documents, posting_frequencies, document_lengths, k1=k1, b=b, use_bigrams=use_bigrams)
+
+    # BM25 score of every document for the query
+    def scores(self, query):
+        scores = np.zeros(len(self.documents), dtype=np.float64)
+        if len(self.documents) == 0:
+            return scores
+        length_normalisation = self.k1 * (1.0 - self.b + self.b * self.document_lengths / max(self.average_document_length, 1e-9))
+        for term in set(get_terms(query, self.use_bigrams)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.posting_offsets[term_id], self.posting_offsets[term_id + 1]
+            documents = self.posting_documents[start:end]
+            frequencies = self.posting_frequencies[start:end]
+            scores[documents] += self.idf[term_id] * frequencies * (self.k1 + 1.0) / (frequencies + length_normalisation[documents])
+        return scores
+
+    # Returns the positions and scores of the top_k documents with a score above zero, best first
+    def nearest(self, query, top_k = 10):
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        order = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return order, scores[order]
+
+    # Returns a copy of the top_k documents with a 'bm25_score' column
+    def search(self, query, top_k = 10):
+        with stage('retrieve', index='bm25', rows=len(self)) as retrieve_stage:
+            positions, scores = self.nearest(query, top_k)
+            retrieve_stage.add('results', len(positions))
+            results = self.documents.iloc[positions].copy()
+            results['bm25_score'] = scores
+            return results
+
+    # The fraction of the query's words that appear in the document at position
+    def coverage(self, query, position):
+        words = set(tokenize(query))
+        if not words:
+            return 0.0
+        document_words = set(tokenize(self.documents['text'].iloc[position]))
+        return len(words & document_words) / len(words)
+
+    # The lexical results are confident if the top document contains at least min_coverage of the query's words and
+    # its score is at least min_margin times the score of the best document for a different section. Sections repeat the
+    # text of their ancestors so the scores of neighbouring sections are close and the margin should be tuned on real
+    # questions
+    def is_confident(self, query, results, min_coverage = 1.0, min_margin = 1.2):
+        if len(results) == 0:
+            return False
+        if self.coverage(query, results.index[0]) < min_coverage:
+            return False
+        top_section = results['section'].iloc[0]
+        other_scores = results.loc[results['section'] != top_section, 'bm25_score']
+        return len(other_scores) == 0 or results['bm25_score'].iloc[0] >= min_margin * other_scores.iloc[0]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'bm25_posting_offsets.npy'), self.posting_offsets)
+        np.save(os.path.join(path, 'bm25_posting_documents.npy'), self.posting_documents)
+        np.save(os.path.join(path, 'bm25_posting_frequencies.npy'), self.posting_frequencies)
+        np.save(os.path.join(path, 'bm25_document_lengths.npy'), self.document_lengths)
+        self.documents.to_parquet(os.path.join(path, 'bm25_documents.parquet'), engine='pyarrow', index=False)
+        header = {
+            'format_version': BM25_INDEX_FORMAT_VERSION,
+            'documents': len(self.documents),
+            'k1': self.k1,
+            'b': self.b,
+            'use_bigrams': self.use_bigrams,
+            'vocabulary': sorted(self.vocabulary, key=self.vocabulary.get),
+        }
+        with open(os.path.join(path, 'bm25_header.json'), 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+
+
+def load_bm25_index(path):
+    with open(os.path.join(path, 'bm25_header.json'), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header['format_version'] != BM25_INDEX_FORMAT_VERSION:
+        raise ValueError(f"BM25 index {path} has format version {header['format_version']} but version {BM25_INDEX_FORMAT_VERSION} is required")
+    documents = pd.read_parquet(os.path.join(path, 'bm25_documents.parquet'), engine='pyarrow')
+    if len(documents) != header['documents']:
+        raise ValueError(f"BM25 index {path} is corrupt: expected {header['documents']} documents but found {len(documents)}")
+    return BM25Index(documents,
+                     {term: term_id for term_id, term in enumerate(header['vocabulary'])},
+                     np.load(os.path.join(path, 'bm25_posting_offsets.npy')),
+                     np.load(os.path.join(path, 'bm25_posting_documents.npy'), mmap_mode='r'),
+                     np.load(os.path.join(path, 'bm25_posting_frequencies.npy'), mmap_mode='r'),
+                     np.load(os.path.join(path, 'bm25_document_lengths.npy')),
+                     k1=header['k1'], b=header['b'], use_bigrams=header['use_bigrams'])
+
+
+####
+# Combines rankings by section with reciprocal rank fusion: score = sum over rankings of 1 / (rrf_k + rank). Each
+# ranking is a DataFrame with 'section' and 'text' columns, best first. Returns the top_k sections with the fused
+# 'score' and the rank (from 1, or NaN if missing) of the section in each ranking.
+###
+def reciprocal_rank_fusion(rankings, names, top_k = 10, rrf_k = 60):
+    fused = {}
+    for ranking, name in zip(rankings, names):
+        seen = set()
+        for section, text in zip(ranking['section'], ranking['text']):
+            if section in seen: # only the best rank of each section counts
+                continue
+            seen.add(section)
+            entry = fused.setdefault(section, {'section': section, 'text': text, 'score': 0.0})
+            entry[name + '_rank'] = len(seen)
+            entry['score'] += 1.0 / (rrf_k + len(seen))
+    columns = ['section', 'text', 'score'] + [name + '_rank' for name in names]
+    results = pd.DataFrame(list(fused.values()), columns=columns)
+    return results.sort_values('score', ascending=False, kind='stable').head(top_k).reset_index(drop=True)
+
+
+# Returns (results, retrieval) where retrieval is 'lexical' if the question was answered from the BM25 index alone
+# or 'hybrid' if the vector search was used as well
+def hybrid_search(question, bm25_index, embedding_index, get_embedding = get_ada_embedding, top_k = 10, threshold = 0.15,
+                  rrf_k = 60, min_coverage = 1.0, min_margin = 1.2):
+    lexical_results = bm25_index.search(question, top_k=top_k)
+    if bm25_index.is_confident(question, lexical_results, min_coverage=min_coverage, min_margin=min_margin):
+        return reciprocal_rank_fusion([lexical_results], ['lexical'], top_k=top_k, rrf_k=rrf_k), 'lexical'
+    vector_results = embedding_index.search(get_embedding(question), threshold=threshold, top_k=top_k)
+    return reciprocal_rank_fusion([lexical_results, vector_results], ['lexical', 'vector'], top_k=top_k, rrf_k=rrf_k), 'hybrid'
@@ -0,0 +1,62 @@
+import pandas as pd
+
+from src.instrumentation import stage
+
+####
+# Builds the context for the prompt from ranked retrieval hits (the output of EmbeddingIndex.search, hybrid_search,
+# ReferenceRouter.route, ... or a list of references, best first) without repeating text.
+#
+# get_regulation_detail renders a section as the rows of its subtree plus the rows of each of its ancestors (the
+# conditions before it and the qualifiers after it). When several hits share a parent, rendering each hit separately
+# repeats the parent rows, and a hit inside another hit's subtree is repeated in full. Here the selected hits are
+# rendered together with RegulationIndex.get_detail_rows, which is also used by get_regulation_detail, so each row is
+# rendered once and a parent's conditions and qualifiers wrap all the selected hits below it. For a single hit the text
+# is the same as get_regulation_detail.
+#
+# Hits are added greedily in rank order. The cost of a hit is the number of tokens in its rows that are not already in
+# the context (from the cached RegulationIndex.get_row_token_counts) plus one token for each line break, so a hit
+# that only adds a few rows to a shared parent is cheap. A hit that does not fit in the remaining budget is dropped
+# and the next hit is tried. The token count is an estimate: tokenizing the rendered block can differ by a token or
+# two at each line break, so leave some slack in token_budget.
+#
+# Returns (context, report) where report has one row per hit with its 'section', 'rank' (from 1), 'status' and the
+# 'tokens' it added to the context. The status is
+#   - 'included' the hit added rows to the context
+#   - 'merged'   all of its rows were already in the context (e.g. it is part of a higher ranked hit)
+#   - 'dropped'  it did not fit in the remaining token budget
+#   - 'missing'  the section has no rows in the regulation
+###
+def assemble_context(hits, regulation_index, token_budget):
+    sections = list(hits['section']) if isinstance(hits, pd.DataFrame) else list(hits)
+    with stage('render', sections=len(sections), token_budget=token_budget) as render_stage:
+        row_token_counts = regulation_index.get_row_token_counts()
+        selected_sections = []
+        selected_rows = set()
+        tokens_used = 0
+        report = []
+        for rank, section in enumerate(sections, start=1):
+            new_rows = get_section_rows(section, regulation_index) - selected_rows
+            if not new_rows:
+                status = 'merged' if section in regulation_index.rows_for_reference or regulation_index.get_rows_with_prefix(section) else 'missing'
+                report.append([section, rank, status, 0])
+                continue
+            # one token for each line break, including the one that joins the new rows to the existing context
+            tokens = sum(row_token_counts[position] for position in new_rows) + len(new_rows) - (0 if selected_rows else 1)
+            if tokens_used + tokens > token_budget:
+                report.append([section, rank, 'dropped', 0])
+                continue
+            selected_sections.append(section)
+            selected_rows |= new_rows
+            tokens_used += tokens
+            report.append([section, rank, 'included', tokens])
+
+        report = pd.DataFrame(report, columns=['section', 'rank', 'status', 'tokens'])
+        render_stage.add('tokens', tokens_used)
+        render_stage.add('dropped', int((report['status'] == 'dropped').sum()))
+        context = "\n".join(regulation_index.render_row(position) for position in regulation_index.get_detail_rows(selected_sections))
+        return context, report
+
+
+# The positions of the rows that get_regulation_detail renders for the section: its subtree and its ancestors
+def get_section_rows(section, regulation_index):
+    return set(regulation_index.get_detail_rows([section]))
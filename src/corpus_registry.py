@@ -0,0 +1,198 @@
+import concurrent.futures
+import threading
+import pandas as pd
+
+from src.corpus_snapshot import CorpusSnapshot, load_or_compile_corpus_snapshot
+from src.embeddings import get_ada_embedding, load_embedding_index
+from src.instrumentation import stage
+from src.query_router import ReferenceRouter, get_section_references
+
+####
+# Serves several regulations (e.g. Reg23 of the Banks Act, POPIA, the Excon manual) from one process. Each regulation
+# is a shard with its own ValidIndex, corpus snapshot (frame, tree and RegulationIndex, see src.corpus_snapshot) and
+# embedding index (a directory written by save_embedding_index).
+#
+# Registering a shard does not read anything. The embedding index of a shard is loaded the first time the shard is
+# searched and the snapshot (compiled first if file_list is given and it is stale) the first time its frame, tree or
+# regulation text is needed, so memory and start up time grow with the regulations that are actually queried. A vector
+# search only needs the (memory mapped) embedding index, not the snapshot. unload releases a shard again.
+#
+#     registry = CorpusRegistry()
+#     registry.register('reg23', get_banking_act_index(), 'reg23.snapshot', 'reg23_index', file_list=reg23_files)
+#     registry.register('popia', popia_index, 'popia.snapshot', 'popia_index', reference_prefix='19')
+#     results, route = registry.search(question, corpora=['reg23'])
+#
+# A search fans out to the selected shards (all of them by default), concurrently if max_workers > 1, and the results
+# are merged by cosine distance into one top_k with a 'corpus' column. All the shards must be embedded with the same
+# model because the question is only embedded once. registry.select(corpora) returns the selected shards as one index
+# (with search(question_embedding, threshold, top_k) and version) so it can be used with QueryCache.
+###
+class CorpusShard():
+    def __init__(self, name, valid_index_checker, snapshot_path, embedding_index_path, file_list = None,
+                 non_text_labels = (), root_node_name = None, reference_prefix = '23', min_components = 2):
+        self.name = name
+        self.valid_index_checker = valid_index_checker
+        self.snapshot_path = snapshot_path
+        self.embedding_index_path = embedding_index_path
+        self.file_list = file_list
+        self.non_text_labels = list(non_text_labels)
+        self.root_node_name = root_node_name if root_node_name is not None else name
+        self.reference_prefix = reference_prefix
+        self.min_components = min_components
+        # reentrant because the router is built from the snapshot
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._embedding_index = None
+        self._router = None
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            if self._snapshot is None:
+                if self.file_list is not None:
+                    self._snapshot = load_or_compile_corpus_snapshot(self.snapshot_path, self.file_list, self.valid_index_checker,
+                                                                     self.non_text_labels, self.root_node_name, self.reference_prefix)
+                else:
+                    self._snapshot = CorpusSnapshot(self.snapshot_path, self.valid_index_checker)
+            return self._snapshot
+
+    @property
+    def df(self):
+        return self.snapshot.df
+
+    @property
+    def tree(self):
+        return self.snapshot.tree
+
+    @property
+    def regulation_index(self):
+        return self.snapshot.regulation_index
+
+    @property
+    def embedding_index(self):
+        with self._lock:
+            if self._embedding_index is None:
+                self._embedding_index = load_embedding_index(self.embedding_index_path)
+            return self._embedding_index
+
+    @property
+    def router(self):
+        with self._lock:
+            if self._router is None:
+                self._router = ReferenceRouter(self.tree, self.regulation_index, min_components=self.min_components)
+            return self._router
+
+    # True if the question cites a section in this shard's numbering. Only the ValidIndex is used so nothing is loaded
+    def cites_section(self, question):
+        references = self.valid_index_checker.extract_valid_references(question)
+        return len(get_section_references(references, self.valid_index_checker, self.min_components)) > 0
+
+    def is_loaded(self):
+        return self._snapshot is not None or self._embedding_index is not None
+
+    # Results from the shard's embedding index with a 'corpus' column
+    def search(self, question_embedding, threshold = 0.15, top_k = None):
+        results = self.embedding_index.search(question_embedding, threshold=threshold, top_k=top_k)
+        results.insert(0, 'corpus', self.name)
+        return results
+
+    def unload(self):
+        with self._lock:
+            if self._snapshot is not None:
+                self._snapshot.close()
+            self._snapshot = None
+            self._embedding_index = None
+            self._router = None
+
+
+class CorpusRegistry():
+    def __init__(self, max_workers = None):
+        self.max_workers = max_workers
+        self._shards = {}
+
+    # Registers a shard (see CorpusShard for the arguments). Nothing is loaded until the shard is used
+    def register(self, name, valid_index_checker, snapshot_path, embedding_index_path, **kwargs):
+        if name in self._shards:
+            raise ValueError(f"A corpus with the name {name} is already registered")
+        shard = CorpusShard(name, valid_index_checker, snapshot_path, embedding_index_path, **kwargs)
+        self._shards[name] = shard
+        return shard
+
+    def names(self):
+        return list(self._shards)
+
+    def loaded_corpora(self):
+        return [name for name, shard in self._shards.items() if shard.is_loaded()]
+
+    def get_shard(self, name):
+        shard = self._shards.get(name)
+        if shard is None:
+            raise ValueError(f"No corpus with the name {name} is registered. The registered corpora are {self.names()}")
+        return shard
+
+    def __contains__(self, name):
+        return name in self._shards
+
+    def __len__(self):
+        return len(self._shards)
+
+    # Unloads one shard, or all of them if name is None
+    def unload(self, name = None):
+        for shard in ([self.get_shard(name)] if name is not None else self._shards.values()):
+            shard.unload()
+
+    # The selected shards (all of them if corpora is None) as one index
+    def select(self, corpora = None):
+        names = self.names() if corpora is None else list(corpora)
+        return ShardedIndex([self.get_shard(name) for name in names], max_workers=self.max_workers)
+
+    # The sections cited in the question (see ReferenceRouter) from the selected shards, with a 'corpus' column, or
+    # None if it does not cite a section. Only the shards whose ValidIndex finds a section reference in the question are
+    # loaded
+    def route(self, question, corpora = None):
+        routed = []
+        for shard in self.select(corpora).shards:
+            if not shard.cites_section(question):
+                continue
+            results = shard.router.route(question)
+            if results is not None:
+                results.insert(0, 'corpus', shard.name)
+                routed.append(results)
+        if not routed:
+            return None
+        return pd.concat(routed, ignore_index=True)
+
+    # Returns (results, route) where route is 'reference' if the question was answered from the sections it cites or
+    # 'retrieval' if it was answered from the merged top_k of the embedding search across the selected shards
+    def search(self, question, corpora = None, get_embedding = get_ada_embedding, threshold = 0.15, top_k = 10):
+        results = self.route(question, corpora)
+        if results is not None:
+            return results, 'reference'
+        return self.select(corpora).search(get_embedding(question), threshold=threshold, top_k=top_k), 'retrieval'
+
+
+class ShardedIndex():
+    def __init__(self, shards, max_workers = None):
+        self.shards = shards
+        self.max_workers = max_workers
+
+    # Changes when any of the shards' embedding indexes is rebuilt (see EmbeddingIndex.version)
+    @property
+    def version(self):
+        return '|'.join(f'{shard.name}:{shard.embedding_index.version}' for shard in self.shards)
+
+    # Each shard returns its own top_k so the merged top_k is the same as the top_k of one index with all the rows
+    def search(self, question_embedding, threshold = 0.15, top_k = None):
+        with stage('retrieve', index='sharded', shards=len(self.shards)) as retrieve_stage:
+            if self.max_workers is not None and self.max_workers > 1 and len(self.shards) > 1:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    shard_results = list(executor.map(lambda shard: shard.search(question_embedding, threshold=threshold, top_k=top_k), self.shards))
+            else:
+                shard_results = [shard.search(question_embedding, threshold=threshold, top_k=top_k) for shard in self.shards]
+            if not shard_results:
+                return pd.DataFrame(columns=['corpus', 'section', 'text', 'cosine_distance'])
+            results = pd.concat(shard_results, ignore_index=True).sort_values('cosine_distance', kind='stable')
+            if top_k is not None:
+                results = results.head(top_k)
+            retrieve_stage.add('results', len(results))
+            return results.reset_index(drop=True)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import pyarrow as pa
+
+from src.file_tools import read_processed_regs_into_dataframe, RegulationIndex
+from src.tree_tools import Tree, TreeNode
+
+####
+# A corpus snapshot is a single binary file with everything a chatbot worker needs for one regulation:
+#   - the parsed regulation DataFrame (the output of read_processed_regs_into_dataframe)
+#   - the non-text blocks (Tables, Formulas, ...)
+#   - the tree structure (so the tree does not need to be rebuilt from the references)
+#   - the reference index used by RegulationIndex (full reference -> row positions)
+#
+# The file layout is
+#   SNAPSHOT_MAGIC | header length (8 bytes, little endian) | header (json) | Arrow IPC segments
+# The header records the format version, the sha256 of each source file, the ValidIndex patterns and the offset and
+# length of each Arrow IPC segment. A snapshot is stale if any of these differ from the current sources.
+#
+# Loading a snapshot only reads the header. The file is memory mapped and each segment is only converted when it is
+# first used, so worker start up is a file open rather than a re-parse.
+###
+SNAPSHOT_MAGIC = b'REGSNAP\x00'
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+def compile_corpus_snapshot(snapshot_path, file_list, valid_index_checker, non_text_labels, root_node_name, reference_prefix = '23'):
+    df, non_text = read_processed_regs_into_dataframe(file_list=file_list, valid_index_checker=valid_index_checker, non_text_labels=non_text_labels, reference_prefix=reference_prefix)
+    tree = Tree.from_frame(root_node_name, df, valid_index_checker)
+    regulation_index = RegulationIndex(df, valid_index_checker)
+
+    non_text_rows = [(label, block, lines) for label in non_text for block, lines in non_text[label].items()]
+    tree_rows = [(node.name, node.full_node_name, node.parent.full_node_name, node.heading_text) for node in tree.root.descendants]
+    segments = {
+        'regulations': pa.Table.from_pandas(df, preserve_index=False),
+        'non_text': pa.table({
+            'label': [row[0] for row in non_text_rows],
+            'block': [row[1] for row in non_text_rows],
+            'lines': pa.array([row[2] for row in non_text_rows], type=pa.list_(pa.string())),
+        }),
+        # descendants are in pre-order so a node's parent is always created before the node
+        'tree': pa.table({
+            'name': [row[0] for row in tree_rows],
+            'full_node_name': [row[1] for row in tree_rows],
+            'parent_full_node_name': [row[2] for row in tree_rows],
+            'heading_text': [row[3] for row in tree_rows],
+        }),
+        'reference_index': pa.table({
+            'full_reference': list(regulation_index.sorted_references),
+            'rows': pa.array([regulation_index.rows_for_reference[reference] for reference in regulation_index.sorted_references], type=pa.list_(pa.int64())),
+        }),
+    }
+
+    segment_bytes = {}
+    for name, table in segments.items():
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        segment_bytes[name] = sink.getvalue()
+
+    header = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'sources': [[file, hash_file(file)] for file in file_list],
+        'index_patterns': list(valid_index_checker.index_patterns),
+        'exclusion_list': list(valid_index_checker.exclusion_list),
+        'non_text_labels': list(non_text_labels),
+        'reference_prefix': reference_prefix,
+        'root_node_name': root_node_name,
+        'root_heading_text': tree.root.heading_text,
+        'segments': {},
+    }
+    # The segment offsets are relative to the end of the header so the header size does not depend on them
+    offset = 0
+    for name, data in segment_bytes.items():
+        header['segments'][name] = [offset, data.size]
+        offset += data.size
+    encoded_header = json.dumps(header).encode('utf-8')
+
+    # A unique temporary file in the same directory (so os.replace is atomic) because several workers can compile the
+    # same snapshot at once
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(snapshot_path)),
+                                                       prefix=os.path.basename(snapshot_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<Q', len(encoded_header)))
+            f.write(encoded_header)
+            for data in segment_bytes.values():
+                f.write(data)
+        os.replace(temporary_path, snapshot_path) # readers never see a partially written snapshot
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def hash_file(file):
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_snapshot_header(snapshot_path):
+    with open(snapshot_path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f'{snapshot_path} is not a corpus snapshot')
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    header['data_offset'] = len(SNAPSHOT_MAGIC) + 8 + header_length
+    return header
+
+
+# Returns True if the snapshot exists and was compiled from the same files (in the same order, with the same
+# content) with the same ValidIndex, non_text_labels and reference_prefix
+def is_snapshot_current(snapshot_path, file_list, valid_index_checker, non_text_labels, reference_prefix = '23'):
+    if not os.path.exists(snapshot_path):
+        return False
+    try:
+        header = read_snapshot_header(snapshot_path)
+    except (ValueError, struct.error):
+        return False
+    return header['format_version'] == SNAPSHOT_FORMAT_VERSION \
+        and header['sources'] == [[file, hash_file(file)] for file in file_list] \
+        and header['index_patterns'] == list(valid_index_checker.index_patterns) \
+        and header['exclusion_list'] == list(valid_index_checker.exclusion_list) \
+        and header['non_text_labels'] == list(non_text_labels) \
+        and header.get('reference_prefix', '23') == reference_prefix
+
+
+# Loads the snapshot, compiling it first if it does not exist or is stale
+def load_or_compile_corpus_snapshot(snapshot_path, file_list, valid_index_checker, non_text_labels, root_node_name, reference_prefix = '23'):
+    if not is_snapshot_current(snapshot_path, file_list, valid_index_checker, non_text_labels, reference_prefix):
+        compile_corpus_snapshot(snapshot_path, file_list, valid_index_checker, non_text_labels, root_node_name, reference_prefix)
+    return CorpusSnapshot(snapshot_path, valid_index_checker)
+
+
+class CorpusSnapshot():
+    def __init__(self, snapshot_path, valid_index_checker):
+        self.snapshot_path = snapshot_path
+        self.valid_index_checker = valid_index_checker
+        self.header = read_snapshot_header(snapshot_path)
+        if self.header['format_version'] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Snapshot {snapshot_path} has format version {self.header['format_version']} but version {SNAPSHOT_FORMAT_VERSION} is required")
+        if self.header['index_patterns'] != list(valid_index_checker.index_patterns):
+            raise ValueError(f"Snapshot {snapshot_path} was compiled with a different ValidIndex")
+        self._memory_map = pa.memory_map(snapshot_path, 'r')
+        self._df = None
+        self._non_text = None
+        self._tree = None
+        self._regulation_index = None
+
+    # Zero copy view of one of the Arrow segments in the memory mapped file
+    def read_segment(self, name):
+        offset, length = self.header['segments'][name]
+        self._memory_map.seek(self.header['data_offset'] + offset)
+        return pa.ipc.open_file(self._memory_map.read_buffer(length)).read_all()
+
+    @property
+    def df(self):
+        if self._df is None:
+            self._df = self.read_segment('regulations').to_pandas()
+        return self._df
+
+    @property
+    def non_text(self):
+        if self._non_text is None:
+            non_text = {label: {} for label in self.header['non_text_labels']}
+            for row in self.read_segment('non_text').to_pylist():
+                non_text[row['label']][row['block']] = row['lines']
+            self._non_text = non_text
+        return self._non_text
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            tree = Tree(self.header['root_node_name'], self.valid_index_checker)
+            tree.root.heading_text = self.header['root_heading_text']
+            segment = self.read_segment('tree')
+            for name, full_node_name, parent_full_node_name, heading_text in zip(*[segment.column(column).to_pylist() for column in ['name', 'full_node_name', 'parent_full_node_name', 'heading_text']]):
+                parent = tree.nodes[parent_full_node_name] if parent_full_node_name != '' else tree.root
+                tree.nodes[full_node_name] = TreeNode(name, full_node_name, parent=parent, heading_text=heading_text)
+            self._tree = tree
+        return self._tree
+
+    @property
+    def regulation_index(self):
+        if self._regulation_index is None:
+            segment = self.read_segment('reference_index')
+            rows_for_reference = dict(zip(segment.column('full_reference').to_pylist(), segment.column('rows').to_pylist()))
+            self._regulation_index = RegulationIndex(self.df, self.valid_index_checker, rows_for_reference=rows_for_reference)
+        return self._regulation_index
+
+    def close(self):
+        self._memory_map.close()
@@ -0,0 +1,96 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import numpy as np
+
+####
+# Content addressed cache for embeddings, stored in a local SQLite file. The key is a hash of the model name and the
+# normalised text so a summary, question or heading that has not changed since the last index build (or a user
+# question that has been asked before) does not need to be embedded again.
+#
+# Entries are evicted when they are older than max_age_seconds (measured from when they were added) and, when there
+# are more than max_entries, the least recently used entries are removed first.
+###
+class EmbeddingCache():
+    def __init__(self, path, max_entries = None, max_age_seconds = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                                        key TEXT PRIMARY KEY,
+                                        model TEXT NOT NULL,
+                                        embedding BLOB NOT NULL,
+                                        created REAL NOT NULL,
+                                        last_used REAL NOT NULL)""")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    # Returns a list with the cached embedding (a float32 array) for each text or None if the text is not cached
+    def get_many(self, texts, model):
+        keys = [cache_key(text, model) for text in texts]
+        found = {}
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), 500): # stay below SQLite's limit on the number of query parameters
+                chunk = keys[start:start + 500]
+                rows = self._connection.execute(f"SELECT key, embedding, created FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, embedding, created in rows:
+                    if self.max_age_seconds is None or now - created <= self.max_age_seconds:
+                        found[key] = np.frombuffer(embedding, dtype=np.float32)
+            self._connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self._connection.commit()
+            embeddings = [found.get(key) for key in keys]
+            hits = sum(1 for embedding in embeddings if embedding is not None)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return embeddings
+
+    def put_many(self, texts, model, embeddings):
+        now = time.time()
+        rows = [(cache_key(text, model), model, np.asarray(embedding, dtype=np.float32).tobytes(), now, now) for text, embedding in zip(texts, embeddings)]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings (key, model, embedding, created, last_used) VALUES (?, ?, ?, ?, ?)", rows)
+            self._connection.commit()
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            if self.max_age_seconds is not None:
+                self._connection.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - self.max_age_seconds,))
+            if self.max_entries is not None:
+                self._connection.execute("""DELETE FROM embeddings WHERE key IN (
+                                                SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def statistics(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'entries': len(self),
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# Texts that only differ in unicode representation or whitespace get the same embedding
+def normalise_text(text):
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', str(text))).strip()
+
+
+def cache_key(text, model):
+    return hashlib.sha256((model + '\x00' + normalise_text(text)).encode('utf-8')).hexdigest()
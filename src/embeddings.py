@@ -1,24 +1,96 @@
+import os
+import json
+import mmap
+import random
+import time
+import threading
+import uuid
+from functools import lru_cache
 import openai
 import tiktoken
 
-from scipy.spatial import distance
+from src.openai_clients import get_client
+from src.instrumentation import stage
+
+import numpy as np
 import pandas as pd
 
-def num_tokens_from_string(string: str, encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")) -> int:
+DEFAULT_TOKENIZER_MODEL = "gpt-3.5-turbo"
+
+# Loading a tiktoken encoding is expensive so each model's encoding is only loaded once, on first use
+_encodings = {}
+_encodings_lock = threading.Lock()
+# Set with set_encoding to count tokens without tiktoken (e.g. with src.fake_openai.FakeEncoding)
+_encoding_override = None
+
+def get_encoding(model = DEFAULT_TOKENIZER_MODEL):
+    if _encoding_override is not None:
+        return _encoding_override
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _encodings_lock:
+            if model not in _encodings:
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    print(f"Warning: model {model} not found. Using cl100k_base encoding.")
+                    _encodings[model] = tiktoken.get_encoding("cl100k_base")
+            encoding = _encodings[model]
+    return encoding
+
+
+# Replaces the encoding returned by get_encoding for every model, or restores the tiktoken encodings if encoding is
+# None. The encoding needs encode(text) and encode_batch(texts, num_threads). Returns the encoding it replaced (None if
+# tiktoken was in use). The memoised token counts are cleared because they were counted with the old encoding
+def set_encoding(encoding = None):
+    global _encoding_override
+    with _encodings_lock:
+        previous_encoding = _encoding_override
+        _encoding_override = encoding
+    clear_token_count_cache()
+    return previous_encoding
+
+
+# Chunking and rendering count the same (often large, overlapping) texts many times so the counts are memoised
+@lru_cache(maxsize=16384)
+def _cached_token_count(string, model = DEFAULT_TOKENIZER_MODEL):
+    with stage('tokenize', model=model) as tokenize_stage:
+        token_count = len(get_encoding(model).encode(string))
+        tokenize_stage.add('tokens', token_count)
+    return token_count
+
+
+# Forgets the memoised token counts, e.g. so a benchmark measures the tokenization on every run
+def clear_token_count_cache():
+    _cached_token_count.cache_clear()
+
+
+def num_tokens_from_string(string: str, encoding = None) -> int:
+    """Returns the number of tokens in a text string."""
     if pd.isna(string):
         return 0
-    """Returns the number of tokens in a text string."""
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-    
+    if encoding is None:
+        return _cached_token_count(string)
+    return len(encoding.encode(string))
+
+
+def num_tokens_from_strings(strings, model = DEFAULT_TOKENIZER_MODEL, num_threads = 8):
+    """Returns the number of tokens in each text in the list, encoding the distinct texts in one threaded batch."""
+    strings = list(strings)
+    distinct = list({string for string in strings if not pd.isna(string)})
+    counts = {}
+    if distinct:
+        with stage('tokenize', model=model) as tokenize_stage:
+            encoded = get_encoding(model).encode_batch(distinct, num_threads=num_threads)
+            counts = {string: len(tokens) for string, tokens in zip(distinct, encoded)}
+            tokenize_stage.add('texts', len(distinct))
+            tokenize_stage.add('tokens', sum(counts.values()))
+    return [0 if pd.isna(string) else counts[string] for string in strings]
+
+
 # see https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model="gpt-3.5"):
     """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
     if model in {
         "gpt-3.5-turbo-0613",
         "gpt-3.5-turbo-16k-0613",
@@ -46,17 +118,278 @@ def num_tokens_from_messages(messages, model="gpt-3.5"):
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            num_tokens += _cached_token_count(value, model)
             if key == "name":
                 num_tokens += tokens_per_name
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
-def get_ada_embedding(text, model="text-embedding-ada-002"):
-   return openai.Embedding.create(input = [text], model=model)['data'][0]['embedding']
+# If an EmbeddingCache is provided, a text that is already in the cache (e.g. a question that has been asked before) is
+# not sent to the API and a new embedding is added to the cache. To use a cache where a search takes get_embedding,
+# pass e.g. lambda question: get_ada_embedding(question, cache=cache)
+def get_ada_embedding(text, model="text-embedding-ada-002", cache = None):
+   if cache is not None:
+       cached = cache.get_many([text], model)[0]
+       if cached is not None:
+           return cached.tolist()
+   with stage('embed', model=model) as embed_stage:
+       response = get_client().embeddings.create(input = [text], model=model)
+       embed_stage.add_usage(response)
+       embed_stage.add('texts', 1)
+   embedding = response.data[0].embedding
+   if cache is not None:
+       cache.put_many([text], model, [embedding])
+   return embedding
+
+
+# Limits for a single request to the embeddings endpoint
+EMBEDDING_MAX_TOKENS_PER_TEXT = 8191
+EMBEDDING_MAX_ITEMS_PER_REQUEST = 2048
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 300000
+
+# Embeds a list of texts, packing as many texts into each request as the item and token limits allow. Returns a
+# float32 matrix with one row per input text, in the same order as the input. A request that fails with a transient
+# error (rate limit, server or connection error) is retried as it is with an exponential backoff. Each packed request
+# has a budget of max_retries retries, shared with the smaller requests it may be split into, so the number of
+# requests is bounded while the API is throttling. A request that is rejected (openai.BadRequestError, e.g. one bad
+# text) is split in half and only the halves are sent again so one bad text does not cost the whole batch.
+#
+# If an EmbeddingCache is provided, only the texts that are not in the cache are sent to the API and their embeddings
+# are added to the cache.
+def get_embeddings(texts, model = "text-embedding-ada-002", client = None,
+                   max_items_per_request = EMBEDDING_MAX_ITEMS_PER_REQUEST,
+                   max_tokens_per_request = EMBEDDING_MAX_TOKENS_PER_REQUEST,
+                   max_retries = 3, retry_wait_seconds = 1.0, cache = None):
+    texts = list(texts)
+    if len(texts) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+
+    embeddings = cache.get_many(texts, model) if cache is not None else [None] * len(texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        if client is None:
+            client = get_client()
+        missing_texts = [texts[i] for i in missing]
+        new_embeddings = []
+        for batch in pack_embedding_requests(missing_texts, max_items_per_request, max_tokens_per_request):
+            new_embeddings.extend(_embed_batch(batch, model, client, {'retries_left': max_retries}, retry_wait_seconds))
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+        if cache is not None:
+            cache.put_many(missing_texts, model, new_embeddings)
+    return np.array(embeddings, dtype=np.float32)
+
+
+# Splits the texts into consecutive batches that each respect the item and token limits of one request
+def pack_embedding_requests(texts, max_items_per_request = EMBEDDING_MAX_ITEMS_PER_REQUEST, max_tokens_per_request = EMBEDDING_MAX_TOKENS_PER_REQUEST):
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for text, token_count in zip(texts, num_tokens_from_strings(texts)):
+        if token_count > EMBEDDING_MAX_TOKENS_PER_TEXT:
+            raise ValueError(f"Text with {token_count} tokens exceeds the embedding limit of {EMBEDDING_MAX_TOKENS_PER_TEXT} tokens: {text[:100]}")
+        if batch and (len(batch) >= max_items_per_request or batch_tokens + token_count > max_tokens_per_request):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(text)
+        batch_tokens += token_count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _embed_batch(texts, model, client, retry_budget, retry_wait_seconds):
+    attempt = 0
+    while True:
+        try:
+            with stage('embed', model=model) as embed_stage:
+                response = client.embeddings.create(input=texts, model=model)
+                embed_stage.add_usage(response)
+                embed_stage.add('texts', len(texts))
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except (openai.AuthenticationError, openai.PermissionDeniedError):
+            raise # retrying will not help
+        except openai.BadRequestError:
+            # sending the same request again will not help but the texts without the bad one may succeed
+            if len(texts) == 1:
+                raise
+            middle = len(texts) // 2
+            return _embed_batch(texts[:middle], model, client, retry_budget, retry_wait_seconds) \
+                 + _embed_batch(texts[middle:], model, client, retry_budget, retry_wait_seconds)
+        except openai.OpenAIError:
+            if retry_budget['retries_left'] <= 0:
+                raise
+            retry_budget['retries_left'] -= 1
+            wait = retry_wait_seconds * (2 ** attempt)
+            time.sleep(wait + random.uniform(0, wait))
+            attempt += 1
+
 
 def get_closest_nodes(df, embedding_column_name, question_embedding, threshold = 0.15):
-      df['cosine_distance'] = df[embedding_column_name].apply(lambda x: distance.cosine(x, question_embedding))
-      closest_nodes = df[df['cosine_distance'] < threshold].sort_values(by='cosine_distance', ascending=True)
-      return closest_nodes
\ No newline at end of file
+    # Convenience wrapper for a once-off search. If the same DataFrame is searched repeatedly (e.g. once per chatbot
+    # turn), build an EmbeddingIndex once and call its search method instead so the embeddings are only stacked once.
+    # Unlike earlier versions, this does not add a 'cosine_distance' column to the input DataFrame. The column is only
+    # added to the returned copy.
+    return EmbeddingIndex(df, embedding_column_name).search(question_embedding, threshold=threshold)
+
+
+class EmbeddingIndex():
+    """
+    Holds the embeddings from one column of an index DataFrame as a single contiguous float32 matrix where every row
+    has been normalised to unit length. The cosine distance between a question and every row in the index is then
+    1 - (matrix @ normalised_question), i.e. a single matrix-vector product.
+
+    The source DataFrame is never modified so one instance can safely be shared between concurrent requests.
+
+    If normalised_embeddings is provided (e.g. a memory-mapped matrix from load_embedding_index) it is used as is,
+    without a copy, and the DataFrame does not need to contain the embedding column.
+
+    version identifies the build of the index (e.g. so cached search results can be invalidated when the index is
+    rebuilt). By default every instance gets a new version.
+    """
+    def __init__(self, df, embedding_column_name = 'Embedding', normalised_embeddings = None, version = None):
+        self.df = df
+        self.embedding_column_name = embedding_column_name
+        self.version = version if version is not None else uuid.uuid4().hex
+        if normalised_embeddings is not None:
+            if normalised_embeddings.shape[0] != len(df):
+                raise ValueError(f"The DataFrame has {len(df)} rows but there are {normalised_embeddings.shape[0]} embeddings")
+            self.embeddings = normalised_embeddings
+        elif len(df) == 0:
+            self.embeddings = np.empty((0, 0), dtype=np.float32)
+        else:
+            self.embeddings = normalise_rows(np.vstack(df[embedding_column_name].to_numpy()))
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def cosine_distances(self, question_embedding):
+        question = np.asarray(question_embedding, dtype=np.float32)
+        norm = np.linalg.norm(question)
+        if norm == 0:
+            raise ValueError("Unable to compute cosine distances for a question embedding with zero length")
+        return 1.0 - self.embeddings @ (question / norm)
+
+    # Returns the row positions (not the DataFrame index labels) and cosine distances of the rows closer than the
+    # threshold, sorted from closest to furthest. If top_k is set, only the top_k closest rows are returned.
+    def nearest(self, question_embedding, threshold = 0.15, top_k = None):
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        distances = self.cosine_distances(question_embedding)
+        return select_closest(np.arange(len(distances)), distances, threshold=threshold, top_k=top_k)
+
+    # Returns a copy of the rows of the source DataFrame that are closer than the threshold, sorted by the new
+    # 'cosine_distance' column, in the same format as get_closest_nodes
+    def search(self, question_embedding, threshold = 0.15, top_k = None):
+        with stage('retrieve', index='exact', rows=len(self)) as retrieve_stage:
+            positions, distances = self.nearest(question_embedding, threshold=threshold, top_k=top_k)
+            retrieve_stage.add('results', len(positions))
+            return self.get_rows(positions, distances)
+
+    def get_rows(self, positions, distances):
+        closest_nodes = self.df.iloc[positions].copy()
+        closest_nodes['cosine_distance'] = np.asarray(distances, dtype=np.float64)
+        return closest_nodes
+
+
+# Given candidate row positions and their cosine distances, returns the positions and distances of the candidates
+# closer than the threshold, sorted from closest to furthest and limited to top_k if it is set
+def select_closest(positions, distances, threshold = 0.15, top_k = None):
+    candidates = np.flatnonzero(distances < threshold)
+    if top_k is not None and len(candidates) > top_k:
+        # argpartition is O(n) and only the top_k survivors need to be sorted
+        candidates = candidates[np.argpartition(distances[candidates], top_k - 1)[:top_k]]
+    order = candidates[np.argsort(distances[candidates], kind='stable')]
+    return positions[order], distances[order]
+
+
+# Returns a float32 copy of the matrix with each row scaled to unit length. Rows with zero length are left as zero
+# so they have a cosine distance of 1 to everything.
+def normalise_rows(matrix):
+    matrix = np.array(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return np.ascontiguousarray(matrix)
+
+
+####
+# On disk format for an embedding index. An index is saved as a directory containing
+#   - header.json:      the format version, a build id and the shape of the embedding matrix
+#   - embeddings.npy:   the row normalised float32 embedding matrix as a fixed width .npy file
+#   - metadata.parquet: one row per embedding with the metadata columns (e.g. section, source) plus the byte offset
+#                       and length of its text in text.bin
+#   - text.bin:         the utf-8 encoded text of every row, concatenated
+# When loaded, the embedding matrix and the text are memory mapped so loading takes (almost) constant time, the pages
+# are shared between worker processes that load the same index and the search code gets a NumPy view with no copy.
+###
+EMBEDDING_INDEX_FORMAT_VERSION = 1
+
+
+def save_embedding_index(df, path, embedding_column_name = 'Embedding', text_column_name = 'text', metadata_columns = ['section', 'source']):
+    os.makedirs(path, exist_ok=True)
+    if len(df) == 0:
+        raise ValueError("Unable to save an empty embedding index")
+    embeddings = normalise_rows(np.vstack(df[embedding_column_name].to_numpy()))
+    np.save(os.path.join(path, 'embeddings.npy'), embeddings)
+
+    encoded_text = [str(text).encode('utf-8') for text in df[text_column_name]]
+    text_length = np.array([len(text) for text in encoded_text], dtype=np.int64)
+    text_offset = np.concatenate(([0], np.cumsum(text_length)[:-1])).astype(np.int64)
+    with open(os.path.join(path, 'text.bin'), 'wb') as f:
+        f.write(b''.join(encoded_text))
+
+    metadata = df[list(metadata_columns)].reset_index(drop=True)
+    metadata['text_offset'] = text_offset
+    metadata['text_length'] = text_length
+    metadata.to_parquet(os.path.join(path, 'metadata.parquet'), engine='pyarrow', index=False)
+
+    header = {
+        'format_version': EMBEDDING_INDEX_FORMAT_VERSION,
+        'build_id': uuid.uuid4().hex,
+        'rows': int(embeddings.shape[0]),
+        'dimension': int(embeddings.shape[1]),
+        'dtype': 'float32',
+        'text_column_name': text_column_name,
+    }
+    with open(os.path.join(path, 'header.json'), 'w', encoding='utf-8') as f:
+        json.dump(header, f)
+
+
+def load_embedding_index(path):
+    with open(os.path.join(path, 'header.json'), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header['format_version'] != EMBEDDING_INDEX_FORMAT_VERSION:
+        raise ValueError(f"Embedding index {path} has format version {header['format_version']} but version {EMBEDDING_INDEX_FORMAT_VERSION} is required")
+    embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='r')
+    if embeddings.shape != (header['rows'], header['dimension']):
+        raise ValueError(f"Embedding index {path} is corrupt: expected shape {(header['rows'], header['dimension'])} but found {embeddings.shape}")
+    metadata = pd.read_parquet(os.path.join(path, 'metadata.parquet'), engine='pyarrow')
+    with open(os.path.join(path, 'text.bin'), 'rb') as f:
+        text_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+    return MappedEmbeddingIndex(metadata, embeddings, text_buffer, header['text_column_name'], version=header.get('build_id'))
+
+
+class MappedEmbeddingIndex(EmbeddingIndex):
+    """
+    An EmbeddingIndex loaded from disk by load_embedding_index. The text of a row is only decoded when the row is
+    returned from a search.
+    """
+    def __init__(self, metadata, normalised_embeddings, text_buffer, text_column_name = 'text', version = None):
+        super().__init__(metadata, embedding_column_name=None, normalised_embeddings=normalised_embeddings, version=version)
+        self.text_buffer = text_buffer
+        self.text_column_name = text_column_name
+        self._text_offset = metadata['text_offset'].to_numpy()
+        self._text_length = metadata['text_length'].to_numpy()
+
+    def get_text(self, position):
+        start = self._text_offset[position]
+        return bytes(self.text_buffer[start:start + self._text_length[position]]).decode('utf-8')
+
+    def get_rows(self, positions, distances):
+        closest_nodes = self.df.iloc[positions].drop(columns=['text_offset', 'text_length'])
+        closest_nodes[self.text_column_name] = [self.get_text(position) for position in positions]
+        closest_nodes['cosine_distance'] = np.asarray(distances, dtype=np.float64)
+        return closest_nodes
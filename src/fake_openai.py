@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from types import SimpleNamespace
+import numpy as np
+import openai
+
+####
+# Offline stand-in for the OpenAI v1 client with the two endpoints used by this package:
+#     client.embeddings.create(input, model)
+#     client.chat.completions.create(model, messages, max_tokens, ...)
+# FakeOpenAI is synchronous and FakeAsyncOpenAI has the same behaviour with coroutines. Use them directly, or through
+# src.openai_clients (use_fake_clients or REG23_OPENAI_CLIENT=fake), to test and benchmark the embedding, generation
+# and chat paths without network access.
+#
+# Behaviour:
+#   - embeddings are deterministic: the normalised sum of a pseudo random vector per word plus a small vector for the
+#     whole text so texts that share words are close and identical texts have identical embeddings
+#   - completions are deterministic functions of the model and the messages (see default_completion) unless a
+#     completion_function(model, messages) is provided. A completion longer than max_tokens is cut off with
+#     finish_reason 'length'
+#   - each request waits for a latency drawn from a distribution (see constant_latency, uniform_latency and
+#     lognormal_latency) plus per_token_latency_seconds for each completion token
+#   - requests fail with a 429 (openai.RateLimitError) or 500 (openai.InternalServerError) with the given
+#     probabilities, and with a 429 when more than requests_per_minute requests arrive in a sliding minute
+#   - completions are truncated (finish_reason 'length') with truncation_probability
+# Token counts are approximated by the number of words so the fake does not need the tiktoken encodings.
+#
+# FakeEncoding is a stand-in for a tiktoken encoding with the same approximation, for code that counts tokens itself
+# (see src.embeddings.set_encoding), e.g. to run the benchmarks without downloading the tiktoken encoding file.
+###
+_word_pattern = re.compile(r'\w+')
+
+
+def constant_latency(seconds):
+    return lambda rng: seconds
+
+
+def uniform_latency(minimum_seconds, maximum_seconds):
+    return lambda rng: rng.uniform(minimum_seconds, maximum_seconds)
+
+
+# The median and the spread (sigma of the underlying normal distribution) of a long tailed latency distribution
+def lognormal_latency(median_seconds, sigma):
+    return lambda rng: median_seconds * math.exp(rng.gauss(0.0, sigma))
+
+
+def default_completion(model, messages):
+    user_content = messages[-1]['content']
+    digest = hashlib.sha256((model + '\x00' + '\x00'.join(message['content'] for message in messages)).encode('utf-8')).hexdigest()[:8]
+    words = user_content.split()
+    return f"Response {digest} from {model}: " + ' '.join(words[:50])
+
+
+class FakeOpenAIBackend():
+    def __init__(self, embedding_dimension = 1536, latency = None, per_token_latency_seconds = 0.0,
+                 rate_limit_probability = 0.0, server_error_probability = 0.0, truncation_probability = 0.0,
+                 requests_per_minute = None, completion_function = None, seed = 42):
+        self.embedding_dimension = embedding_dimension
+        self.latency = latency if callable(latency) else constant_latency(latency or 0.0)
+        self.per_token_latency_seconds = per_token_latency_seconds
+        self.rate_limit_probability = rate_limit_probability
+        self.server_error_probability = server_error_probability
+        self.truncation_probability = truncation_probability
+        self.requests_per_minute = requests_per_minute
+        self.completion_function = completion_function if completion_function is not None else default_completion
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._request_times = deque()
+        self.statistics = {'embedding_requests': 0, 'completion_requests': 0, 'rate_limit_errors': 0, 'server_errors': 0,
+                           'truncated_completions': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    # Draws the latency and decides whether the request fails. Returns (latency, error or None)
+    def start_request(self, endpoint):
+        with self._lock:
+            self.statistics[endpoint + '_requests'] += 1
+            latency = max(self.latency(self.random), 0.0)
+            now = time.monotonic()
+            if self.requests_per_minute is not None:
+                while self._request_times and now - self._request_times[0] >= 60.0:
+                    self._request_times.popleft()
+                if len(self._request_times) >= self.requests_per_minute:
+                    self.statistics['rate_limit_errors'] += 1
+                    return latency, _status_error(openai.RateLimitError, 429, 'Rate limit reached for requests')
+                self._request_times.append(now)
+            draw = self.random.random()
+            if draw < self.rate_limit_probability:
+                self.statistics['rate_limit_errors'] += 1
+                return latency, _status_error(openai.RateLimitError, 429, 'Rate limit reached (injected)')
+            if draw < self.rate_limit_probability + self.server_error_probability:
+                self.statistics['server_errors'] += 1
+                return latency, _status_error(openai.InternalServerError, 500, 'The server had an error (injected)')
+        return latency, None
+
+    def embed(self, input, model):
+        texts = [input] if isinstance(input, str) else list(input)
+        data = [SimpleNamespace(object='embedding', index=i, embedding=fake_embedding(text, model, self.embedding_dimension).tolist()) for i, text in enumerate(texts)]
+        prompt_tokens = sum(_count_words(text) for text in texts)
+        with self._lock:
+            self.statistics['prompt_tokens'] += prompt_tokens
+        return SimpleNamespace(object='list', model=model, data=data, usage=SimpleNamespace(prompt_tokens=prompt_tokens, total_tokens=prompt_tokens))
+
+    # Returns the response and the extra latency for generating the completion tokens
+    def complete(self, model, messages, max_tokens = None):
+        words = self.completion_function(model, messages).split(' ')
+        finish_reason = 'stop'
+        if max_tokens is not None and len(words) > max_tokens:
+            words = words[:max_tokens]
+            finish_reason = 'length'
+        with self._lock:
+            if finish_reason == 'stop' and self.random.random() < self.truncation_probability:
+                words = words[:max(len(words) // 2, 1)]
+                finish_reason = 'length'
+            if finish_reason == 'length':
+                self.statistics['truncated_completions'] += 1
+            prompt_tokens = sum(_count_words(message['content']) for message in messages)
+            completion_tokens = len(words)
+            self.statistics['prompt_tokens'] += prompt_tokens
+            self.statistics['completion_tokens'] += completion_tokens
+        response = SimpleNamespace(
+            id='chatcmpl-fake', object='chat.completion', created=int(time.time()), model=model,
+            choices=[SimpleNamespace(index=0, finish_reason=finish_reason, message=SimpleNamespace(role='assistant', content=' '.join(words)))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens))
+        return response, completion_tokens * self.per_token_latency_seconds
+
+
+class FakeOpenAI():
+    def __init__(self, backend = None, **kwargs):
+        self.backend = backend if backend is not None else FakeOpenAIBackend(**kwargs)
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    def _create_embeddings(self, input, model, **kwargs):
+        latency, error = self.backend.start_request('embedding')
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        return self.backend.embed(input, model)
+
+    def _create_completion(self, model, messages, max_tokens = None, **kwargs):
+        latency, error = self.backend.start_request('completion')
+        time.sleep(latency)
+        if error is not None:
+            raise error
+        response, generation_latency = self.backend.complete(model, messages, max_tokens)
+        time.sleep(generation_latency)
+        return response
+
+
+class FakeAsyncOpenAI():
+    def __init__(self, backend = None, **kwargs):
+        self.backend = backend if backend is not None else FakeOpenAIBackend(**kwargs)
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create_completion))
+
+    async def _create_embeddings(self, input, model, **kwargs):
+        latency, error = self.backend.start_request('embedding')
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return self.backend.embed(input, model)
+
+    async def _create_completion(self, model, messages, max_tokens = None, **kwargs):
+        latency, error = self.backend.start_request('completion')
+        await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        response, generation_latency = self.backend.complete(model, messages, max_tokens)
+        await asyncio.sleep(generation_latency)
+        return response
+
+
+def fake_embedding(text, model = 'text-embedding-ada-002', dimension = 1536):
+    embedding = 0.1 * _seeded_vector(model + '\x00text\x00' + text, dimension)
+    for word in _word_pattern.findall(text.lower()):
+        embedding = embedding + _seeded_vector(model + '\x00word\x00' + word, dimension)
+    return (embedding / np.linalg.norm(embedding)).astype(np.float32)
+
+
+@lru_cache(maxsize=65536)
+def _seeded_vector(key, dimension):
+    seed = int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    vector.flags.writeable = False # shared between calls through the cache
+    return vector
+
+
+# Each word and each punctuation character is one token
+class FakeEncoding():
+    _token_pattern = re.compile(r'\w+|[^\w\s]')
+
+    def encode(self, text, **kwargs):
+        return self._token_pattern.findall(text)
+
+    def encode_batch(self, texts, num_threads = 8, **kwargs):
+        return [self.encode(text) for text in texts]
+
+
+def _count_words(text):
+    return len(str(text).split())
+
+
+# openai's status errors need an http response. Only these attributes are read when the error is created
+def _status_error(error_class, status_code, message):
+    response = SimpleNamespace(status_code=status_code, request=None, headers={})
+    return error_class(message, response=response, body=None)
@@ -1,42 +1,113 @@
 import pandas as pd
 import os
 import re
+import bisect
+import concurrent.futures
 from src.valid_index import ValidIndex
-
-
-
-def process_regulations(filenames_as_list, valid_index_checker, non_text_labels):
-    all_data_as_lines = []
+from src.embeddings import num_tokens_from_strings
+from src.instrumentation import stage
+
+
+
+# Reads the regulation files one line at a time. Each line passes through the pipeline:
+#   read_non_blank_lines -> extract_non_text_blocks -> iterate_parsed_lines -> column lists
+# so only the parsed columns (and the non-text blocks) are held in memory, not copies of the input text.
+#
+# If max_workers > 1, the files are parsed concurrently in a process pool and the rows from each file are merged in
+# the order of filenames_as_list. The full references are only added after the merge because a line at the start of
+# a file can depend on the last reference seen at each indent in the previous file.
+#
+# reference_prefix is added to the start of every full reference, e.g. '23' for Regulation 23 of the Banks Act. It must
+# match the first of the valid_index_checker patterns.
+def process_regulations(filenames_as_list, valid_index_checker, non_text_labels, max_workers = None, reference_prefix = '23'):
     non_text = {}
     for i in range(0, len(non_text_labels)):
         non_text[non_text_labels[i]] = {}
 
-    for file in filenames_as_list:
-        #print(f"Processing file: {file}")
-        text = {}
-        with open(file, 'r', encoding='utf-8') as f:
-            text = f.read()
+    with stage('parse', files=len(filenames_as_list)) as parse_stage:
+        if max_workers is not None and max_workers > 1 and len(filenames_as_list) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                parsed_files = list(executor.map(_process_regulation_file, filenames_as_list,
+                                                 [valid_index_checker] * len(filenames_as_list),
+                                                 [non_text_labels] * len(filenames_as_list)))
+            for _, file_non_text in parsed_files:
+                for label in non_text_labels:
+                    non_text[label].update(file_non_text[label])
+            file_dfs = [file_df for file_df, _ in parsed_files if len(file_df) > 0]
+            df = pd.concat(file_dfs, ignore_index=True) if file_dfs else parsed_files[0][0]
+        else:
+            lines = (line for file in filenames_as_list for line in extract_non_text_blocks(read_non_blank_lines(file), non_text_labels, non_text))
+            df = process_lines(lines, valid_index_checker)
+        parse_stage.add('rows', len(df))
+    with stage('full_reference'):
+        add_full_reference(df, valid_index_checker, reference_prefix) # adds the reference to the input dataframe
+    df['word_count'] = df['Text'].str.split().str.len()
+    return df, non_text
+
 
-        remaining_lines = text.split('\n')
-        # remove empty lines
-        remaining_lines = [line for line in remaining_lines if line.strip() != '']
+# Runs in a worker process. Returns the parsed rows (without the full reference) and the non-text blocks for one file
+def _process_regulation_file(file, valid_index_checker, non_text_labels):
+    non_text = {label: {} for label in non_text_labels}
+    df = process_lines(extract_non_text_blocks(read_non_blank_lines(file), non_text_labels, non_text), valid_index_checker)
+    return df, non_text
 
-        for i in range(0, len(non_text_labels)):
-            remaining_lines, non_text_table_dict = extract_non_text(remaining_lines, '#' + non_text_labels[i])
-            #print(non_text_table_dict)
-            non_text[non_text_labels[i]].update(non_text_table_dict)
 
-        # print(f'read {len(remaining_lines)} lines from {file})')
-        all_data_as_lines.extend(remaining_lines)
-        #print(f"Added: {len(remaining_lines)} lines")
+def read_non_blank_lines(file):
+    with open(file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.endswith('\n'):
+                line = line[:-1]
+            if line.strip() != '':
+                yield line
+
+
+# Single pass version of extract_non_text for all the non_text_labels (e.g. 'Table', 'Formula', 'Example',
+# 'Definition') at once. Yields the lines that are not part of a block and adds each block to
+# non_text[label][block_name]. A block marker for another label inside a block is treated as part of the block.
+def extract_non_text_blocks(lines, non_text_labels, non_text, hard_stop = 100):
+    block_identifiers = [(label, '#' + label) for label in non_text_labels]
+    current_label = None
+    current_identifier = None
+    current_block = None
+    line_counter = 0
+
+    for line in lines:
+        stripped_line = line.lstrip(' ')
+        if stripped_line.startswith('#'):
+            if current_block is not None:
+                matched = [(current_label, current_identifier)] if stripped_line.startswith(current_identifier) else []
+            else:
+                matched = [(label, identifier) for label, identifier in block_identifiers if stripped_line.startswith(identifier)][:1]
+            if matched:
+                if '- end' in line:
+                    current_label = None
+                    current_identifier = None
+                    current_block = None
+                    line_counter = 0
+                else:
+                    current_label, current_identifier = matched[0]
+                    current_block = stripped_line.strip()
+                    non_text[current_label][current_block] = []
+                continue
+
+        if current_block is not None:
+            if line_counter < hard_stop:
+                non_text[current_label][current_block].append(line)
+                line_counter += 1
+            else:
+                raise ValueError(f'Formatting issue with {current_block}: more than {hard_stop} lines before finding closing token: "{current_identifier} - end".')
+        else:
+            yield line
+
+    if current_block is not None:
+        raise ValueError(f'Formatting issue with {current_block}: reached the end of the input lines before finding closing token: "{current_identifier} - end".')
 
-    df = pd.DataFrame()
-    df = process_lines(all_data_as_lines, valid_index_checker)
-    add_full_reference(df, valid_index_checker, "23") # adds the reference to the input dataframe
-    df['word_count'] = df['Text'].str.split().str.len()
-    return df, non_text
 
 
+# Markup at the end of a line with the source document and page number e.g. (02-Regulations-part-2.pdf; pg 14)
+_document_page_pattern = re.compile(r'\(([^\(\)]*\.pdf); pg (\d+)\)\s*$')
+# Markup anywhere in a line to indicate that the line is a heading
+_heading_pattern = re.compile(r'\(#Heading\)')
 
 def process_lines(lines, valid_index_checker):
     data = {
@@ -47,39 +118,35 @@ def process_lines(lines, valid_index_checker):
         "Page": [],
         "Heading": []
     }
+    for row in iterate_parsed_lines(lines, valid_index_checker):
+        for column, value in zip(data, row):
+            data[column].append(value)
+
+    df = pd.DataFrame(data)
+    return df
 
+
+# Yields (indent, reference, text, document, page, heading) for each non-blank line
+def iterate_parsed_lines(lines, valid_index_checker):
     for line_of_text in lines:
         if line_of_text.strip() != '':  # Skip blank lines
             # Find and remove any special markup characters from the line of text
-            pattern = r'\(([^\(\)]*\.pdf); pg (\d+)\)\s*$'
-            # Use search to find matches
-            document_page = re.search(pattern, line_of_text)
+            document_page = _document_page_pattern.search(line_of_text)
             if document_page:
-                data['Document'].append(document_page.group(1).strip())
-                data['Page'].append(document_page.group(2).strip())
+                document = document_page.group(1).strip()
+                page = document_page.group(2).strip()
                 line_of_text = line_of_text[:document_page.start()] + line_of_text[document_page.end():]
             else:
-                data['Document'].append('')
-                data['Page'].append('')
+                document = ''
+                page = ''
 
-            pattern = '\(#Heading\)'
-            # Use search to find matches
-            document_page = re.search(pattern, line_of_text)
-            if document_page:
-                data['Heading'].append(True)
-                line_of_text = line_of_text[:document_page.start()] + line_of_text[document_page.end():]
-            else:
-                data['Heading'].append(False)
+            heading = _heading_pattern.search(line_of_text)
+            if heading:
+                line_of_text = line_of_text[:heading.start()] + line_of_text[heading.end():]
 
             #Now strip out the index part
             indent, reference, remaining_text = valid_index_checker.parse_line_of_text(line_of_text)
-
-            data['Indent'].append(indent)
-            data['Reference'].append(reference.strip())
-            data['Text'].append(remaining_text.strip())
-
-    df = pd.DataFrame(data)
-    return df
+            yield indent, reference.strip(), remaining_text.strip(), document, page, heading is not None
 
 
 # TODO: Remove the page reference from the 'block_identifier' because this is messing up the dictionary keys
@@ -140,103 +207,171 @@ def add_full_reference(df, valid_index_checker, prefix = ''):
        - Calculate the root reference which is the 'full_reference' from the last row with 'Indent' equal to
          this row's 'Indent' - 1.
        - 'full_reference' is a concatenation of the root reference and the stub reference.
-    """
-    df['full_reference'] = ''
 
-    for i in range(df.shape[0]):
-        if df.loc[i, 'Indent'] == 0:
-            if pd.notna(df.loc[i, 'Reference']) and df.loc[i, 'Reference'].strip() != '':
-                #df.loc[i, 'full_reference'] = '(' + df.loc[i, 'Reference'].strip() + ')'
-                df.loc[i, 'full_reference'] = prefix + df.loc[i, 'Reference'].strip()
+    This is done in a single pass over the rows by keeping, for each indent, the last non-blank 'Reference' and the
+    last 'full_reference' seen so far.
+    """
+    indents = df['Indent'].to_numpy()
+    references = df['Reference'].to_numpy()
+    texts = df['Text'].to_numpy()
+    last_reference = {}       # indent: last non-blank 'Reference' with that indent
+    last_full_reference = {}  # indent: last 'full_reference' with that indent
+    full_references = []
+
+    for i in range(len(indents)):
+        indent = indents[i]
+        reference = references[i]
+        # NaN's are not blank when looking back for the last reference at this indent
+        if pd.isna(reference) or reference.strip() != '':
+            last_reference[indent] = reference
+        has_reference = pd.notna(reference) and reference.strip() != ''
+
+        if indent == 0:
+            if has_reference:
+                full_reference = prefix + reference.strip()
             else:
-                ref = df.loc[:i, :].loc[(df['Indent'] == 0) & (df['Reference'].str.strip() != ''), 'Reference'].values
-                df.loc[i, 'full_reference'] = prefix + ref[-1] if ref.size > 0 else ''
+                full_reference = prefix + last_reference[0] if 0 in last_reference else ''
         else:
-            if pd.notna(df.loc[i, 'Reference']) and df.loc[i, 'Reference'].strip() != '':
-                stub = df.loc[i, 'Reference']
+            if has_reference:
+                stub = reference
             else:
-                ref = df.loc[:i, :].loc[(df['Indent'] == df.loc[i, 'Indent']) & (df['Reference'].str.strip() != ''), 'Reference'].values
-                stub = ref[-1] if ref.size > 0 else ''
+                stub = last_reference.get(indent, '')
+            root = last_full_reference.get(indent - 1, '')
 
-            root_ref = df.loc[:i, :].loc[df['Indent'] == df.loc[i, 'Indent'] - 1, 'full_reference'].values
-            root = root_ref[-1] if root_ref.size > 0 else ''
-            
             full_reference = root + stub
             if not valid_index_checker.is_valid_reference(full_reference):
-                raise ValueError(f'Unable to construct a valid full reference for line: {df.loc[i, "Text"]}')
+                raise ValueError(f'Unable to construct a valid full reference for line: {texts[i]}')
+
+        last_full_reference[indent] = full_reference
+        full_references.append(full_reference)
 
-            df.loc[i, 'full_reference'] = full_reference
+    df['full_reference'] = full_references
 
 
 # Note: This method will not work correctly if empty values in the dataframe are NaN as is the case when loading
 #       a dataframe form a file without the 'na_filter=False' option. You should ensure that the dataframe does 
 #       not have any NaN value for the text fields. Try running df.isna().any().any() as a test before you get here
+#
+# If you need the detail for more than one node from the same DataFrame, create a RegulationIndex once and call its
+# get_regulation_detail method rather than calling this function for each node.
 def get_regulation_detail(node_str, df, valid_index_tracker):
-    text = ''
-    terminal_text_df = df[df['full_reference'].str.startswith(node_str)]
-    if len(terminal_text_df) == 0:
-        return f"No section could be found with the reference {node_str}"
-    terminal_text_index = terminal_text_df.index[0]
-    terminal_text_indent = 0 # terminal_text_df.iloc[0]['Indent']
-    for index, row in terminal_text_df.iterrows():
-        number_of_spaces = (row['Indent'] - terminal_text_indent) * 4
-        #set the string "line" to start with the number of spaces
-        line = " " * number_of_spaces
-        if pd.isna(row['Reference']) or row['Reference'] == '':
-            line = line + row['Text']
-        else:
-            if pd.isna(row['Text']):
-                line = line + row['Reference']
-            else:     
-                line = line + row['Reference'] + " " + row['Text']
-        if text != "":
-            text = text + "\n"
-        text = text + line
-
-    if node_str != '': #i.e. there is a parent
-        parent_reference = valid_index_tracker.get_parent_reference(node_str)
-        all_conditions = ""
-        all_qualifiers = ""
-        while parent_reference != "":
-            parent_text_df = df[df['full_reference'] == parent_reference]
-            conditions = ""
-            qualifiers = ""
-            for index, row in parent_text_df.iterrows():
-                if index < terminal_text_index:
-                    number_of_spaces = (row['Indent'] - terminal_text_indent) * 4
-                    if conditions != "":
-                        conditions = conditions + "\n"
-                    conditions = conditions + " " * number_of_spaces
-                    if (row['Reference'] == ''):
-                        conditions = conditions + row['Text']
-                    else:
-                        conditions = conditions + row['Reference'] + " " +  row['Text']
-                else:
-                    number_of_spaces = (row['Indent'] - terminal_text_indent) * 4
-                    if (qualifiers != ""):
-                        qualifiers = qualifiers + "\n"
-                    qualifiers = qualifiers + " " * number_of_spaces
-                    if (row['Reference'] == ''):
-                        qualifiers = qualifiers + row['Text']
-                    else:
-                        qualifiers = qualifiers + row['Reference'] + " " + row['Text']
-
-            if conditions != "":
-                all_conditions = conditions + "\n" + all_conditions
-            if qualifiers != "":
-                all_qualifiers = all_qualifiers + "\n" + qualifiers
-            parent_reference = valid_index_tracker.get_parent_reference(parent_reference)
-
-        if all_conditions != "":
-            text = all_conditions +  text
-        if all_qualifiers != "":
-            text = text + all_qualifiers
-
-    return text
-
-
-def read_processed_regs_into_dataframe(file_list, valid_index_checker, non_text_labels, print_summary = False):
-    df, non_text = process_regulations(file_list, valid_index_checker, non_text_labels)
+    return RegulationIndex(df, valid_index_tracker).get_regulation_detail(node_str)
+
+
+class RegulationIndex():
+    """
+    Precomputed lookups on a regulation DataFrame (with a 'full_reference' column) for get_regulation_detail:
+    - the distinct full references in sorted order so all the references that start with a prefix are a contiguous
+      range that can be found with bisect
+    - a map from each full reference to the positions of its rows
+
+    The DataFrame must not be modified after the index is created. If the map from reference to row positions has
+    already been computed (e.g. it was saved in a corpus snapshot) it can be passed in as rows_for_reference.
+    """
+    def __init__(self, df, valid_index_checker, rows_for_reference = None):
+        self.valid_index_checker = valid_index_checker
+        self.index_labels = df.index.to_numpy()
+        self.indents = df['Indent'].to_numpy()
+        self.references = df['Reference'].to_numpy()
+        self.texts = df['Text'].to_numpy()
+        if rows_for_reference is None:
+            rows_for_reference = {}
+            for position, full_reference in enumerate(df['full_reference'].to_numpy()):
+                rows_for_reference.setdefault(full_reference, []).append(position)
+        self.rows_for_reference = rows_for_reference
+        self.sorted_references = sorted(self.rows_for_reference)
+        self._row_token_counts = None
+
+    # Positions (in DataFrame order) of all the rows in the subtree of node_str, i.e. whose full reference is node_str
+    # or starts with all of its components. When the components have no closing delimiter a reference can start with
+    # the same characters without being in the subtree ('1.10' is not part of '1.1') so those references are split and
+    # compared component by component. With a closing delimiter (e.g. '23(1)' and '23(10)') the prefix is enough
+    def get_rows_with_prefix(self, node_str):
+        start = bisect.bisect_left(self.sorted_references, node_str)
+        end = start
+        while end < len(self.sorted_references) and self.sorted_references[end].startswith(node_str):
+            end += 1
+        references = self.sorted_references[start:end]
+        if node_str != '' and node_str[-1].isalnum() and len(references) > 1:
+            number_of_components = len(self.valid_index_checker.split_reference(node_str))
+            references = [reference for reference in references
+                          if reference == node_str or ''.join(self.valid_index_checker.split_reference(reference)[:number_of_components]) == node_str]
+        if len(references) == 1:
+            return self.rows_for_reference[references[0]]
+        return sorted(position for reference in references for position in self.rows_for_reference[reference])
+
+    # A row is always rendered the same way, irrespective of the node being rendered, because the indent is measured
+    # from indent 0
+    def render_row(self, position):
+        reference = self.references[position]
+        text = self.texts[position]
+        line = " " * (self.indents[position] * 4)
+        if pd.isna(reference) or reference == '':
+            return line + text
+        elif pd.isna(text):
+            return line + reference
+        return line + reference + " " + text
+
+    # The number of tokens in each rendered row. Each row is only tokenized once, the first time this is called
+    def get_row_token_counts(self):
+        if self._row_token_counts is None:
+            self._row_token_counts = num_tokens_from_strings([self.render_row(position) for position in range(len(self.indents))])
+        return self._row_token_counts
+
+    def get_regulation_detail(self, node_str):
+        with stage('render'):
+            return self._get_regulation_detail(node_str)
+
+    def _get_regulation_detail(self, node_str):
+        positions = self.get_detail_rows([node_str])
+        if len(positions) == 0:
+            return f"No section could be found with the reference {node_str}"
+        return "\n".join([self.render_row(position) for position in positions])
+
+    # The positions of the rows that are rendered for the sections, in the order they are rendered: the rows of each
+    # section's subtree in document order, wrapped in the rows of its ancestors. An ancestor's rows before the first row
+    # of the sections below it (the conditions) come before them and the rest (the qualifiers) after them, so the
+    # conditions are printed from the root inwards and the qualifiers from the closest parent outwards. Where an ancestor
+    # has more than one of the sections below it, its rows and the sections below it are in document order. A section
+    # inside another section's subtree is part of that section
+    def get_detail_rows(self, sections):
+        subtree_rows = {}
+        for section in sections:
+            rows = self.get_rows_with_prefix(section)
+            if len(rows) > 0:
+                subtree_rows[section] = rows
+        split_sections = {section: self.valid_index_checker.split_reference(section) for section in subtree_rows}
+        outer_sections = {section for section, components in split_sections.items()
+                          if not any(len(other) < len(components) and components[:len(other)] == other for other in split_sections.values())}
+        if not outer_sections:
+            return []
+
+        # the ancestors of the sections, each with the sections (or ancestors) directly below it and the position of the
+        # first section row below it
+        children = {}
+        first_rows = {}
+        for section in outer_sections:
+            first_row = subtree_rows[section][0]
+            first_rows[section] = first_row
+            reference = section
+            while reference != '':
+                parent_reference = self.valid_index_checker.get_parent_reference(reference)
+                children.setdefault(parent_reference, set()).add(reference)
+                first_rows[parent_reference] = min(first_rows.get(parent_reference, first_row), first_row)
+                reference = parent_reference
+
+        def ordered_rows(reference):
+            if reference in outer_sections:
+                return list(subtree_rows[reference])
+            blocks = [(position, [position]) for position in self.rows_for_reference.get(reference, [])] if reference != '' else []
+            blocks += [(first_rows[child], ordered_rows(child)) for child in children.get(reference, ())]
+            return [position for _, rows in sorted(blocks, key=lambda block: block[0]) for position in rows]
+
+        return ordered_rows('')
+
+
+def read_processed_regs_into_dataframe(file_list, valid_index_checker, non_text_labels, print_summary = False, max_workers = None, reference_prefix = '23'):
+    df, non_text = process_regulations(file_list, valid_index_checker, non_text_labels, max_workers=max_workers, reference_prefix=reference_prefix)
     #TODO: Remove the page numbers from the non-text keys
     if print_summary:
         print("total lines in dataframe: ", len(df))
@@ -0,0 +1,154 @@
+import difflib
+import json
+import os
+import tempfile
+import pandas as pd
+
+from src.file_tools import read_processed_regs_into_dataframe, RegulationIndex
+from src.embeddings import num_tokens_from_string
+from src.tree_tools import Tree, split_tree
+
+####
+# Incremental rebuild after the regulation source files change.
+#
+# Every chunk in the sectioned DataFrame (the output of split_tree) depends on the rows that get_regulation_detail
+# renders for it: the rows in its subtree and the rows of its ancestors. The summaries, questions and embeddings for
+# a chunk depend only on that text. So after re-parsing the (changed) sources:
+#   - parsing and building the tree are re-run in full (they are linear and take milliseconds)
+#   - each previous chunk is re-rendered and compared with its previous text. Unchanged chunks keep their section
+#     boundaries. Changed chunks are kept if they are still under the token limit and are re-split otherwise
+#   - rows that are not covered by any previous chunk (new sections) are split into new chunks
+#   - only the summaries, questions and embeddings for the changed, added and removed chunks need to be regenerated
+#
+# The change report has one row per chunk with its status ('unchanged', 'changed', 'added' or 'removed'), the lines of
+# regulation text that were added ('+ ...') or removed ('- ...') for that chunk and the 'row_positions' of the rows in
+# the new regulation DataFrame that the chunk is rendered from (see get_row_positions). These are positions in the
+# DataFrame (use df.iloc), not line numbers in the source files. The 'Document' and 'Page' columns of those rows give
+# their place in the source documents.
+#
+# reference_prefix is passed to read_processed_regs_into_dataframe and must be the one the previous chunks were built with.
+###
+def incremental_rebuild(previous_sectioned_df, file_list, valid_index_checker, non_text_labels, root_node_name, token_limit, reference_prefix = '23'):
+    df, non_text = read_processed_regs_into_dataframe(file_list=file_list, valid_index_checker=valid_index_checker, non_text_labels=non_text_labels,
+                                                      reference_prefix=reference_prefix)
+    tree = Tree.from_frame(root_node_name, df, valid_index_checker)
+    sectioned_df, change_report = update_sections(previous_sectioned_df, df, tree, valid_index_checker, token_limit)
+    return df, non_text, tree, sectioned_df, change_report
+
+
+def update_sections(previous_sectioned_df, df, tree, valid_index_checker, token_limit, regulation_index = None):
+    if regulation_index is None:
+        regulation_index = RegulationIndex(df, valid_index_checker)
+    report = []
+    chunks = {} # section: (text, token_count)
+
+    for section, previous_text, previous_token_count in zip(previous_sectioned_df['section'], previous_sectioned_df['text'], previous_sectioned_df['token_count']):
+        if _get_node(tree, section) is None:
+            report.append([section, 'removed', 0, _changed_lines(previous_text, ''), []])
+            continue
+        text = regulation_index.get_regulation_detail(section)
+        if text == previous_text:
+            chunks[section] = (text, previous_token_count)
+            report.append([section, 'unchanged', previous_token_count, [], get_row_positions(section, regulation_index)])
+            continue
+        token_count = num_tokens_from_string(text)
+        # Some chunks are deliberately larger than the default limit (see 10_create_summary_and_questions.ipynb) so a
+        # chunk is only re-split if it is larger than both the limit and its previous size
+        if token_count <= max(token_limit, previous_token_count):
+            chunks[section] = (text, token_count)
+            report.append([section, 'changed', token_count, _changed_lines(previous_text, text), get_row_positions(section, regulation_index)])
+        else:
+            split_df = split_tree(_get_node(tree, section), df, token_limit, valid_index_checker, regulation_index)
+            if section not in set(split_df['section']):
+                report.append([section, 'removed', 0, _changed_lines(previous_text, ''), []])
+            for new_section, new_text, new_token_count in zip(split_df['section'], split_df['text'], split_df['token_count']):
+                chunks[new_section] = (new_text, new_token_count)
+                status = 'changed' if new_section == section else 'added'
+                report.append([new_section, status, new_token_count, _changed_lines(previous_text if new_section == section else '', new_text), get_row_positions(new_section, regulation_index)])
+
+    # New sections that are not covered by any of the previous chunks
+    chunk_ancestors = {ancestor.full_node_name for section in chunks for ancestor in _get_node(tree, section).ancestors}
+    for node in _get_uncovered_nodes(tree.root, set(chunks), chunk_ancestors, regulation_index):
+        split_df = split_tree(node, df, token_limit, valid_index_checker, regulation_index)
+        for new_section, new_text, new_token_count in zip(split_df['section'], split_df['text'], split_df['token_count']):
+            chunks[new_section] = (new_text, new_token_count)
+            report.append([new_section, 'added', new_token_count, _changed_lines('', new_text), get_row_positions(new_section, regulation_index)])
+
+    # Keep the chunks in the same order as the regulation text
+    sections = sorted(chunks, key=lambda section: regulation_index.get_rows_with_prefix(section)[0])
+    sectioned_df = pd.DataFrame([[section, chunks[section][0], chunks[section][1]] for section in sections], columns=['section', 'text', 'token_count'])
+    change_report = pd.DataFrame(report, columns=['section', 'status', 'token_count', 'changed_lines', 'row_positions'])
+    return sectioned_df, change_report
+
+
+# The positions in the regulation DataFrame of the rows that get_regulation_detail renders for a section (the rows in
+# its subtree and the rows of its ancestors), in document order
+def get_row_positions(section, regulation_index):
+    return sorted(regulation_index.get_detail_rows([section]))
+
+
+# The node for a section or None if it is not in the tree. When the whole regulation fits in one chunk the section is
+# the root, which has the name '' and is not in tree.nodes
+def _get_node(tree, section):
+    if section == '':
+        return tree.root
+    return tree.nodes.get(section)
+
+
+# Nodes whose subtree does not overlap any chunk. The rows of the ancestors of a chunk are part of the chunk's text
+def _get_uncovered_nodes(node, chunk_sections, chunk_ancestors, regulation_index):
+    if node.full_node_name in chunk_sections:
+        return []
+    if node.full_node_name not in chunk_ancestors:
+        return [node] if regulation_index.get_rows_with_prefix(node.full_node_name) else []
+    uncovered = []
+    for child in node.children:
+        uncovered.extend(_get_uncovered_nodes(child, chunk_sections, chunk_ancestors, regulation_index))
+    return uncovered
+
+
+def _changed_lines(previous_text, text):
+    previous_lines = previous_text.split('\n') if previous_text else []
+    lines = text.split('\n') if text else []
+    return [line for line in difflib.ndiff(previous_lines, lines) if line.startswith('+ ') or line.startswith('- ')]
+
+
+# The sections whose summaries, questions and embeddings need to be regenerated (or removed)
+def get_stale_sections(change_report):
+    return set(change_report.loc[change_report['status'] != 'unchanged', 'section'])
+
+
+# Removes the rows for stale sections from a DataFrame with a 'section' column (e.g. the summary, questions or
+# embedding index DataFrames) so only those sections need to be regenerated
+def drop_stale_rows(df_with_sections, change_report):
+    stale_sections = get_stale_sections(change_report)
+    return df_with_sections[~df_with_sections['section'].isin(stale_sections)].reset_index(drop=True)
+
+
+# Removes the stale sections from a generate_summaries_and_questions checkpoint file so that the next run regenerates
+# only those sections
+def invalidate_checkpoint(checkpoint_file, change_report):
+    if not os.path.exists(checkpoint_file):
+        return
+    stale_sections = get_stale_sections(change_report)
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    kept_lines = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if entry['section'] not in stale_sections:
+            kept_lines.append(json.dumps(entry) + '\n')
+    # a unique temporary file in the same directory, as for compile_corpus_snapshot
+    file_descriptor, temporary_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(checkpoint_file)),
+                                                       prefix=os.path.basename(checkpoint_file) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as f:
+            f.writelines(kept_lines)
+        os.replace(temporary_file, checkpoint_file)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
@@ -0,0 +1,241 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+####
+# Lightweight instrumentation for the pipeline and the chat workers. The code is instrumented with
+#
+#     with stage('embed', model=model) as s:
+#         response = client.embeddings.create(...)
+#         s.add_usage(response)    # prompt and completion tokens from the response
+#         s.add('texts', len(texts))
+#
+# around the stages in STAGES. When a stage ends, an event with its name, duration, counters and attributes is passed
+# to every attached sink. With no sink attached, stage() returns a shared object that does nothing so the overhead is
+# a function call and a list check and the instrumentation can stay in production code.
+#
+# Sinks:
+#   - Recorder aggregates the events into a per-run report and per-request reports (the request is set with
+#     request_context, which also works across asyncio tasks) and exports them as json lines
+#   - JsonLinesSink writes every event to a json lines file as it happens
+# For example:
+#     with recording() as recorder:
+#         with request_context('question-1'):
+#             ... answer a question ...
+#     recorder.export_json_lines('telemetry.jsonl')
+###
+STAGES = ('parse', 'full_reference', 'tree', 'split', 'render', 'tokenize', 'embed', 'retrieve', 'complete')
+
+_sinks = []
+_sinks_lock = threading.Lock()
+_current_request = contextvars.ContextVar('reg23_request_id', default=None)
+
+
+class _NullStage():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, counter, value = 1):
+        pass
+
+    def add_usage(self, response):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage():
+    __slots__ = ('name', 'attributes', 'counters', 'start')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.counters = {}
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event = {
+            'stage': self.name,
+            'seconds': time.perf_counter() - self.start,
+            'request_id': _current_request.get(),
+            'timestamp': time.time(),
+            'error': exc_type.__name__ if exc_type is not None else None,
+            'counters': self.counters,
+            'attributes': self.attributes,
+        }
+        for sink in list(_sinks):
+            sink.record(event)
+        return False
+
+    def add(self, counter, value = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    # Adds the prompt and completion tokens from an OpenAI response (if it reports its usage)
+    def add_usage(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return
+        self.add('prompt_tokens', getattr(usage, 'prompt_tokens', 0) or 0)
+        self.add('completion_tokens', getattr(usage, 'completion_tokens', 0) or 0)
+
+
+def stage(name, **attributes):
+    if not _sinks:
+        return _NULL_STAGE
+    return _Stage(name, attributes)
+
+
+def attach_sink(sink):
+    with _sinks_lock:
+        if sink not in _sinks:
+            _sinks.append(sink)
+    return sink
+
+
+def detach_sink(sink):
+    with _sinks_lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+
+# Events from stages inside the context are tagged with the request_id. Returns the request_id (a new uuid if None)
+@contextmanager
+def request_context(request_id = None):
+    if request_id is None:
+        request_id = uuid.uuid4().hex
+    token = _current_request.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _current_request.reset(token)
+
+
+# Attaches a new Recorder for the duration of the context
+@contextmanager
+def recording(prices = None):
+    recorder = attach_sink(Recorder(prices))
+    try:
+        yield recorder
+    finally:
+        detach_sink(recorder)
+
+
+####
+# Aggregates stage events. For each stage the report has the number of calls, errors, total, minimum and maximum
+# seconds and the sum of each counter. prices is an optional dictionary of model: (prompt, completion) price per 1000
+# tokens, used to add the cost of the tokens recorded with add_usage to the reports.
+###
+class Recorder():
+    def __init__(self, prices = None):
+        self.prices = prices if prices is not None else {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._run = _Aggregate()
+            self._requests = {}
+
+    def record(self, event):
+        with self._lock:
+            self._run.add(event)
+            request_id = event['request_id']
+            if request_id is not None:
+                if request_id not in self._requests:
+                    self._requests[request_id] = _Aggregate()
+                self._requests[request_id].add(event)
+
+    def run_report(self):
+        with self._lock:
+            return self._run.report(self.prices)
+
+    def request_report(self, request_id):
+        with self._lock:
+            return self._requests[request_id].report(self.prices)
+
+    def request_ids(self):
+        with self._lock:
+            return list(self._requests)
+
+    # One line for the run followed by one line for each request
+    def export_json_lines(self, path, append = True):
+        with self._lock:
+            lines = [dict(type='run', **self._run.report(self.prices))]
+            lines.extend(dict(type='request', request_id=request_id, **aggregate.report(self.prices)) for request_id, aggregate in self._requests.items())
+        with open(path, 'a' if append else 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(json.dumps(line) + '\n')
+
+
+class _Aggregate():
+    def __init__(self):
+        self.stages = {}
+        self.tokens_by_model = {}
+
+    def add(self, event):
+        statistics = self.stages.get(event['stage'])
+        if statistics is None:
+            statistics = {'calls': 0, 'errors': 0, 'total_seconds': 0.0, 'min_seconds': None, 'max_seconds': 0.0, 'counters': {}}
+            self.stages[event['stage']] = statistics
+        seconds = event['seconds']
+        statistics['calls'] += 1
+        statistics['errors'] += event['error'] is not None
+        statistics['total_seconds'] += seconds
+        statistics['min_seconds'] = seconds if statistics['min_seconds'] is None else min(statistics['min_seconds'], seconds)
+        statistics['max_seconds'] = max(statistics['max_seconds'], seconds)
+        for counter, value in event['counters'].items():
+            statistics['counters'][counter] = statistics['counters'].get(counter, 0) + value
+        if 'prompt_tokens' in event['counters'] or 'completion_tokens' in event['counters']:
+            model = event['attributes'].get('model')
+            prompt_tokens, completion_tokens = self.tokens_by_model.get(model, (0, 0))
+            self.tokens_by_model[model] = (prompt_tokens + event['counters'].get('prompt_tokens', 0),
+                                           completion_tokens + event['counters'].get('completion_tokens', 0))
+
+    def report(self, prices):
+        cost = 0.0
+        tokens = []
+        for model, (prompt_tokens, completion_tokens) in self.tokens_by_model.items():
+            model_cost = None
+            if model in prices:
+                prompt_price, completion_price = prices[model]
+                model_cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+                cost += model_cost
+            tokens.append({'model': model, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'cost': model_cost})
+        return {
+            'stages': {name: dict(statistics, counters=dict(statistics['counters'])) for name, statistics in self.stages.items()},
+            'tokens': tokens,
+            'prompt_tokens': sum(token['prompt_tokens'] for token in tokens),
+            'completion_tokens': sum(token['completion_tokens'] for token in tokens),
+            'cost': cost,
+        }
+
+
+# Writes every event to a json lines file as it happens
+class JsonLinesSink():
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, event):
+        line = json.dumps(dict(type='stage', **event), default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
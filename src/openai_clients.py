@@ -0,0 +1,64 @@
+import os
+import threading
+
+from openai import OpenAI, AsyncOpenAI
+
+####
+# The OpenAI clients used by the rest of the package. Nothing else should create an OpenAI() or AsyncOpenAI() so the
+# clients can be swapped in one place, e.g. for the offline stand-in in src/fake_openai.py:
+#
+#     set_clients(FakeOpenAI(), FakeAsyncOpenAI())   or   use_fake_clients(latency = lognormal_latency(0.5, 0.3))
+#
+# If the environment variable REG23_OPENAI_CLIENT is 'fake', the fake clients are used by default so a notebook or
+# script can be run offline without changing any code.
+#
+# The real clients are only created when they are first used so the package can be imported without an API key.
+###
+OPENAI_CLIENT_ENVIRONMENT_VARIABLE = 'REG23_OPENAI_CLIENT'
+
+_client = None
+_async_client = None
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _clients_lock:
+            if _client is None:
+                _client = _create_default_client(asynchronous=False)
+    return _client
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        with _clients_lock:
+            if _async_client is None:
+                _async_client = _create_default_client(asynchronous=True)
+    return _async_client
+
+
+# Replaces the clients returned by get_client and get_async_client. Passing None resets a client to the default
+def set_clients(client = None, async_client = None):
+    global _client, _async_client
+    with _clients_lock:
+        _client = client
+        _async_client = async_client
+
+
+# Uses the offline stand-in for both clients. The keyword arguments are passed to FakeOpenAI and FakeAsyncOpenAI,
+# which are returned
+def use_fake_clients(**kwargs):
+    from src.fake_openai import FakeOpenAI, FakeAsyncOpenAI
+    client = FakeOpenAI(**kwargs)
+    async_client = FakeAsyncOpenAI(**kwargs)
+    set_clients(client, async_client)
+    return client, async_client
+
+
+def _create_default_client(asynchronous):
+    if os.environ.get(OPENAI_CLIENT_ENVIRONMENT_VARIABLE, '').lower() == 'fake':
+        from src.fake_openai import FakeOpenAI, FakeAsyncOpenAI
+        return FakeAsyncOpenAI() if asynchronous else FakeOpenAI()
+    return AsyncOpenAI() if asynchronous else OpenAI()
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+from src.embedding_cache import normalise_text
+from src.embeddings import get_ada_embedding
+
+####
+# Two level cache in front of the question embedding and the similarity search for the chatbot:
+#   - exact tier: the normalised question text (see query_key) -> its embedding and the retrieved sections
+#   - semantic tier: if a new question's embedding is within semantic_distance (cosine distance) of a cached
+#     question's embedding, the cached question's retrieved sections are reused
+# The embedding still has to be fetched for a semantic hit but the search is skipped. An exact hit skips both.
+#
+# Retrieved sections are only valid for the index build they came from. Each entry records the version of the index
+# (EmbeddingIndex.version) and the search parameters, and all the retrieved sections are dropped as soon as a search
+# against a different index version is made. The question embeddings do not depend on the index and are kept.
+#
+# Entries expire ttl_seconds after they were added and, when there are more than max_entries, the least recently used
+# entries are evicted first.
+###
+class QueryCache():
+    def __init__(self, max_entries = 1000, ttl_seconds = 3600, semantic_distance = 0.05):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.semantic_distance = semantic_distance
+        self._embeddings = OrderedDict() # key: (embedding, created)
+        self._results = OrderedDict()    # (key, search parameters): (normalised embedding, results, created)
+        self._index_version = None
+        self._semantic_matrix = None     # the normalised embeddings of the entries in _results, in the same order
+        self._semantic_keys = None
+        self._lock = threading.Lock()
+        self.statistics = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'embedding_hits': 0, 'invalidations': 0}
+
+    # Searches the index for the question, using the cache where possible. get_embedding is called with the question
+    # text when its embedding is not cached. Returns a copy of the cached (or new) search results.
+    def search(self, question, index, threshold = 0.15, top_k = None, get_embedding = get_ada_embedding):
+        key = query_key(question)
+        parameters = (threshold, top_k)
+        self.check_index_version(index.version)
+
+        results = self.get_results(key, parameters)
+        if results is not None:
+            return results
+
+        embedding = self.get_embedding(key)
+        if embedding is None:
+            embedding = np.asarray(get_embedding(question), dtype=np.float32)
+            self.put_embedding(key, embedding)
+
+        results = self.get_similar_results(embedding, parameters)
+        if results is None:
+            results = index.search(embedding, threshold=threshold, top_k=top_k)
+        self.put_results(key, parameters, embedding, results)
+        return results.copy()
+
+    # Drops all the cached search results if the index has changed since they were cached
+    def check_index_version(self, index_version):
+        with self._lock:
+            if index_version != self._index_version:
+                if self._results:
+                    self.statistics['invalidations'] += 1
+                self._results.clear()
+                self._semantic_matrix = None
+                self._index_version = index_version
+
+    def invalidate(self):
+        with self._lock:
+            self._results.clear()
+            self._semantic_matrix = None
+            self.statistics['invalidations'] += 1
+
+    def get_embedding(self, key):
+        with self._lock:
+            entry = self._get_entry(self._embeddings, key)
+            if entry is None:
+                return None
+            self.statistics['embedding_hits'] += 1
+            return entry[0]
+
+    def put_embedding(self, key, embedding):
+        with self._lock:
+            self._embeddings[key] = (embedding, time.monotonic())
+            self._embeddings.move_to_end(key)
+            self._evict(self._embeddings)
+
+    # The exact tier
+    def get_results(self, key, parameters):
+        with self._lock:
+            entry = self._get_entry(self._results, (key, parameters))
+            if entry is None:
+                return None
+            self.statistics['exact_hits'] += 1
+            return entry[1].copy()
+
+    # The semantic tier. Returns the results of the closest cached question (searched with the same parameters) if it
+    # is within semantic_distance of the embedding
+    def get_similar_results(self, embedding, parameters):
+        with self._lock:
+            self._expire(self._results)
+            if self._results and self.semantic_distance > 0:
+                if self._semantic_matrix is None:
+                    self._semantic_keys = list(self._results)
+                    self._semantic_matrix = np.vstack([self._results[key][0] for key in self._semantic_keys])
+                norm = np.linalg.norm(embedding)
+                if norm > 0:
+                    distances = 1.0 - self._semantic_matrix @ (embedding / norm)
+                    for position in np.argsort(distances):
+                        if distances[position] > self.semantic_distance:
+                            break
+                        key = self._semantic_keys[position]
+                        if key[1] == parameters:
+                            self._results.move_to_end(key)
+                            self.statistics['semantic_hits'] += 1
+                            return self._results[key][1].copy()
+            self.statistics['misses'] += 1
+            return None
+
+    def put_results(self, key, parameters, embedding, results):
+        norm = np.linalg.norm(embedding)
+        normalised_embedding = np.asarray(embedding / norm if norm > 0 else embedding, dtype=np.float32)
+        with self._lock:
+            self._results[(key, parameters)] = (normalised_embedding, results.copy(), time.monotonic())
+            self._results.move_to_end((key, parameters))
+            self._evict(self._results)
+            self._semantic_matrix = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    # Returns the entry (without the time it was created) and marks it as recently used, or None if it is missing or
+    # has expired. Must be called with the lock held
+    def _get_entry(self, entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl_seconds is not None and time.monotonic() - entry[-1] > self.ttl_seconds:
+            del entries[key]
+            if entries is self._results:
+                self._semantic_matrix = None
+            return None
+        entries.move_to_end(key)
+        return entry[:-1]
+
+    def _expire(self, entries):
+        if self.ttl_seconds is None:
+            return
+        now = time.monotonic()
+        expired = [key for key, entry in entries.items() if now - entry[-1] > self.ttl_seconds]
+        for key in expired:
+            del entries[key]
+        if expired and entries is self._results:
+            self._semantic_matrix = None
+
+    def _evict(self, entries):
+        while self.max_entries is not None and len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+
+# Questions that only differ in case, unicode representation or whitespace are the same question
+def query_key(question):
+    return normalise_text(question).casefold()
@@ -0,0 +1,73 @@
+import pandas as pd
+
+from src.instrumentation import stage
+
+####
+# Routing in front of retrieval for questions that cite sections, e.g. "what does 23(5)(b)(i) say" or an answer from
+# the LLM that is pasted back with its references. The references written out in the question (see
+# ValidIndex.extract_valid_references) that are nodes of the tree are answered directly with their text from
+# RegulationIndex.get_regulation_detail, so there is no question embedding and no similarity search. Questions without
+# a reference in the tree return None from route and are passed on to the usual retrieval (QueryCache.search,
+# hybrid_search, ...). For example:
+#     router = ReferenceRouter(tree, regulation_index)
+#     results, route = router.search(question, lambda question: hybrid_search(question, bm25_index, embedding_index)[0])
+#
+# References with fewer than min_components components are ignored because they name the whole document (e.g.
+# "Regulation 23") rather than a section. A cited section inside another cited section is dropped because its text is
+# already part of the text of the outer section.
+###
+class ReferenceRouter():
+    def __init__(self, tree, regulation_index, min_components = 2):
+        self.tree = tree
+        self.regulation_index = regulation_index
+        self.valid_index_checker = tree.valid_index_checker
+        self.min_components = min_components
+
+    # Returns (found, missing): the references cited in the question that are nodes in the tree and the ones that
+    # are not (e.g. a typo or a section from a different version of the regulation)
+    def find_references(self, question):
+        found = []
+        missing = []
+        for reference in get_section_references(self.valid_index_checker.extract_valid_references(question), self.valid_index_checker, self.min_components):
+            if reference in self.tree.nodes:
+                found.append(reference)
+            else:
+                missing.append(reference)
+        found = [reference for reference in found if not any(self._is_ancestor(other, reference) for other in found)]
+        return found, missing
+
+    # The cited sections and their text, in the order they are cited. Returns None if the question does not cite a
+    # section in the tree
+    def route(self, question):
+        with stage('retrieve', index='reference') as retrieve_stage:
+            references, _ = self.find_references(question)
+            retrieve_stage.add('results', len(references))
+            if not references:
+                return None
+            return pd.DataFrame({
+                'section': references,
+                'text': [self.regulation_index.get_regulation_detail(reference) for reference in references],
+                'cosine_distance': 0.0, # the same columns as EmbeddingIndex.search. A cited section is an exact match
+            })
+
+    # Returns (results, route) where route is 'reference' if the question was answered from the sections it cites or
+    # 'retrieval' if it was passed to retrieve(question)
+    def search(self, question, retrieve):
+        results = self.route(question)
+        if results is not None:
+            return results, 'reference'
+        return retrieve(question), 'retrieval'
+
+    def _is_ancestor(self, reference, other):
+        if reference == other:
+            return False
+        components = self.valid_index_checker.split_reference(reference)
+        other_components = self.valid_index_checker.split_reference(other)
+        return len(components) < len(other_components) and other_components[:len(components)] == components
+
+
+# The references that name a section rather than the whole document, i.e. those with at least min_components
+# components or on the exclusion list
+def get_section_references(references, valid_index_checker, min_components = 2):
+    return [reference for reference in references
+            if reference in valid_index_checker.exclusion_list or len(valid_index_checker.split_reference(reference)) >= min_components]
@@ -1,6 +1,18 @@
 # Update the relevant summary row
-from openai import OpenAI
-client = OpenAI()
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+
+import openai
+import pandas as pd
+
+from src.embeddings import num_tokens_from_string
+# The clients are created in src.openai_clients so they can be replaced, e.g. by the offline fake in src.fake_openai
+from src.openai_clients import get_client, get_async_client
+from src.instrumentation import stage
 
 system_content_summerise = "You are summarising parts of Regulation 23 of the Banks Act (Reg23) for a bank that needs to complete the Credit Risk Monthly Return (Form BA 200). When summerising, do not add filler words like 'the act says ...' or 'Reg23 says ...', just summarise the section. Your summary should use plain language and avoid legalese. Since it is for a bank, when the act uses the phrase 'bank', please replace it with the relevant first person pronoun like 'I' or 'me'. A good summary will minimise the use of lists. Rather it should make use of paragraphs.\n\
 Note: Reg23 offers two approaches to modelling credit risk namely the standardised approach and the internal ratings-based (IRB) approach. The standardised approach is subdivided into the 'Simplified Standardised' and the 'Standardised' approach. The IRB approach is subdivided into the 'Foundation IRB' (FIRB) and the 'Advanced IRB' (AIRB). The act will often refer to Method 1 or Method 2 but please use the full name or acronym of the appropriate calculation methodology in your summary."
@@ -13,15 +25,17 @@ system_content_question = "You are assisting a bank to comply with regulation 23
 def get_summary_and_questions_for(text, model):
 
     user_context = text
-    response = client.chat.completions.create(
-                        model=model,
-                        temperature = 1.0,
-                        max_tokens = 500,
-                        messages=[
-                            {"role": "system", "content": system_content_summerise},
-                            {"role": "user", "content": user_context},
-                        ]
-                    )
+    with stage('complete', model=model) as complete_stage:
+        response = get_client().chat.completions.create(
+                            model=model,
+                            temperature = 1.0,
+                            max_tokens = 500,
+                            messages=[
+                                {"role": "system", "content": system_content_summerise},
+                                {"role": "user", "content": user_context},
+                            ]
+                        )
+        complete_stage.add_usage(response)
     if response.choices[0].finish_reason == "stop":
         summary = response.choices[0].message.content
     else:
@@ -32,15 +46,17 @@ def get_summary_and_questions_for(text, model):
 
     user_context_question = summary
     if summary != "":
-        response = client.chat.completions.create(
-                            model=model,
-                            temperature = 1.0,
-                            max_tokens = 500,
-                            messages=[
-                                {"role": "system", "content": system_content_question},
-                                {"role": "user", "content": user_context_question},
-                            ]
-                        )
+        with stage('complete', model=model) as complete_stage:
+            response = get_client().chat.completions.create(
+                                model=model,
+                                temperature = 1.0,
+                                max_tokens = 500,
+                                messages=[
+                                    {"role": "system", "content": system_content_question},
+                                    {"role": "user", "content": user_context_question},
+                                ]
+                            )
+            complete_stage.add_usage(response)
         if response.choices[0].finish_reason == "stop":
             questions = response.choices[0].message.content
         else:
@@ -52,3 +68,134 @@ def get_summary_and_questions_for(text, model):
 
     return summary, questions
 
+
+####
+# Batch generation of the summaries and questions for every section in a sectioned DataFrame (the output of
+# split_tree). Sections are processed concurrently (up to max_concurrency at a time) while keeping under the
+# requests and tokens per minute limits of the account. A completion that does not finish with
+# finish_reason == "stop", or that fails with an API or transport error, is retried with an exponential backoff.
+#
+# The result for each section is appended to checkpoint_file (json lines) as soon as it is complete so, if the run
+# stops for any reason, calling the function again with the same checkpoint_file only processes the sections that
+# are not already in the file. To regenerate everything (e.g. after a prompt change) use a new checkpoint_file.
+#
+# From a notebook use: df = await generate_summaries_and_questions(sectioned_df, model, checkpoint_file)
+# and from a script: df = asyncio.run(generate_summaries_and_questions(sectioned_df, model, checkpoint_file))
+###
+async def generate_summaries_and_questions(sectioned_df, model, checkpoint_file, client = None,
+                                           max_concurrency = 8, requests_per_minute = 500, tokens_per_minute = 150000,
+                                           max_retries = 5, retry_wait_seconds = 1.0, max_tokens = 500):
+    if client is None:
+        client = get_async_client()
+    completed = read_checkpoint(checkpoint_file)
+    pending = [(section, text) for section, text in zip(sectioned_df['section'], sectioned_df['text']) if section not in completed]
+    print(f"{len(completed)} sections already completed. Generating summaries and questions for {len(pending)} sections")
+
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    checkpoint_lock = asyncio.Lock()
+    failed_sections = []
+
+    async def process_section(section, text):
+        async with semaphore:
+            try:
+                summary, questions = await _get_summary_and_questions_async(text, model, client, rate_limiter, max_retries, retry_wait_seconds, max_tokens)
+            except Exception as e:
+                print(f"Section {section} failed: {e}")
+                failed_sections.append(section)
+                return
+        async with checkpoint_lock:
+            with open(checkpoint_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'section': section, 'summary': summary, 'questions': questions}) + '\n')
+            completed[section] = (summary, questions)
+
+    await asyncio.gather(*[process_section(section, text) for section, text in pending])
+    if failed_sections:
+        print(f"{len(failed_sections)} sections did not complete. Run the function again to retry them: {failed_sections}")
+
+    results = [[section, completed[section][0], completed[section][1]] for section in sectioned_df['section'] if section in completed]
+    return pd.DataFrame(results, columns=['section', 'summary', 'questions'])
+
+
+# Returns a dictionary of section: (summary, questions) from the checkpoint file. A partially written last line (e.g.
+# from a crash during a write) is ignored and removed from the file so the next record appended to the file starts on
+# a new line
+def read_checkpoint(checkpoint_file):
+    completed = {}
+    if not os.path.exists(checkpoint_file):
+        return completed
+    with open(checkpoint_file, 'rb') as f:
+        content = f.read()
+    if content and not content.endswith(b'\n'):
+        with open(checkpoint_file, 'r+b') as f:
+            f.truncate(content.rfind(b'\n') + 1)
+        content = content[:content.rfind(b'\n') + 1]
+    for line in content.decode('utf-8').splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        completed[entry['section']] = (entry['summary'], entry['questions'])
+    return completed
+
+
+async def _get_summary_and_questions_async(text, model, client, rate_limiter, max_retries, retry_wait_seconds, max_tokens):
+    if pd.isna(text) or text.strip() == "":
+        return "", ""
+    summary = await _complete_async(system_content_summerise, text, model, client, rate_limiter, max_retries, retry_wait_seconds, max_tokens)
+    questions = await _complete_async(system_content_question, summary, model, client, rate_limiter, max_retries, retry_wait_seconds, max_tokens)
+    return summary, questions
+
+
+async def _complete_async(system_content, user_content, model, client, rate_limiter, max_retries, retry_wait_seconds, max_tokens):
+    estimated_tokens = num_tokens_from_string(system_content) + num_tokens_from_string(user_content) + max_tokens
+    for attempt in range(max_retries + 1):
+        await rate_limiter.acquire(estimated_tokens)
+        try:
+            with stage('complete', model=model) as complete_stage:
+                response = await client.chat.completions.create(
+                                    model=model,
+                                    temperature = 1.0,
+                                    max_tokens = max_tokens,
+                                    messages=[
+                                        {"role": "system", "content": system_content},
+                                        {"role": "user", "content": user_content},
+                                    ]
+                                )
+                complete_stage.add_usage(response)
+            if response.choices[0].finish_reason == "stop":
+                return response.choices[0].message.content
+            error = f'Completion did not complete. finish_reason: {response.choices[0].finish_reason}'
+        except (openai.AuthenticationError, openai.PermissionDeniedError, openai.BadRequestError):
+            raise # retrying will not help
+        except openai.OpenAIError as e:
+            error = e
+        if attempt < max_retries:
+            wait = retry_wait_seconds * (2 ** attempt)
+            await asyncio.sleep(wait + random.uniform(0, wait))
+    raise RuntimeError(f'Completion failed after {max_retries + 1} attempts. Last error: {error}')
+
+
+# Sliding window (one minute) limiter on the number of requests and the number of tokens
+class RateLimiter():
+    def __init__(self, requests_per_minute, tokens_per_minute, window_seconds = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window_seconds = window_seconds
+        self._history = deque() # (time, tokens)
+        self._tokens_in_window = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        # a single request larger than the token limit would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._history and now - self._history[0][0] >= self.window_seconds:
+                    self._tokens_in_window -= self._history.popleft()[1]
+                if len(self._history) < self.requests_per_minute and self._tokens_in_window + tokens <= self.tokens_per_minute:
+                    self._history.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                await asyncio.sleep(self._history[0][0] + self.window_seconds - now)
@@ -0,0 +1,171 @@
+import os
+import random
+
+####
+# Generates synthetic regulation text files that conform to a ValidIndex so the parser, tree and chunker can be
+# benchmarked and stress tested on corpora far larger than the Reg23 files. The output has the same markup as the
+# files in txt/:
+#   - 4 spaces of indent per level, where the reference at indent n matches index_patterns[n + 1] (index_patterns[0]
+#     is the prefix that add_full_reference adds, e.g. '23')
+#   - '(#Heading)' markers on the top level sections (and some of the lower levels)
+#   - '(x.pdf; pg n)' page tags at the end of some lines
+#   - '#Table n' and '#Formula n' blocks ending with '#Table n - end' and '#Formula n - end'
+#   - lines without a reference (preamble and continuation text) at the same indent as the preceding sibling
+#
+# The references for each level are found by testing the candidate sequences below against the level's pattern so
+# any ValidIndex built from the usual bracketed numbers, letters, Roman numerals and two-letter references works.
+# The output is deterministic for a given seed.
+###
+_ROMAN_NUMERALS = [('m', 1000), ('cm', 900), ('d', 500), ('cd', 400), ('c', 100), ('xc', 90), ('l', 50), ('xl', 40),
+                   ('x', 10), ('ix', 9), ('v', 5), ('iv', 4), ('i', 1)]
+
+_WORDS = ['bank', 'registrar', 'exposure', 'capital', 'requirement', 'risk', 'credit', 'shall', 'relevant', 'specified',
+          'writing', 'conditions', 'approach', 'amount', 'calculate', 'respect', 'provided', 'subject', 'such', 'may',
+          'be', 'the', 'of', 'in', 'to', 'and', 'or', 'with', 'any', 'that', 'accordance', 'reporting', 'asset',
+          'institution', 'minimum', 'equal', 'assets', 'liabilities', 'counterparty', 'collateral', 'guarantee',
+          'securitisation', 'exposures', 'weighted', 'portfolio', 'sufficient', 'material', 'method', 'prior',
+          'approval', 'determine', 'loss', 'default', 'probability', 'rating', 'system', 'internal', 'model']
+
+_FIRST_WORDS = ['A', 'The', 'Subject', 'Unless', 'Provided', 'Any', 'Such', 'For', 'When', 'Every', 'No', 'In']
+
+
+def _to_roman(number):
+    roman = ''
+    for numeral, value in _ROMAN_NUMERALS:
+        while number >= value:
+            roman += numeral
+            number -= value
+    return roman
+
+
+# Candidate reference sequences, in order of preference. The sequences are generators because only the start of each
+# sequence is needed for most levels
+def _candidate_sequences(max_length = 100000):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [
+        (f'({i})' for i in range(1, max_length + 1)),
+        (f'({letter})' for letter in letters),
+        (f'({letter.upper()})' for letter in letters),
+        (f'({_to_roman(i)})' for i in range(1, max_length + 1)),
+        (f'({letter}{letter})' for letter in letters),
+    ]
+
+
+# Returns the consecutive references that match the pattern, starting from the first candidate (e.g. (1), (2), ... or
+# (i), (ii), ...), using the candidate sequence with the longest run of matches
+def get_reference_sequence(pattern, exclusion_list = []):
+    best = []
+    for sequence in _candidate_sequences():
+        matched = []
+        for reference in sequence:
+            match = pattern.match(reference)
+            if not match or match.end() != len(reference) or reference in exclusion_list:
+                break
+            matched.append(reference)
+        if len(matched) > len(best):
+            best = matched
+    if not best:
+        raise ValueError(f'Unable to generate references for the pattern {pattern.pattern}')
+    return best
+
+
+class SyntheticCorpusGenerator():
+    def __init__(self, valid_index_checker, max_depth = None, fan_out = 4, branch_probability = 0.6,
+                 words_per_line = (5, 40), heading_probability = 0.2, text_line_probability = 0.2,
+                 non_text_probability = 0.02, lines_per_page = 40, seed = 42):
+        self.valid_index_checker = valid_index_checker
+        # the first pattern is the prefix added by add_full_reference and does not appear in the text
+        patterns = valid_index_checker.get_compiled_patterns()
+        self.references_per_indent = [get_reference_sequence(pattern, valid_index_checker.exclusion_list) for pattern in patterns[1:]]
+        # a line of text must not start with something the parser would read as a reference
+        self.first_words = [word for word in _FIRST_WORDS if word not in valid_index_checker.exclusion_list and not any(pattern.match(word) for pattern in patterns)]
+        if not self.first_words:
+            raise ValueError('Every word that can start a line of text matches one of the index patterns')
+        self.max_depth = len(self.references_per_indent) if max_depth is None else min(max_depth, len(self.references_per_indent))
+        self.fan_out = fan_out
+        self.branch_probability = branch_probability
+        self.words_per_line = words_per_line
+        self.heading_probability = heading_probability
+        self.text_line_probability = text_line_probability
+        self.non_text_probability = non_text_probability
+        self.lines_per_page = lines_per_page
+        self.random = random.Random(seed)
+        self._next_top_level = 0
+        self._block_number = 0
+        self._line_number = 0
+
+    # Writes number_of_files files with sections_per_file top level sections each. Returns the list of files
+    def generate_files(self, output_directory, number_of_files, sections_per_file, file_prefix = 'synthetic'):
+        os.makedirs(output_directory, exist_ok=True)
+        file_list = []
+        for file_number in range(number_of_files):
+            file = os.path.join(output_directory, f'{file_prefix}_{file_number:04d}.txt')
+            with open(file, 'w', encoding='utf-8') as f:
+                for line in self.generate_lines(sections_per_file, document=f'{file_prefix}_{file_number:04d}.pdf'):
+                    f.write(line + '\n')
+            file_list.append(file)
+        return file_list
+
+    # Yields the lines for the next number_of_sections top level sections
+    def generate_lines(self, number_of_sections, document = 'synthetic.pdf'):
+        top_level_references = self.references_per_indent[0]
+        for _ in range(number_of_sections):
+            if self._next_top_level >= len(top_level_references):
+                raise ValueError(f'The pattern for the top level only has {len(top_level_references)} references')
+            reference = top_level_references[self._next_top_level]
+            self._next_top_level += 1
+            yield from self._generate_node(0, reference, document)
+            yield ''
+
+    def _generate_node(self, indent, reference, document):
+        spaces = ' ' * (indent * 4)
+        if indent == 0:
+            yield spaces + reference + ' ' + self._sentence(3, 8) + ' (#Heading)' + self._page_tag(document, always=True)
+        elif self.random.random() < self.heading_probability:
+            yield spaces + reference + ' ' + self._sentence(3, 8) + ' (#Heading)' + self._page_tag(document)
+        else:
+            yield spaces + reference + ' ' + self._sentence(*self.words_per_line) + self._page_tag(document)
+
+        has_children = indent + 1 < self.max_depth and (indent == 0 or self.random.random() < self.branch_probability)
+        if not has_children:
+            return
+        if self.random.random() < self.text_line_probability:
+            yield spaces + self._sentence(*self.words_per_line) + self._page_tag(document)
+        child_references = self.references_per_indent[indent + 1]
+        number_of_children = self.random.randint(1, min(self.fan_out, len(child_references)))
+        child_spaces = ' ' * ((indent + 1) * 4)
+        for child_reference in child_references[:number_of_children]:
+            yield from self._generate_node(indent + 1, child_reference, document)
+            if self.random.random() < self.non_text_probability:
+                yield from self._generate_non_text_block(indent + 1, document)
+            if self.random.random() < self.text_line_probability / 2:
+                yield child_spaces + self._sentence(*self.words_per_line) + self._page_tag(document)
+
+    def _generate_non_text_block(self, indent, document):
+        spaces = ' ' * (indent * 4)
+        self._block_number += 1
+        label = self.random.choice(['Table', 'Formula'])
+        yield spaces + f'#{label} {self._block_number}' + self._page_tag(document)
+        for _ in range(self.random.randint(1, 6)):
+            if label == 'Table':
+                yield spaces + '| ' + ' | '.join(self._sentence(1, 3) for _ in range(3)) + ' |'
+            else:
+                yield spaces + '$' + ' x '.join(self.random.choice('KRWAEDLGP') for _ in range(self.random.randint(2, 5))) + '$'
+        yield spaces + f'#{label} {self._block_number} - end'
+
+    # Text never starts with a bracket, a digit or a word that matches an index pattern so it cannot be mistaken for a
+    # reference
+    def _sentence(self, minimum_words, maximum_words):
+        words = [self.random.choice(self.first_words)] + [self.random.choice(_WORDS) for _ in range(self.random.randint(minimum_words, maximum_words) - 1)]
+        return ' '.join(words) + self.random.choice([';', '.', '-', ',', ''])
+
+    def _page_tag(self, document, always = False):
+        self._line_number += 1
+        if always or self._line_number % self.lines_per_page == 0:
+            return f' ({document}; pg {self._line_number // self.lines_per_page + 1})'
+        return ''
+
+
+def generate_synthetic_corpus(valid_index_checker, output_directory, number_of_files = 4, sections_per_file = 6, seed = 42, **kwargs):
+    generator = SyntheticCorpusGenerator(valid_index_checker, seed=seed, **kwargs)
+    return generator.generate_files(output_directory, number_of_files, sections_per_file)
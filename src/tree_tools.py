@@ -3,16 +3,28 @@ import re
 import pandas as pd
 from src.valid_index import ValidIndex
 
-from src.file_tools import get_regulation_detail
+from src.file_tools import RegulationIndex
 from src.embeddings import num_tokens_from_string
+from src.instrumentation import stage
         
 
 class TreeNode(Node):
     def __init__(self, name, full_node_name, parent=None, heading_text=''):
+        # children_by_name has to exist before the node is attached to a parent and must be set before calling super()
+        self.children_by_name = {}
         super().__init__(name, parent=parent)
         self.heading_text = heading_text
         self.full_node_name = full_node_name
 
+    # anytree hooks to keep the parent's name: child dictionary in sync with its children
+    def _post_attach(self, parent):
+        if isinstance(parent, TreeNode):
+            parent.children_by_name[self.name] = self
+
+    def _post_detach(self, parent):
+        if isinstance(parent, TreeNode) and parent.children_by_name.get(self.name) is self:
+            del parent.children_by_name[self.name]
+
     # Recursive function to consolidate headings from leaves to root
     def consolidate_from_leaves(self, consolidate_headings):
         # base case: if the node is a leaf node (no children)
@@ -24,18 +36,51 @@ class TreeNode(Node):
         self.heading_text = consolidate_headings(children_headings)
         return self.heading_text
 
+# Note: The Tree keeps a dictionary of full_node_name: node for every node (except the root) so nodes should only be
+#       added with add_to_tree and should not be moved or removed afterwards
 class Tree:
     def __init__(self, root_id, valid_index_checker):
         self.root = TreeNode(root_id, "", parent=None, heading_text='')
         self.valid_index_checker = valid_index_checker
+        self.nodes = {}
+
+    # Builds the tree from the 'full_reference', 'Heading' and 'Text' columns of a regulation DataFrame in one pass.
+    # Raises a ValueError for the first row that does not have a valid reference
+    @classmethod
+    def from_frame(cls, root_id, df, valid_index_checker):
+        with stage('tree'):
+            tree = cls(root_id, valid_index_checker)
+            for i, (full_reference, heading_text) in enumerate(_get_references_and_headings(df)):
+                tree._add_valid_row(full_reference, heading_text, i)
+        return tree
 
     def add_to_tree(self, node_str, heading_text=''):
         if node_str == self.root.name:
             self.root.heading_text = heading_text
             return
-        elif not self.valid_index_checker.is_valid_reference(node_str):
+        existing_node = self.nodes.get(node_str)
+        if existing_node is not None:
+            if not existing_node.heading_text:
+                existing_node.heading_text = heading_text
+            return
+        if not self.valid_index_checker.is_valid_reference(node_str):
             raise ValueError(f'{node_str} is not a valid node reference')
+        self._add_new_node(node_str, heading_text)
 
+    def _add_valid_row(self, full_reference, heading_text, row_number):
+        if not self.valid_index_checker.is_valid_reference(full_reference):
+            raise ValueError(full_reference + ' is not a valid reference. See row ' + str(row_number))
+        if full_reference == self.root.name:
+            self.root.heading_text = heading_text
+            return
+        existing_node = self.nodes.get(full_reference)
+        if existing_node is not None:
+            if not existing_node.heading_text:
+                existing_node.heading_text = heading_text
+        else:
+            self._add_new_node(full_reference, heading_text)
+
+    def _add_new_node(self, node_str, heading_text):
         node_names = self.valid_index_checker.split_reference(node_str)
         current_parent = self.root
         full_node_name = ''
@@ -44,17 +89,14 @@ class Tree:
             previous_full_node_name = full_node_name  # update previous node name before adding current node name
             full_node_name = full_node_name + node_name
             # Try to find the node as a child of the current parent
-            found_node = None
-            for child in current_parent.children:
-                if child.name == node_name:
-                    found_node = child
-                    break
+            found_node = current_parent.children_by_name.get(node_name)
             # If the node isn't found, create it
             if found_node is None:
                 if i == len(node_names) - 1:  # if this is the last node
                     current_parent = TreeNode(node_name, previous_full_node_name + node_name, parent=current_parent, heading_text=heading_text)
                 else:
                     current_parent = TreeNode(node_name, previous_full_node_name + node_name, parent=current_parent, heading_text='')
+                self.nodes[current_parent.full_node_name] = current_parent
             else:
                 # # if found node has a heading text and it's not the last node or it's the last node and heading text is not the same, raise an exception
                 # if found_node.heading_text and ((i != len(node_names) - 1) or (heading_text != '' and i == len(node_names) - 1 and found_node.heading_text != heading_text)):
@@ -67,21 +109,12 @@ class Tree:
     def get_node(self, node_str):
         if node_str == self.root.name:
             return self.root
+        found_node = self.nodes.get(node_str)
+        if found_node is not None:
+            return found_node
         if not self.valid_index_checker.is_valid_reference(node_str):
             raise ValueError(f'{node_str} is not a valid node reference')
-        # Start search from the root
-        current_node = self.root
-        node_names = self.valid_index_checker.split_reference(node_str)
-        for node_name in node_names:
-            # Look for the node among the children of the current node
-            found_node = next((node for node in current_node.children if node.name == node_name), None)
-            # If not found, raise a ValueError
-            if found_node is None:
-                raise ValueError(f"Node with path {node_str} does not exist in the tree")
-            # If found, continue searching from this node
-            current_node = found_node
-        # Return the node we've found
-        return current_node
+        raise ValueError(f"Node with path {node_str} does not exist in the tree")
 
     def print_tree(self):
         for pre, _, node in RenderTree(self.root, style=AsciiStyle()):
@@ -110,36 +143,92 @@ class Tree:
 
 def build_tree_for_regulation(root_node_name, regs_as_dataframe, valid_index_checker):
     # Create a tree from the full_reference column and check there are no errors
-    tree = Tree(root_node_name, valid_index_checker=valid_index_checker)
-    # NOTE: Hierarchy: Regulation / Sub regulation / Paragraph / 
-    for i, row in regs_as_dataframe.iterrows() :
-        try:
-            heading_text = ''
-            if row['Heading'] == True:
-                heading_text = row['Text']
-            if not valid_index_checker.is_valid_reference(row['full_reference']):
-                raise ValueError(row['full_reference'] + ' is not a valid reference. See row ' + str(i))
-            tree.add_to_tree(row['full_reference'], heading_text=heading_text)
-        except Exception as e:
-            print(f"An error occurred at row {i}:")
-            print(regs_as_dataframe.iloc[i])
-            print(f"Error message: {e}")
-            break
+    # Unlike Tree.from_frame, this prints the first row with an error and returns the tree built up to that row
+    with stage('tree'):
+        tree = Tree(root_node_name, valid_index_checker=valid_index_checker)
+        # NOTE: Hierarchy: Regulation / Sub regulation / Paragraph / 
+        for i, (full_reference, heading_text) in enumerate(_get_references_and_headings(regs_as_dataframe)):
+            try:
+                tree._add_valid_row(full_reference, heading_text, i)
+            except Exception as e:
+                print(f"An error occurred at row {i}:")
+                print(regs_as_dataframe.iloc[i])
+                print(f"Error message: {e}")
+                break
     return tree
 
 
-def _split_recursive(node, df, token_limit, valid_index_checker, node_list=[]):
-    # Get the full text for this node
-    subsection_text = get_regulation_detail(node.full_node_name, df, valid_index_tracker=valid_index_checker)
-    token_count = num_tokens_from_string(subsection_text)
+# (full_reference, heading_text) for each row where heading_text is the 'Text' if the row is a heading, otherwise ''
+def _get_references_and_headings(df):
+    texts = df['Text'].to_numpy()
+    headings = df['Heading'].to_numpy()
+    return [(full_reference, texts[i] if headings[i] == True else '') for i, full_reference in enumerate(df['full_reference'].to_numpy())]
+
+
+# The text for a node (from get_regulation_detail) is the text of all the rows in its subtree plus the rows of each of
+# its ancestors, one row per line. Each row is tokenized once (RegulationIndex.get_row_token_counts) and the totals
+# for each subtree are added up from the leaves so the token count of a node can be estimated without rendering it.
+#
+# Returns a dictionary of node: (tokens, lines) for the rows in the subtree below (and including) each node
+def get_subtree_token_counts(node, regulation_index):
+    row_token_counts = regulation_index.get_row_token_counts()
+    subtree_counts = {}
+
+    def count(node):
+        own_rows = regulation_index.rows_for_reference.get(node.full_node_name, []) if node.full_node_name != '' else []
+        tokens = sum(row_token_counts[position] for position in own_rows)
+        lines = len(own_rows)
+        for child in node.children:
+            child_tokens, child_lines = count(child)
+            tokens += child_tokens
+            lines += child_lines
+        subtree_counts[node] = (tokens, lines)
+        return tokens, lines
+
+    count(node)
+    return subtree_counts
+
+
+# Tokens and lines in the rows of the ancestors of the node (but not the root) that get_regulation_detail adds as
+# conditions and qualifiers
+def _get_ancestor_token_counts(node, regulation_index):
+    row_token_counts = regulation_index.get_row_token_counts()
+    tokens = 0
+    lines = 0
+    for ancestor in node.ancestors:
+        if ancestor.full_node_name != '':
+            own_rows = regulation_index.rows_for_reference.get(ancestor.full_node_name, [])
+            tokens += sum(row_token_counts[position] for position in own_rows)
+            lines += len(own_rows)
+    return tokens, lines
+
+
+# Tokenizing the lines separately rather than as one text can change the count at the line breaks (e.g. a line ending
+# in ";" followed by "\n" may be one token). When the estimate is within this many tokens per line break of the limit
+# the node is rendered and counted exactly. Leaves are always counted exactly because they cannot be split further
+_TOKEN_TOLERANCE_PER_LINE = 2
+
+def _split_recursive(node, regulation_index, token_limit, subtree_counts, ancestor_counts, node_list):
+    subtree_tokens, subtree_lines = subtree_counts[node]
+    ancestor_tokens, ancestor_lines = ancestor_counts
+    lines = subtree_lines + ancestor_lines
+    estimated_token_count = subtree_tokens + ancestor_tokens + max(lines - 1, 0) # one token for each line break
+    tolerance = _TOKEN_TOLERANCE_PER_LINE * max(lines - 1, 0)
+    if subtree_lines == 0 or abs(estimated_token_count - token_limit) <= tolerance or len(node.children) == 0:
+        token_count = num_tokens_from_string(regulation_index.get_regulation_detail(node.full_node_name))
+    else:
+        token_count = estimated_token_count
 
     # Check if the total token count of the node is greater than the limit
     if token_count > token_limit:
         # If the token count is over the limit, recursively apply the function to each child
         if len(node.children) == 0:
             raise Exception(f'Node {node.full_node_name} has no children but has a token count of {token_count}')
+        own_rows = regulation_index.rows_for_reference.get(node.full_node_name, []) if node.full_node_name != '' else []
+        row_token_counts = regulation_index.get_row_token_counts()
+        child_ancestor_counts = (ancestor_tokens + sum(row_token_counts[position] for position in own_rows), ancestor_lines + len(own_rows))
         for child in node.children:
-            _split_recursive(child, df, token_limit, valid_index_checker, node_list)
+            _split_recursive(child, regulation_index, token_limit, subtree_counts, child_ancestor_counts, node_list)
     else:
         # If the token count is under the limit, add this node to the list
         node_list.append(node)
@@ -151,19 +240,26 @@ def _split_recursive(node, df, token_limit, valid_index_checker, node_list=[]):
 # into sections where the text does not exceed a certain token_count cap.
 #
 # Initially this is used to set up the base DataFrame using node == root and later it can be used if we want 
-# to change the word_limit for a specific piece of regulation
+# to change the word_limit for a specific piece of regulation. When trying different token_limits, create the
+# RegulationIndex once and pass it in so the rows are only tokenized once. The tree must have been built from df.
 ###
-def split_tree(node, df, token_limit, valid_index_checker):
-    node_list=[]
-    node_list = _split_recursive(node, df, token_limit, valid_index_checker, node_list)
+def split_tree(node, df, token_limit, valid_index_checker, regulation_index = None):
+    with stage('split', token_limit=token_limit) as split_stage:
+        sectioned_df = _split_tree(node, df, token_limit, valid_index_checker, regulation_index)
+        split_stage.add('sections', len(sectioned_df))
+    return sectioned_df
+
+
+def _split_tree(node, df, token_limit, valid_index_checker, regulation_index):
+    if regulation_index is None:
+        regulation_index = RegulationIndex(df, valid_index_checker)
+    subtree_counts = get_subtree_token_counts(node, regulation_index)
+    node_list = _split_recursive(node, regulation_index, token_limit, subtree_counts, _get_ancestor_token_counts(node, regulation_index), [])
     section_token_count = []
     for node in node_list:
-        #subsection_text = get_full_text_for_node(node.full_node_name, df, False)
-        subsection_text = get_regulation_detail(node.full_node_name, df, valid_index_checker)
+        subsection_text = regulation_index.get_regulation_detail(node.full_node_name)
         token_count = num_tokens_from_string(subsection_text)
         section_token_count.append([node.full_node_name, subsection_text, token_count])
 
     column_names = ['section', 'text', 'token_count']
     return pd.DataFrame(section_token_count, columns=column_names)
-
-
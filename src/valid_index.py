@@ -1,4 +1,5 @@
 import re
+from collections import OrderedDict
 
 # Legal documents are often written where every line is given a reference in a tree structure. The numbering follows a format
 # where for example you start with a Capital Letter, then an indented Roman Numeral, then a double indented lowercase letter
@@ -6,21 +7,60 @@ import re
 # This is a helper class for indexes like this. It also has a list of exclusions because these texts often start with a section
 # or two that do not follow the default numbering
 class ValidIndex():
-    def __init__(self, regex_list_of_indices, exclusion_list = []):
+    def __init__(self, regex_list_of_indices, exclusion_list = [], memo_size = 8192):
         self.index_patterns = regex_list_of_indices
         self.exclusion_list = exclusion_list
+        # The patterns are compiled once. The search patterns are used to find a reference anywhere in a string so the
+        # caret "^" that anchors the index patterns to the start of the string is removed
+        self._compiled_patterns = [re.compile(pattern) for pattern in regex_list_of_indices]
+        self._compiled_search_patterns = [re.compile(pattern[1:] if pattern[0] == "^" else pattern) for pattern in regex_list_of_indices]
+        # The same references are validated and split many times when building trees and chunking so the results
+        # are memoised. The memos are least recently used caches: when a memo is full, the reference that was used
+        # longest ago is evicted. An OrderedDict (rather than lru_cache on a bound method) so the ValidIndex can still be
+        # pickled for the process pool in process_regulations
+        self.memo_size = memo_size
+        self._valid_reference_memo = OrderedDict()
+        self._split_reference_memo = OrderedDict()
+
+    # The compiled index patterns, anchored to the start of the string, in order
+    def get_compiled_patterns(self):
+        return list(self._compiled_patterns)
 
     # Note: This does check the order
     def is_valid_reference(self, reference):
+        is_valid = self._get_memoised(self._valid_reference_memo, reference)
+        if is_valid is None:
+            is_valid = self._is_valid_reference(reference)
+            self._memoise(self._valid_reference_memo, reference, is_valid)
+        return is_valid
+
+    def _get_memoised(self, memo, reference):
+        value = memo.get(reference)
+        if value is not None:
+            try:
+                memo.move_to_end(reference)
+            except KeyError: # evicted by another thread
+                pass
+        return value
+
+    def _memoise(self, memo, reference, value):
+        memo[reference] = value
+        while len(memo) > self.memo_size:
+            try:
+                memo.popitem(last=False)
+            except KeyError: # emptied by another thread
+                break
+
+    def _is_valid_reference(self, reference):
         if reference in self.exclusion_list:
             return True
 
         reference_copy = reference
         pattern_matched = False
 
-        for pattern in self.index_patterns:
+        for pattern in self._compiled_patterns:
             if (len(reference_copy) > 0):
-                match = re.match(pattern, reference_copy)
+                match = pattern.match(reference_copy)
                 if match:
                     reference_copy = reference_copy[match.end():]
                     pattern_matched = True
@@ -50,10 +90,10 @@ class ValidIndex():
         partial_ref = ""
         remaining_str = input_string
     
-        for pattern in self.index_patterns:
-            if pattern[0] == "^": # the caret "^" is used in the index pattern because we only want the index at the start of the section but this causes potential issues here so it is removed 
-                pattern = pattern[1:]
-            match = re.search(pattern, remaining_str)
+        # the caret "^" is used in the index pattern because we only want the index at the start of the section but
+        # this causes potential issues here so the search patterns (with the caret removed) are used
+        for pattern in self._compiled_search_patterns:
+            match = pattern.search(remaining_str)
             if match:
                 partial_ref += match.group()
                 remaining_str = remaining_str[match.end():]
@@ -64,8 +104,61 @@ class ValidIndex():
         
         return partial_ref if partial_ref else None
 
+    # Finds all the references written out in full in a piece of text, e.g. a question like "how do 23(5)(b)(i) and
+    # 23(6) differ". Unlike extract_valid_reference, the components of a reference must be next to each other (spaces
+    # between them are allowed) so text between two references is not merged into one. A reference has to start with
+    # the first index pattern and is not matched inside a longer word or number. Returns the references in the order
+    # they appear, without duplicates
+    def extract_valid_references(self, input_string):
+        found = [] # (position, reference)
+        for exclusion_item in self.exclusion_list:
+            match = re.search(r'(?<!\w)' + re.escape(exclusion_item) + r'(?!\w)', input_string)
+            if match:
+                found.append((match.start(), exclusion_item))
+
+        first_pattern = self._compiled_search_patterns[0]
+        position = 0
+        while position < len(input_string):
+            match = first_pattern.search(input_string, position)
+            if not match:
+                break
+            if match.end() == match.start() or (match.start() > 0 and input_string[match.start() - 1].isalnum()) \
+                    or (match.end() < len(input_string) and input_string[match.end()].isalnum()):
+                position = match.start() + 1
+                continue
+            reference_start = match.start()
+            reference = match.group()
+            position = match.end()
+            for pattern in self._compiled_search_patterns[1:]:
+                start = position
+                while start < len(input_string) and input_string[start] == ' ':
+                    start += 1
+                component = pattern.match(input_string, start)
+                if not component or component.end() == start:
+                    break
+                reference += component.group()
+                position = component.end()
+            found.append((reference_start, reference))
+
+        references = []
+        for _, reference in sorted(found):
+            if reference not in references:
+                references.append(reference)
+        return references
+
 
     def split_reference(self, reference):
+        components = self._get_memoised(self._split_reference_memo, reference)
+        if components is None:
+            components = tuple(self._split_reference(reference))
+            self._memoise(self._split_reference_memo, reference, components)
+        return list(components)
+
+    # Splits each reference in the list. Returns a list with the components of each reference
+    def split_references(self, references):
+        return [self.split_reference(reference) for reference in references]
+
+    def _split_reference(self, reference):
         components = []
         #print(f'split_reference called with input: {reference}')
         if reference == "": # i.e. the root node which has no name
@@ -78,9 +171,9 @@ class ValidIndex():
         # Initialize variables
         reference_copy = reference
         pattern_matched = False
-        for pattern in self.index_patterns:
+        for pattern in self._compiled_patterns:
             if (len(reference_copy) > 0):
-                match = re.match(pattern, reference_copy)
+                match = pattern.match(reference_copy)
                 if match:
                     components.append(match.group(0))
                     reference_copy = reference_copy[match.end():]
@@ -125,10 +218,10 @@ class ValidIndex():
 
             if indent >= len(self.index_patterns):
                 raise ValueError(f"This line has too many indents and cannot be compared against a Valid Index: {line_of_text}")
-            expected_pattern = self.index_patterns[indent+1] # exclude the "23"
-            match = re.match(expected_pattern, index)
+            expected_pattern = self._compiled_patterns[indent+1] # exclude the "23"
+            match = expected_pattern.match(index)
             if not match:
-                raise ValueError(f"This line has {indent} indent(s) and its index should match a regex pattern {expected_pattern} but it does not: {line_of_text}")
+                raise ValueError(f"This line has {indent} indent(s) and its index should match a regex pattern {expected_pattern.pattern} but it does not: {line_of_text}")
 
         return indent, index, remaining_text
 
@@ -140,13 +233,11 @@ class ValidIndex():
     #       We only check if (i) is a indented correctly later when we have the full reference
     #
     def _extract_reference_from_string(self, s):
-        counter = 0
-        for pattern in self.index_patterns:
-            match = re.match(pattern, s)
+        for pattern in self._compiled_patterns:
+            match = pattern.match(s)
             if match:
                 # If a match is found, return the matched index and the remaining string
                 return match.group(0), s[match.end()+1:] # there is always a space after the index
-            counter += 1
 
         for exclusion_item in self.exclusion_list:
             if s.strip() == exclusion_item:
@@ -0,0 +1,64 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from src.embeddings import EmbeddingIndex
+from src.ann_index import IVFIndex, load_ivf_index, measure_recall
+
+
+def _clustered_index(n_clusters = 8, rows_per_cluster = 50, dimension = 16, seed = 0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_clusters, dimension))
+    embeddings = np.vstack([centre + 0.1 * rng.normal(size=(rows_per_cluster, dimension)) for centre in centres])
+    df = pd.DataFrame({
+        'section': [f'23({i})' for i in range(len(embeddings))],
+        'Embedding': list(embeddings),
+    })
+    return EmbeddingIndex(df, 'Embedding'), centres
+
+
+def test_ivf_index_search():
+    embedding_index, centres = _clustered_index()
+    ivf_index = IVFIndex.build(embedding_index, n_lists = 8, n_probe = 2)
+    assert ivf_index.n_lists == 8
+    assert sorted(ivf_index.list_positions) == list(range(len(embedding_index)))
+
+    question_embedding = centres[3]
+    expected = embedding_index.search(question_embedding, threshold = 0.5, top_k = 10)
+    closest = ivf_index.search(question_embedding, threshold = 0.5, top_k = 10)
+    assert list(closest['section']) == list(expected['section'])
+
+    # probing every list is the exact search
+    positions, distances = ivf_index.nearest(question_embedding, threshold = 2.0, n_probe = 8)
+    with pytest.raises(ValueError):
+        ivf_index.nearest(question_embedding, threshold = 2.0, n_probe = 0)
+    with pytest.raises(ValueError):
+        IVFIndex.build(embedding_index, n_lists = 8, n_probe = 0)
+    exact_positions, exact_distances = embedding_index.nearest(question_embedding, threshold = 2.0)
+    assert np.array_equal(positions, exact_positions)
+
+    with pytest.raises(ValueError):
+        ivf_index.search(np.zeros(16))
+
+
+def test_measure_recall():
+    embedding_index, centres = _clustered_index()
+    ivf_index = IVFIndex.build(embedding_index, n_lists = 8)
+    assert measure_recall(ivf_index, centres, top_k = 10, n_probe = 8) == 1.0
+    assert measure_recall(ivf_index, centres, top_k = 10, n_probe = 2) > 0.9
+
+
+def test_save_and_load_ivf_index(tmp_path):
+    embedding_index, centres = _clustered_index()
+    ivf_index = IVFIndex.build(embedding_index, n_lists = 8, n_probe = 3)
+    ivf_index.save(str(tmp_path))
+    loaded = load_ivf_index(str(tmp_path), embedding_index)
+    assert loaded.n_probe == 3
+    assert np.array_equal(loaded.list_offsets, ivf_index.list_offsets)
+    positions, _ = loaded.nearest(centres[0], threshold = 2.0, top_k = 5)
+    expected_positions, _ = ivf_index.nearest(centres[0], threshold = 2.0, top_k = 5)
+    assert np.array_equal(positions, expected_positions)
+
+    other_index, _ = _clustered_index(rows_per_cluster = 10)
+    with pytest.raises(ValueError):
+        load_ivf_index(str(tmp_path), other_index)
@@ -0,0 +1,51 @@
+import json
+
+from src.valid_index import get_banking_act_index
+from src.file_tools import process_regulations
+from src.fake_openai import FakeEncoding
+from src.embeddings import set_encoding
+from src.benchmarks import scale_corpus, run_benchmarks, save_benchmark_results, load_benchmark_results, compare_benchmark_results
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+file_list = ['./test/data/reg23_sections_01_09.txt', './test/data/reg23_sections_10_12.txt']
+
+
+def test_scale_corpus(tmp_path):
+    index_checker = get_banking_act_index()
+    df, _ = process_regulations(file_list, index_checker, non_text_labels)
+    scaled_files = scale_corpus(file_list, 3, str(tmp_path))
+    assert len(scaled_files) == 6
+    scaled_df, _ = process_regulations(scaled_files, index_checker, non_text_labels)
+    assert len(scaled_df) == 3 * len(df)
+    # the top level references in each copy are renumbered
+    top_level = set(reference for reference in df['full_reference'] if index_checker.get_parent_reference(reference) == '23')
+    scaled_top_level = set(reference for reference in scaled_df['full_reference'] if index_checker.get_parent_reference(reference) == '23')
+    assert len(scaled_top_level) == 3 * len(top_level)
+
+
+def test_run_benchmarks(tmp_path):
+    # FakeEncoding so the benchmarks do not need the tiktoken encoding file
+    encoding = FakeEncoding()
+    benchmark_results = run_benchmarks(file_list, sizes=(1, 2), repeat=1, detail_sample_size=5, embedding_dimension=8, encoding=encoding)
+    assert benchmark_results['tokenizer'] == 'FakeEncoding'
+    # the previous (tiktoken) encoding is restored
+    assert set_encoding() is None
+    functions = set(result['function'] for result in benchmark_results['results'])
+    for function in ['process_regulations', 'add_full_reference', 'build_tree_for_regulation', 'split_tree', 'get_regulation_detail', 'num_tokens_from_string', 'get_closest_nodes']:
+        assert function in functions
+    assert set(result['corpus_size'] for result in benchmark_results['results']) == {1, 2}
+    assert all(result['seconds_min'] >= 0 and result['peak_memory_bytes'] >= 0 for result in benchmark_results['results'])
+
+    path = str(tmp_path / 'results.json')
+    save_benchmark_results(benchmark_results, path)
+    assert load_benchmark_results(path) == json.loads(json.dumps(benchmark_results))
+    comparison = compare_benchmark_results(benchmark_results, benchmark_results)
+    assert len(comparison) == len(benchmark_results['results'])
+    assert (comparison['time_ratio'] == 1.0).all()
+
+
+def test_run_benchmarks_on_synthetic_corpus():
+    benchmark_results = run_benchmarks(sizes=(1,), repeat=1, detail_sample_size=5, embedding_dimension=8, synthetic=True, synthetic_sections_per_size=3,
+                                       encoding=FakeEncoding())
+    assert set(result['corpus'] for result in benchmark_results['results']) == {'synthetic'}
+    assert all(result['rows'] > 0 for result in benchmark_results['results'])
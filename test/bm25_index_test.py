@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+from src.valid_index import get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe
+from src.tree_tools import Tree, split_tree
+from src.embeddings import EmbeddingIndex
+from src.fake_openai import fake_embedding
+from src.bm25_index import tokenize, get_terms, build_bm25_index, load_bm25_index, reciprocal_rank_fusion, hybrid_search, BM25Index
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+
+
+def _regulation_frames():
+    index_checker = get_banking_act_index()
+    df, _ = read_processed_regs_into_dataframe(['./test/data/reg23_sections_10_12.txt'], index_checker, non_text_labels)
+    tree = Tree.from_frame('BA', df, index_checker)
+    return df, split_tree(tree.root, df, 1000, index_checker)
+
+
+def test_tokenize():
+    assert tokenize('The bank shall calculate its Exposures (BA 200)') == ['bank', 'calculate', 'exposure', 'ba', '200']
+    assert get_terms('specialised lending exposures') == ['specialised', 'lending', 'exposure', 'specialised lending', 'lending exposure']
+
+
+def test_bm25_scores():
+    documents = pd.DataFrame({
+        'section': ['23(1)', '23(2)', '23(3)'],
+        'source': 'regulation_text',
+        'text': ['specialised lending exposures', 'lending to banks and lending to corporates', 'the weather'],
+    })
+    index = BM25Index.build(documents)
+    scores = index.scores('specialised lending')
+    assert scores[0] > scores[1] > 0
+    assert scores[2] == 0
+    results = index.search('specialised lending', top_k=5)
+    assert list(results['section']) == ['23(1)', '23(2)']
+    assert index.is_confident('specialised lending', results)
+    assert not index.is_confident('lending to the weather', index.search('lending to the weather'))
+    assert len(index.search('unknown words')) == 0
+
+
+def test_build_save_and_load(tmp_path):
+    df, sectioned_df = _regulation_frames()
+    index = build_bm25_index(df, sectioned_df)
+    assert len(index) == len(df) + len(sectioned_df)
+    results = index.search('foundation IRB approach minimum requirements', top_k=5)
+    assert len(results) == 5
+    assert set(results['source']) <= {'regulation_text', 'section_text'}
+
+    path = str(tmp_path / 'reg23_index')
+    index.save(path)
+    loaded = load_bm25_index(path)
+    for query in ['foundation IRB approach', 'probability of default', 'credit risk mitigation']:
+        assert np.allclose(loaded.scores(query), index.scores(query))
+        assert list(loaded.search(query)['section']) == list(index.search(query)['section'])
+
+
+def test_reciprocal_rank_fusion():
+    lexical = pd.DataFrame({'section': ['a', 'b', 'c'], 'text': ['A', 'B', 'C']})
+    vector = pd.DataFrame({'section': ['c', 'a', 'a', 'd'], 'text': ['C', 'A', 'A', 'D']})
+    fused = reciprocal_rank_fusion([lexical, vector], ['lexical', 'vector'], top_k=3, rrf_k=1)
+    assert list(fused['section']) == ['a', 'c', 'b']
+    assert fused.loc[0, 'lexical_rank'] == 1 and fused.loc[0, 'vector_rank'] == 2
+    assert np.isnan(fused.loc[2, 'vector_rank'])
+
+
+def test_hybrid_search():
+    df, sectioned_df = _regulation_frames()
+    bm25_index = build_bm25_index(sectioned_df=sectioned_df)
+    index_df = pd.DataFrame({'section': sectioned_df['section'], 'text': sectioned_df['text'],
+                             'Embedding': [fake_embedding(text, dimension=32) for text in sectioned_df['text']]})
+    embedding_index = EmbeddingIndex(index_df)
+    calls = []
+
+    def get_embedding(question):
+        calls.append(question)
+        return fake_embedding(question, dimension=32)
+
+    # a question whose words are all in the top section is answered locally when the margin is met
+    results, retrieval = hybrid_search('credit conversion factor', bm25_index, embedding_index, get_embedding=get_embedding, threshold=2.0, min_margin=1.1)
+    assert retrieval == 'lexical'
+    assert calls == []
+    assert results.loc[0, 'section'] == bm25_index.search('credit conversion factor').iloc[0]['section']
+    results, retrieval = hybrid_search('credit conversion factor', bm25_index, embedding_index, get_embedding=get_embedding, threshold=2.0, min_margin=2.0)
+    assert retrieval == 'hybrid'
+    calls.clear()
+
+    # with the default margin, phrases that single out one section are answered locally
+    for question in ['project finance', 'loss given default']:
+        results, retrieval = hybrid_search(question, bm25_index, embedding_index, get_embedding=get_embedding, threshold=2.0)
+        assert retrieval == 'lexical'
+        assert results.loc[0, 'section'] == bm25_index.search(question).iloc[0]['section']
+    assert calls == []
+
+    # a question with words that are not in the corpus needs the embeddings
+    results, retrieval = hybrid_search('zebra crossing approach', bm25_index, embedding_index, get_embedding=get_embedding, threshold=2.0)
+    assert retrieval == 'hybrid'
+    assert calls == ['zebra crossing approach']
+    assert 'vector_rank' in results.columns
@@ -0,0 +1,13 @@
+import os
+import shutil
+import pytest
+
+
+# Copies of the files in ./test/data/ in tmp_path, sorted by name, so a test can change them
+@pytest.fixture
+def copied_test_data(tmp_path):
+    file_list = []
+    for file in sorted(os.listdir('./test/data/')):
+        shutil.copy(os.path.join('./test/data/', file), tmp_path / file)
+        file_list.append(str(tmp_path / file))
+    return file_list
@@ -0,0 +1,53 @@
+import os
+from src.valid_index import get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe, RegulationIndex
+from src.context_assembly import assemble_context, get_section_rows
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+
+
+def _regulation_index():
+    index_checker = get_banking_act_index()
+    df, _ = read_processed_regs_into_dataframe(['./test/data/reg23_sections_10_12.txt'], index_checker, non_text_labels)
+    return RegulationIndex(df, index_checker)
+
+
+def test_single_section_matches_regulation_detail():
+    index_checker = get_banking_act_index()
+    file_list = sorted([os.path.join('./test/data/', file) for file in os.listdir('./test/data/') if file.endswith('.txt')])
+    df, _ = read_processed_regs_into_dataframe(file_list, index_checker, non_text_labels)
+    regulation_index = RegulationIndex(df, index_checker)
+    # includes sections like 23(18)(b)(v)(A) where a row of the grandparent is between the parent and the section
+    for section in sorted(set(df['full_reference'])):
+        context, report = assemble_context([section], regulation_index, 10**9)
+        assert context == regulation_index.get_regulation_detail(section)
+        assert list(report['status']) == ['included']
+
+
+def test_shared_ancestors_are_rendered_once():
+    regulation_index = _regulation_index()
+    hits = ['23(11)(a)(iii)', '23(11)(a)(iv)', '23(11)(a)(iii)', '23(11)(a)', '23(5)']
+    context, report = assemble_context(hits, regulation_index, 100000)
+    assert list(report['status']) == ['included', 'included', 'merged', 'included', 'missing']
+    assert list(report['rank']) == [1, 2, 3, 4, 5]
+    parent_line = regulation_index.render_row(regulation_index.rows_for_reference['23(11)'][0])
+    assert context.count(parent_line) == 1
+    # the second sibling only adds its own row
+    row_token_counts = regulation_index.get_row_token_counts()
+    assert report['tokens'].iloc[1] == sum(row_token_counts[position] for position in regulation_index.rows_for_reference['23(11)(a)(iv)']) + 1
+    assert context == regulation_index.get_regulation_detail('23(11)(a)')
+    assert get_section_rows('23(5)', regulation_index) == set()
+
+
+def test_token_budget():
+    regulation_index = _regulation_index()
+    _, report = assemble_context(['23(11)(a)(iii)'], regulation_index, 100000)
+    budget = int(report['tokens'].iloc[0])
+    context, report = assemble_context(['23(11)', '23(11)(a)(iii)', '23(12)'], regulation_index, budget)
+    # 23(11) is too large, 23(11)(a)(iii) fits exactly and there is nothing left for 23(12)
+    assert list(report['status']) == ['dropped', 'included', 'dropped']
+    assert report['tokens'].sum() == budget
+    assert context == regulation_index.get_regulation_detail('23(11)(a)(iii)')
+    context, report = assemble_context(['23(11)'], regulation_index, 0)
+    assert context == ''
+    assert list(report['status']) == ['dropped']
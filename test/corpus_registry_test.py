@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.valid_index import ValidIndex, get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe
+from src.tree_tools import Tree, split_tree
+from src.embeddings import save_embedding_index
+from src.fake_openai import fake_embedding
+from src.synthetic_corpus import generate_synthetic_corpus
+from src.query_cache import QueryCache
+from src.corpus_registry import CorpusRegistry
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+
+
+def _popia_index():
+    return ValidIndex([r'^19', r'^\(\d+\)', r'^\([a-z]\)', r'^\((i|ii|iii|iv|v|vi|vii|viii|ix|x)\)'])
+
+
+# Writes the embedding index for the sections of a regulation
+def _save_embedding_shard(path, file_list, index_checker, reference_prefix):
+    df, _ = read_processed_regs_into_dataframe(file_list, index_checker, non_text_labels, reference_prefix=reference_prefix)
+    tree = Tree.from_frame('root', df, index_checker)
+    sectioned_df = split_tree(tree.root, df, 500, index_checker)
+    sectioned_df['source'] = 'section_text'
+    sectioned_df['Embedding'] = [fake_embedding(text, dimension=64) for text in sectioned_df['text']]
+    save_embedding_index(sectioned_df, path)
+    return sectioned_df
+
+
+def _registry(tmp_path, max_workers = None):
+    popia_files = generate_synthetic_corpus(_popia_index(), str(tmp_path / 'popia_txt'), number_of_files=1, sections_per_file=4, seed=7)
+    reg23_files = ['./test/data/reg23_sections_10_12.txt']
+    reg23_sections = _save_embedding_shard(str(tmp_path / 'reg23_index'), reg23_files, get_banking_act_index(), '23')
+    popia_sections = _save_embedding_shard(str(tmp_path / 'popia_index'), popia_files, _popia_index(), '19')
+
+    registry = CorpusRegistry(max_workers=max_workers)
+    registry.register('reg23', get_banking_act_index(), str(tmp_path / 'reg23.snapshot'), str(tmp_path / 'reg23_index'),
+                      file_list=reg23_files, non_text_labels=non_text_labels)
+    registry.register('popia', _popia_index(), str(tmp_path / 'popia.snapshot'), str(tmp_path / 'popia_index'),
+                      file_list=popia_files, non_text_labels=non_text_labels, reference_prefix='19')
+    return registry, reg23_sections, popia_sections
+
+
+def test_shards_are_loaded_lazily(tmp_path):
+    registry, reg23_sections, _ = _registry(tmp_path)
+    assert registry.names() == ['reg23', 'popia']
+    assert registry.loaded_corpora() == []
+
+    question = reg23_sections['text'].iloc[3]
+    results, route = registry.search(question, corpora=['reg23'], get_embedding=lambda text: fake_embedding(text, dimension=64), threshold=2.0, top_k=3)
+    assert route == 'retrieval'
+    assert list(results['corpus']) == ['reg23'] * 3
+    assert results['section'].iloc[0] == reg23_sections['section'].iloc[3]
+    assert registry.loaded_corpora() == ['reg23']
+    # the vector search does not need the snapshot
+    assert registry.get_shard('reg23')._snapshot is None
+
+    registry.unload()
+    assert registry.loaded_corpora() == []
+    with pytest.raises(ValueError):
+        registry.select(['excon'])
+    with pytest.raises(ValueError):
+        registry.register('reg23', get_banking_act_index(), 'other.snapshot', 'other_index')
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_fan_out_merges_the_top_k(tmp_path, max_workers):
+    registry, reg23_sections, popia_sections = _registry(tmp_path, max_workers=max_workers)
+    question = popia_sections['text'].iloc[1]
+    question_embedding = fake_embedding(question, dimension=64)
+    results = registry.select().search(question_embedding, threshold=2.0, top_k=5)
+    assert results['corpus'].iloc[0] == 'popia'
+    assert results['section'].iloc[0] == popia_sections['section'].iloc[1]
+    assert results['cosine_distance'].is_monotonic_increasing
+
+    # the same as one search over all the sections
+    all_sections = pd.concat([reg23_sections.assign(corpus='reg23'), popia_sections.assign(corpus='popia')], ignore_index=True)
+    distances = 1.0 - np.vstack(all_sections['Embedding']) @ question_embedding
+    expected = all_sections.iloc[np.argsort(distances, kind='stable')[:5]]
+    assert list(zip(results['corpus'], results['section'])) == list(zip(expected['corpus'], expected['section']))
+
+
+def test_cited_sections_only_load_their_corpus(tmp_path):
+    registry, _, _ = _registry(tmp_path)
+    # a bare first component is not a section so the snapshots are not needed for the vector search
+    results, route = registry.search('what do the 23 largest banks report?', get_embedding=lambda text: fake_embedding(text, dimension=64), threshold=2.0)
+    assert route == 'retrieval'
+    assert registry.get_shard('reg23')._snapshot is None
+    assert registry.get_shard('popia')._snapshot is None
+    registry.unload()
+
+    results, route = registry.search('what does 23(11)(a)(iii) say?', get_embedding=None)
+    assert route == 'reference'
+    assert list(results['corpus']) == ['reg23']
+    assert results['text'].iloc[0] == registry.get_shard('reg23').regulation_index.get_regulation_detail('23(11)(a)(iii)')
+    assert registry.loaded_corpora() == ['reg23']
+
+    popia = registry.get_shard('popia')
+    assert popia.df['full_reference'].str.startswith('19(').all()
+    results, route = registry.search('compare 19(1)(a) and 23(10)(a)', get_embedding=None)
+    assert list(zip(results['corpus'], results['section'])) == [('reg23', '23(10)(a)'), ('popia', '19(1)(a)')]
+
+
+def test_query_cache_with_selected_shards(tmp_path):
+    registry, reg23_sections, _ = _registry(tmp_path)
+    cache = QueryCache()
+    index = registry.select(['reg23', 'popia'])
+    get_embedding = lambda text: fake_embedding(text, dimension=64)
+    question = reg23_sections['text'].iloc[0]
+    first = cache.search(question, index, threshold=2.0, top_k=3, get_embedding=get_embedding)
+    second = cache.search(question, index, threshold=2.0, top_k=3, get_embedding=get_embedding)
+    assert first.equals(second)
+    assert cache.statistics['exact_hits'] == 1
+    version = index.version
+    registry.unload('reg23')
+    _save_embedding_shard(str(tmp_path / 'reg23_index'), ['./test/data/reg23_sections_10_12.txt'], get_banking_act_index(), '23')
+    assert index.version != version
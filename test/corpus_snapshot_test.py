@@ -0,0 +1,58 @@
+import os
+import pytest
+from anytree import PreOrderIter
+
+from src.valid_index import get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe, get_regulation_detail
+from src.tree_tools import build_tree_for_regulation
+from src.corpus_snapshot import compile_corpus_snapshot, load_or_compile_corpus_snapshot, is_snapshot_current, CorpusSnapshot
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+
+
+def test_compile_and_load_snapshot(tmp_path, copied_test_data):
+    index_checker = get_banking_act_index()
+    file_list = copied_test_data
+    snapshot_path = str(tmp_path / 'reg23.snapshot')
+    compile_corpus_snapshot(snapshot_path, file_list, index_checker, non_text_labels, 'BA')
+    assert is_snapshot_current(snapshot_path, file_list, index_checker, non_text_labels)
+    assert [file for file in os.listdir(tmp_path) if file.endswith('.tmp')] == []
+
+    df, non_text = read_processed_regs_into_dataframe(file_list, index_checker, non_text_labels)
+    tree = build_tree_for_regulation('BA', df, index_checker)
+
+    snapshot = CorpusSnapshot(snapshot_path, index_checker)
+    assert snapshot.df.equals(df)
+    assert snapshot.non_text == non_text
+    signature = lambda tree: [(node.name, node.full_node_name, node.heading_text, node.depth) for node in PreOrderIter(tree.root)]
+    assert signature(snapshot.tree) == signature(tree)
+    assert snapshot.tree.get_node('23(1)').parent is snapshot.tree.get_node('23')
+    assert snapshot.tree.get_node('23').parent is snapshot.tree.root
+    for reference in ['23(1)', '23(6)(b)', '23(11)(b)(v)']:
+        assert snapshot.regulation_index.get_regulation_detail(reference) == get_regulation_detail(reference, df, index_checker)
+    snapshot.close()
+
+
+def test_snapshot_is_invalidated_by_source_changes(tmp_path, copied_test_data):
+    index_checker = get_banking_act_index()
+    file_list = copied_test_data
+    snapshot_path = str(tmp_path / 'reg23.snapshot')
+    assert not is_snapshot_current(snapshot_path, file_list, index_checker, non_text_labels)
+    snapshot = load_or_compile_corpus_snapshot(snapshot_path, file_list, index_checker, non_text_labels, 'BA')
+    number_of_rows = len(snapshot.df)
+    snapshot.close()
+
+    with open(file_list[-1], 'a', encoding='utf-8') as f:
+        f.write('\n(23) A new sub-regulation\n')
+    assert not is_snapshot_current(snapshot_path, file_list, index_checker, non_text_labels)
+    assert not is_snapshot_current(snapshot_path, file_list[:-1], index_checker, non_text_labels)
+    snapshot = load_or_compile_corpus_snapshot(snapshot_path, file_list, index_checker, non_text_labels, 'BA')
+    assert len(snapshot.df) == number_of_rows + 1
+    assert snapshot.tree.get_node('23(23)').parent.full_node_name == '23'
+    snapshot.close()
+
+    with open(snapshot_path, 'wb') as f:
+        f.write(b'not a snapshot')
+    assert not is_snapshot_current(snapshot_path, file_list, index_checker, non_text_labels)
+    with pytest.raises(ValueError):
+        CorpusSnapshot(snapshot_path, index_checker)
@@ -0,0 +1,49 @@
+import time
+import numpy as np
+
+from src.embedding_cache import EmbeddingCache, cache_key, normalise_text
+
+
+def test_cache_key():
+    assert normalise_text('  Specialised   lending\n') == 'Specialised lending'
+    assert cache_key('Specialised  lending', 'text-embedding-ada-002') == cache_key(' Specialised lending ', 'text-embedding-ada-002')
+    assert cache_key('Specialised lending', 'text-embedding-ada-002') != cache_key('Specialised lending', 'another-model')
+
+
+def test_get_and_put(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'))
+    model = 'text-embedding-ada-002'
+    assert cache.get_many(['a', 'b'], model) == [None, None]
+    cache.put_many(['a', 'b'], model, [[1.0, 2.0], [3.0, 4.0]])
+    embeddings = cache.get_many(['b', 'c', 'a'], model)
+    assert list(embeddings[0]) == [3.0, 4.0]
+    assert embeddings[1] is None
+    assert embeddings[2].dtype == np.float32
+    statistics = cache.statistics()
+    assert statistics['hits'] == 2
+    assert statistics['misses'] == 3
+    assert statistics['entries'] == 2
+    cache.close()
+
+    # the cache persists between sessions
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'))
+    assert list(cache.get_many(['a'], model)[0]) == [1.0, 2.0]
+
+
+def test_eviction(tmp_path):
+    model = 'text-embedding-ada-002'
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'), max_entries = 2)
+    cache.put_many(['a', 'b'], model, [[1.0], [2.0]])
+    time.sleep(0.01)
+    cache.get_many(['a'], model) # 'b' is now the least recently used
+    time.sleep(0.01)
+    cache.put_many(['c'], model, [[3.0]])
+    assert len(cache) == 2
+    assert cache.get_many(['b'], model) == [None]
+
+    cache = EmbeddingCache(str(tmp_path / 'aged.sqlite'), max_age_seconds = 0.05)
+    cache.put_many(['a'], model, [[1.0]])
+    time.sleep(0.1)
+    assert cache.get_many(['a'], model) == [None]
+    cache.evict()
+    assert len(cache) == 0
@@ -0,0 +1,176 @@
+import pytest
+import numpy as np
+import pandas as pd
+from scipy.spatial import distance
+
+import openai
+from types import SimpleNamespace
+
+from src.embeddings import get_closest_nodes, EmbeddingIndex, save_embedding_index, load_embedding_index, \
+                           get_embeddings, pack_embedding_requests, num_tokens_from_string, num_tokens_from_strings, \
+                           get_encoding
+from src.embedding_cache import EmbeddingCache
+
+
+def _index_df():
+    return pd.DataFrame({
+        'section':   ['23(1)', '23(2)', '23(3)', '23(4)'],
+        'text':      ['one', 'two', 'three', 'four'],
+        'Embedding': [[1.0, 0.0, 0.0], [0.9, 0.1, 0.0], [0.0, 1.0, 0.0], [0.7, 0.7, 0.1]],
+    })
+
+
+def test_get_closest_nodes():
+    df = _index_df()
+    question_embedding = [1.0, 0.05, 0.0]
+    closest = get_closest_nodes(df, 'Embedding', question_embedding, threshold = 0.15)
+    # the input DataFrame is not modified
+    assert 'cosine_distance' not in df.columns
+    assert list(closest['section']) == ['23(1)', '23(2)']
+    expected = [distance.cosine(df.loc[i, 'Embedding'], question_embedding) for i in closest.index]
+    assert np.allclose(closest['cosine_distance'].values, expected, atol=1e-6)
+
+
+def test_embedding_index_search():
+    df = _index_df()
+    index = EmbeddingIndex(df, 'Embedding')
+    assert len(index) == 4
+    assert index.embeddings.dtype == np.float32
+    assert index.embeddings.flags['C_CONTIGUOUS']
+
+    question_embedding = [1.0, 0.0, 0.0]
+    closest = index.search(question_embedding, threshold = 1.0)
+    assert list(closest['section']) == ['23(1)', '23(2)', '23(4)']
+    closest = index.search(question_embedding, threshold = 2.0, top_k = 2)
+    assert list(closest['section']) == ['23(1)', '23(2)']
+    # the index labels of the source DataFrame are kept
+    assert list(closest.index) == [0, 1]
+
+    positions, distances = index.nearest(question_embedding, threshold = 2.0)
+    assert list(positions) == [0, 1, 3, 2]
+    assert np.all(np.diff(distances) >= 0)
+
+    with pytest.raises(ValueError):
+        index.search([0.0, 0.0, 0.0])
+
+    empty_index = EmbeddingIndex(df.iloc[0:0], 'Embedding')
+    assert len(empty_index.search(question_embedding)) == 0
+
+
+def test_save_and_load_embedding_index(tmp_path):
+    df = _index_df()
+    df['source'] = ['question', 'summary', 'heading', 'question']
+    df.loc[2, 'text'] = 'Non-ascii text – “quoted”'
+    path = str(tmp_path / 'reg23_index')
+    save_embedding_index(df, path)
+
+    loaded = load_embedding_index(path)
+    assert isinstance(loaded.embeddings, np.memmap)
+    assert loaded.embeddings.dtype == np.float32
+    assert loaded.get_text(2) == 'Non-ascii text – “quoted”'
+    # the version identifies the saved build so it is the same each time the index is loaded
+    assert load_embedding_index(path).version == loaded.version
+    save_embedding_index(df, path)
+    assert load_embedding_index(path).version != loaded.version
+
+    in_memory = EmbeddingIndex(df, 'Embedding')
+    question_embedding = [0.5, 0.5, 0.0]
+    expected = in_memory.search(question_embedding, threshold = 2.0)
+    closest = loaded.search(question_embedding, threshold = 2.0)
+    assert list(closest['section']) == list(expected['section'])
+    assert list(closest['text']) == list(expected['text'])
+    assert list(closest['source']) == list(expected['source'])
+    assert np.allclose(closest['cosine_distance'].values, expected['cosine_distance'].values)
+
+
+class _FakeEmbeddingItem():
+    def __init__(self, index, embedding):
+        self.index = index
+        self.embedding = embedding
+
+class _FakeEmbeddingResponse():
+    def __init__(self, data):
+        self.data = data
+
+class _FakeEmbeddingsEndpoint():
+    # Embeds a text as [len(text), number of words]. Fails any request containing a text in fail_texts the first
+    # fail_count times that text is seen
+    def __init__(self, fail_texts = [], fail_count = 1, error = None):
+        self.requests = []
+        self.failures_remaining = {text: fail_count for text in fail_texts}
+        self.error = error
+
+    def create(self, input, model):
+        self.requests.append(list(input))
+        for text in input:
+            if self.failures_remaining.get(text, 0) > 0:
+                self.failures_remaining[text] -= 1
+                if self.error is not None:
+                    raise self.error(f'Failed on {text}', response=SimpleNamespace(status_code=400, request=None, headers={}), body=None)
+                raise openai.OpenAIError(f'Failed on {text}')
+        data = [_FakeEmbeddingItem(i, [float(len(text)), float(len(text.split()))]) for i, text in enumerate(input)]
+        return _FakeEmbeddingResponse(list(reversed(data)))
+
+class _FakeClient():
+    def __init__(self, **kwargs):
+        self.embeddings = _FakeEmbeddingsEndpoint(**kwargs)
+
+
+def test_pack_embedding_requests():
+    texts = [f'text number {i}' for i in range(10)]
+    batches = pack_embedding_requests(texts, max_items_per_request = 4)
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert sum(batches, []) == texts
+    token_count = num_tokens_from_string(texts[0])
+    batches = pack_embedding_requests(texts, max_tokens_per_request = 3 * token_count)
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+
+
+def test_get_embeddings():
+    texts = [f'text {"word " * i}' for i in range(10)]
+    client = _FakeClient()
+    embeddings = get_embeddings(texts, client = client, max_items_per_request = 4)
+    assert embeddings.shape == (10, 2)
+    assert embeddings.dtype == np.float32
+    assert list(embeddings[:, 1]) == [float(len(text.split())) for text in texts]
+    assert len(client.embeddings.requests) == 3
+
+    # a transient error retries the same request
+    client = _FakeClient(fail_texts = [texts[1]], fail_count = 2)
+    embeddings = get_embeddings(texts, client = client, max_items_per_request = 4, retry_wait_seconds = 0)
+    assert list(embeddings[:, 1]) == [float(len(text.split())) for text in texts]
+    assert client.embeddings.requests[:4] == [texts[0:4], texts[0:4], texts[0:4], texts[4:8]]
+
+    client = _FakeClient(fail_texts = [texts[1]], fail_count = 10)
+    with pytest.raises(openai.OpenAIError):
+        get_embeddings(texts, client = client, max_retries = 2, retry_wait_seconds = 0)
+    assert len(client.embeddings.requests) == 3
+
+    # only the half of a rejected request with the bad text is sent again
+    client = _FakeClient(fail_texts = [texts[1]], fail_count = 2, error = openai.BadRequestError)
+    embeddings = get_embeddings(texts, client = client, max_items_per_request = 4, retry_wait_seconds = 0)
+    assert list(embeddings[:, 1]) == [float(len(text.split())) for text in texts]
+    assert client.embeddings.requests[:5] == [texts[0:4], texts[0:2], texts[0:1], texts[1:2], texts[2:4]]
+
+
+def test_get_embeddings_with_cache(tmp_path):
+    texts = ['one', 'two words', 'three words here']
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'))
+    client = _FakeClient()
+    embeddings = get_embeddings(texts, client = client, cache = cache)
+    client = _FakeClient()
+    cached_embeddings = get_embeddings(texts + ['four more words here'], client = client, cache = cache)
+    # only the new text is sent to the API
+    assert client.embeddings.requests == [['four more words here']]
+    assert np.array_equal(cached_embeddings[:3], embeddings)
+    assert cache.statistics()['hits'] == 3
+
+
+def test_num_tokens_from_strings():
+    texts = ['The bank must calculate its credit risk exposure.', None, '', 'average daily balance', 'The bank must calculate its credit risk exposure.']
+    counts = num_tokens_from_strings(texts)
+    assert counts == [num_tokens_from_string(text) for text in texts]
+    assert counts[1] == 0
+    assert counts[2] == 0
+    assert num_tokens_from_strings([]) == []
+    assert get_encoding() is get_encoding()
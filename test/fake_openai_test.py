@@ -0,0 +1,152 @@
+import asyncio
+import random
+import time
+import numpy as np
+import pytest
+import openai
+import pandas as pd
+
+from src.fake_openai import FakeOpenAI, FakeAsyncOpenAI, FakeOpenAIBackend, fake_embedding, constant_latency, uniform_latency, lognormal_latency
+from src import openai_clients
+from src.openai_clients import get_client, get_async_client, set_clients, use_fake_clients
+from src.embeddings import get_embeddings, get_ada_embedding
+from src.embedding_cache import EmbeddingCache
+from src.summarise_and_question import generate_summaries_and_questions
+
+
+def test_fake_embeddings_are_deterministic():
+    client = FakeOpenAI(embedding_dimension=64)
+    texts = ['credit risk exposure', 'credit risk exposures of the bank', 'the weather in Cape Town']
+    response = client.embeddings.create(input=texts, model='text-embedding-ada-002')
+    embeddings = np.array([item.embedding for item in response.data])
+    assert embeddings.shape == (3, 64)
+    assert np.allclose(np.linalg.norm(embeddings, axis=1), 1.0, atol=1e-5)
+    assert np.allclose(embeddings[0], fake_embedding(texts[0], 'text-embedding-ada-002', 64))
+    again = FakeOpenAI(embedding_dimension=64, seed=7).embeddings.create(input=texts[:1], model='text-embedding-ada-002')
+    assert np.allclose(again.data[0].embedding, embeddings[0])
+    # texts that share words are closer than texts that do not
+    assert embeddings[0] @ embeddings[1] > embeddings[0] @ embeddings[2]
+    assert response.usage.prompt_tokens == 3 + 6 + 5
+
+
+def test_fake_completions():
+    client = FakeOpenAI()
+    messages = [{'role': 'system', 'content': 'Summarise'}, {'role': 'user', 'content': 'one two three'}]
+    response = client.chat.completions.create(model='gpt-4', messages=messages, max_tokens=500)
+    assert response.choices[0].finish_reason == 'stop'
+    assert response.choices[0].message.content == client.chat.completions.create(model='gpt-4', messages=messages).choices[0].message.content
+    assert response.choices[0].message.content.endswith('one two three')
+    assert response.usage.prompt_tokens == 4
+
+    response = client.chat.completions.create(model='gpt-4', messages=messages, max_tokens=2)
+    assert response.choices[0].finish_reason == 'length'
+    assert len(response.choices[0].message.content.split(' ')) == 2
+
+    client = FakeOpenAI(completion_function=lambda model, messages: 'fixed answer')
+    assert client.chat.completions.create(model='gpt-4', messages=messages).choices[0].message.content == 'fixed answer'
+
+
+def test_fault_injection():
+    client = FakeOpenAI(rate_limit_probability=0.3, server_error_probability=0.2, truncation_probability=0.5, seed=1)
+    messages = [{'role': 'user', 'content': 'text'}]
+    outcomes = {'429': 0, '500': 0, 'length': 0, 'stop': 0}
+    for _ in range(400):
+        try:
+            response = client.chat.completions.create(model='gpt-4', messages=messages)
+            outcomes[response.choices[0].finish_reason] += 1
+        except openai.RateLimitError as e:
+            assert e.status_code == 429
+            outcomes['429'] += 1
+        except openai.InternalServerError as e:
+            assert e.status_code == 500
+            outcomes['500'] += 1
+    assert 80 < outcomes['429'] < 160
+    assert 40 < outcomes['500'] < 120
+    assert outcomes['length'] > 0 and outcomes['stop'] > 0
+    statistics = client.backend.statistics
+    assert statistics['completion_requests'] == 400
+    assert statistics['rate_limit_errors'] == outcomes['429']
+    assert statistics['truncated_completions'] == outcomes['length']
+
+    # a sliding window requests per minute limit
+    client = FakeOpenAI(requests_per_minute=3)
+    for _ in range(3):
+        client.embeddings.create(input=['text'], model='m')
+    with pytest.raises(openai.RateLimitError):
+        client.embeddings.create(input=['text'], model='m')
+
+
+def test_latency():
+    assert constant_latency(0.5)(random.Random(0)) == 0.5
+    assert all(0.1 <= uniform_latency(0.1, 0.2)(random.Random(i)) <= 0.2 for i in range(10))
+    samples = sorted(lognormal_latency(0.1, 0.5)(random.Random(i)) for i in range(101))
+    assert 0.07 < samples[50] < 0.13
+
+    client = FakeAsyncOpenAI(latency=0.05)
+    messages = [{'role': 'user', 'content': 'text'}]
+
+    async def run():
+        start = time.perf_counter()
+        await asyncio.gather(*[client.chat.completions.create(model='gpt-4', messages=messages) for _ in range(10)])
+        return time.perf_counter() - start
+    # the requests run concurrently
+    assert 0.05 <= asyncio.run(run()) < 0.4
+
+
+def test_get_embeddings_with_fake_client_retries_server_errors():
+    backend = FakeOpenAIBackend(embedding_dimension=16, server_error_probability=0.3, seed=3)
+    texts = [f'section {i} of the regulation' for i in range(40)]
+    embeddings = get_embeddings(texts, client=FakeOpenAI(backend=backend), max_items_per_request=8, max_retries=10, retry_wait_seconds=0)
+    assert embeddings.shape == (40, 16)
+    assert np.allclose(embeddings[5], fake_embedding(texts[5], dimension=16))
+    assert backend.statistics['server_errors'] > 0
+
+
+def test_get_embeddings_rate_limits_do_not_multiply_requests():
+    backend = FakeOpenAIBackend(embedding_dimension=16, rate_limit_probability=1.0)
+    texts = [f'section {i} of the regulation' for i in range(2048)]
+    with pytest.raises(openai.RateLimitError):
+        get_embeddings(texts, client=FakeOpenAI(backend=backend), max_retries=3, retry_wait_seconds=0)
+    # the first request and its three retries, not a request for each half
+    assert backend.statistics['embedding_requests'] == 4
+
+    backend = FakeOpenAIBackend(embedding_dimension=16, rate_limit_probability=0.5, seed=1)
+    embeddings = get_embeddings(texts, client=FakeOpenAI(backend=backend), max_items_per_request=512, max_retries=20, retry_wait_seconds=0)
+    assert embeddings.shape == (2048, 16)
+    assert backend.statistics['embedding_requests'] == 4 + backend.statistics['rate_limit_errors']
+
+
+def test_generate_summaries_and_questions_with_fake_client(tmp_path):
+    client = FakeAsyncOpenAI(latency=uniform_latency(0, 0.01), rate_limit_probability=0.1, truncation_probability=0.1, seed=5)
+    sectioned_df = pd.DataFrame({'section': [f'23({i})' for i in range(1, 21)], 'text': [f'text of section {i}' for i in range(1, 21)]})
+    df = asyncio.run(generate_summaries_and_questions(sectioned_df, 'gpt-4', str(tmp_path / 'checkpoint.jsonl'), client=client, max_retries=10, retry_wait_seconds=0))
+    assert len(df) == 20
+    assert all(summary.endswith(f'text of section {i}') for i, summary in zip(range(1, 21), df['summary']))
+    assert client.backend.statistics['rate_limit_errors'] + client.backend.statistics['truncated_completions'] > 0
+
+
+def test_get_ada_embedding_with_cache(tmp_path):
+    try:
+        client, _ = use_fake_clients(embedding_dimension=8)
+        cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'))
+        embedding = get_ada_embedding('what is a qualifying CCP', cache=cache)
+        assert np.allclose(get_ada_embedding('what is a qualifying CCP', cache=cache), embedding)
+        assert client.backend.statistics['embedding_requests'] == 1
+        assert cache.statistics()['hits'] == 1
+    finally:
+        set_clients()
+
+
+def test_pluggable_clients(monkeypatch):
+    try:
+        client, async_client = use_fake_clients(embedding_dimension=8)
+        assert get_client() is client
+        assert get_async_client() is async_client
+        assert np.allclose(get_ada_embedding('some text'), fake_embedding('some text', dimension=8))
+
+        set_clients()
+        monkeypatch.setenv(openai_clients.OPENAI_CLIENT_ENVIRONMENT_VARIABLE, 'fake')
+        assert isinstance(get_client(), FakeOpenAI)
+        assert isinstance(get_async_client(), FakeAsyncOpenAI)
+    finally:
+        set_clients()
@@ -6,9 +6,12 @@ import fnmatch
 from src.valid_index import ValidIndex, get_banking_act_index
 from src.file_tools import  add_full_reference, \
                             read_processed_regs_into_dataframe, \
+                            process_regulations, \
                             extract_non_text, \
+                            extract_non_text_blocks, \
                             process_lines, \
-                            get_regulation_detail
+                            get_regulation_detail, \
+                            RegulationIndex
 
 
 def test_extract_non_text():
@@ -50,6 +53,29 @@ def test_extract_non_text():
     with pytest.raises(ValueError):
         remaining_lines, dictionary = extract_non_text(lines, block_identifier)
     
+def test_extract_non_text_blocks():
+    lines = []
+    lines.append('A.2 Authorised entities (#Heading)')
+    lines.append('        #Table 1')
+    lines.append('            Name of entity - Authorised Dealer')
+    lines.append('            #Formula 1 inside a table is part of the table')
+    lines.append('        #Table 1 - end')
+    lines.append('    Some text between the blocks')
+    lines.append('        #Formula 2')
+    lines.append('            x = y + z')
+    lines.append('        #Formula 2 - end')
+    non_text = {'Table': {}, 'Formula': {}}
+    remaining_lines = list(extract_non_text_blocks(iter(lines), ['Table', 'Formula'], non_text))
+    assert remaining_lines == ['A.2 Authorised entities (#Heading)', '    Some text between the blocks']
+    assert non_text['Table']['#Table 1'] == ['            Name of entity - Authorised Dealer', '            #Formula 1 inside a table is part of the table']
+    assert non_text['Formula'] == {'#Formula 2': ['            x = y + z']}
+
+    non_text = {'Table': {}, 'Formula': {}}
+    with pytest.raises(ValueError):
+        list(extract_non_text_blocks(iter(lines[:3]), ['Table', 'Formula'], non_text))
+    with pytest.raises(ValueError):
+        list(extract_non_text_blocks(iter(lines[:3]), ['Table', 'Formula'], non_text, hard_stop = 1))
+
 def test_process_lines():
     lines = []
     lines.append('(1) Duties and responsibilities of Authorised Dealers (#Heading) (reference_pdf_document_1.pdf; pg 1)')
@@ -141,6 +167,25 @@ some preamble with no reference, but correct spacing here\n\
 some post-amble with no reference, but correct spacing here'
     assert response == expected_response
 
+    regulation_index = RegulationIndex(df, index_checker)
+    assert regulation_index.get_regulation_detail('23(1)(e)(viii)(A)(ii)') == expected_response
+    assert regulation_index.get_rows_with_prefix('23(1)(a)') == [2, 3, 4]
+    assert regulation_index.get_regulation_detail('23(2)') == 'No section could be found with the reference 23(2)'
+
+
+    # without a closing delimiter, 1.10 starts with the same characters as 1.1 but is not part of its subtree
+    numbered_index = ValidIndex([r'^\d+', r'^\.\d+', r'^\.\d+'])
+    df_numbered = pd.DataFrame({
+        'Indent':         [0,     1,      2,        1,       0],
+        'Reference':      ['1',   '.1',   '.2',     '.10',   '10'],
+        'Text':           ['one', 'one one', 'two', 'ten',   'ten'],
+        'full_reference': ['1',   '1.1',  '1.1.2',  '1.10',  '10'],
+    })
+    regulation_index = RegulationIndex(df_numbered, numbered_index)
+    assert regulation_index.get_rows_with_prefix('1.1') == [1, 2]
+    assert regulation_index.get_rows_with_prefix('1') == [0, 1, 2, 3]
+    assert regulation_index.get_regulation_detail('1.1') == '1 one\n    .1 one one\n        .2 two'
+
 # Don't need to do this in the ChatBot app
 def test_read_processed_regs_into_dataframe():
     index_checker = get_banking_act_index()
@@ -158,3 +203,13 @@ def test_read_processed_regs_into_dataframe():
     assert len(non_text['Table']) == 24
     assert len(non_text['Definition']) == 1
 
+def test_process_regulations_in_parallel():
+    index_checker = get_banking_act_index()
+    non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+    # the files are in order so references carry over from one file to the next
+    file_list = sorted([os.path.join('./test/data/', file) for file in os.listdir('./test/data/') if fnmatch.fnmatch(file, 'reg23*.txt')])
+    df, non_text = process_regulations(file_list, index_checker, non_text_labels)
+    df_parallel, non_text_parallel = process_regulations(file_list, index_checker, non_text_labels, max_workers = 2)
+    assert df_parallel.equals(df)
+    assert non_text_parallel == non_text
+
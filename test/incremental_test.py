@@ -0,0 +1,123 @@
+import json
+import pandas as pd
+
+from src.valid_index import ValidIndex, get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe, RegulationIndex
+from src.tree_tools import Tree, split_tree
+from src.synthetic_corpus import generate_synthetic_corpus
+from src.incremental import incremental_rebuild, get_row_positions, get_stale_sections, drop_stale_rows, invalidate_checkpoint
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+token_limit = 1000
+
+
+def _build(file_list, index_checker):
+    df, non_text = read_processed_regs_into_dataframe(file_list, index_checker, non_text_labels)
+    tree = Tree.from_frame('BA', df, index_checker)
+    return split_tree(tree.root, df, token_limit, index_checker)
+
+
+def test_incremental_rebuild_without_changes(copied_test_data):
+    index_checker = get_banking_act_index()
+    file_list = copied_test_data
+    sectioned_df = _build(file_list, index_checker)
+    df, non_text, tree, new_sectioned_df, change_report = incremental_rebuild(sectioned_df, file_list, index_checker, non_text_labels, 'BA', token_limit)
+    assert new_sectioned_df.equals(sectioned_df)
+    assert (change_report['status'] == 'unchanged').all()
+    assert get_stale_sections(change_report) == set()
+
+
+def test_incremental_rebuild_of_a_single_chunk(copied_test_data):
+    index_checker = get_banking_act_index()
+    file_list = copied_test_data[:1]
+    df, _ = read_processed_regs_into_dataframe(file_list, index_checker, non_text_labels)
+    tree = Tree.from_frame('BA', df, index_checker)
+    sectioned_df = split_tree(tree.root, df, 10**7, index_checker)
+    assert list(sectioned_df['section']) == ['']
+    _, _, _, new_sectioned_df, change_report = incremental_rebuild(sectioned_df, file_list, index_checker, non_text_labels, 'BA', 10**7)
+    assert new_sectioned_df.equals(sectioned_df)
+    assert list(change_report['status']) == ['unchanged']
+    assert get_stale_sections(change_report) == set()
+
+
+def test_incremental_rebuild_with_other_reference_prefix(tmp_path):
+    other_index = ValidIndex([r'^A', r'^\([A-Z]\)', r'^\(\d+\)'])
+    file_list = generate_synthetic_corpus(other_index, str(tmp_path), number_of_files=2, sections_per_file=5, seed=3)
+    df, _ = read_processed_regs_into_dataframe(file_list, other_index, non_text_labels, reference_prefix='A')
+    tree = Tree.from_frame('other', df, other_index)
+    sectioned_df = split_tree(tree.root, df, 100, other_index)
+    _, _, _, new_sectioned_df, change_report = incremental_rebuild(sectioned_df, file_list, other_index, non_text_labels, 'other', 100, reference_prefix='A')
+    assert new_sectioned_df.equals(sectioned_df)
+    assert (change_report['status'] == 'unchanged').all()
+
+
+def test_incremental_rebuild_with_amended_line(tmp_path, copied_test_data):
+    index_checker = get_banking_act_index()
+    file_list = copied_test_data
+    sectioned_df = _build(file_list, index_checker)
+
+    amended_file = str(tmp_path / 'reg23_sections_10_12.txt')
+    with open(amended_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    old_line = '        (ii) shall continuously comply with the relevant minimum disclosure requirements specified in regulation 43(2);'
+    new_line = '        (ii) shall continuously comply with the relevant minimum disclosure requirements specified in regulation 43(3);'
+    assert old_line in text
+    with open(amended_file, 'w', encoding='utf-8') as f:
+        f.write(text.replace(old_line, new_line))
+
+    df, non_text, tree, new_sectioned_df, change_report = incremental_rebuild(sectioned_df, file_list, index_checker, non_text_labels, 'BA', token_limit)
+    stale_sections = get_stale_sections(change_report)
+    assert len(stale_sections) == 1
+    stale_section = stale_sections.pop()
+    assert stale_section.startswith('23(11)(a)')
+    changed = change_report[change_report['status'] == 'changed'].iloc[0]
+    assert changed['changed_lines'] == ['- ' + old_line, '+ ' + new_line]
+    # the chunk is traced back to the amended row
+    amended_row = df.index.get_loc(df[df['Text'].str.contains('regulation 43\\(3\\)', regex=True)].index[0])
+    assert amended_row in changed['row_positions']
+
+    # the result is the same as a full rebuild when the chunk boundaries do not change
+    assert new_sectioned_df.equals(_build(file_list, index_checker))
+
+    # only the stale sections are dropped from the downstream frames
+    df_summary = pd.DataFrame({'section': sectioned_df['section'], 'summary': 'summary'})
+    kept = drop_stale_rows(df_summary, change_report)
+    assert len(kept) == len(df_summary) - 1
+    assert stale_section not in set(kept['section'])
+
+
+def test_incremental_rebuild_with_new_and_removed_sections(tmp_path, copied_test_data):
+    index_checker = get_banking_act_index()
+    file_list = copied_test_data
+    sectioned_df = _build(file_list[:2], index_checker)
+    # drop regulation 23(11) and add regulations 23(13) - 23(17)
+    removed_file = str(tmp_path / 'reg23_sections_10_12.txt')
+    with open(removed_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    with open(removed_file, 'w', encoding='utf-8') as f:
+        f.write(text[:text.index('(11) Method 1')] + text[text.index('(12) Credit-risk mitigation'):])
+
+    df, non_text, tree, new_sectioned_df, change_report = incremental_rebuild(sectioned_df, file_list[:3], index_checker, non_text_labels, 'BA', token_limit)
+    removed = set(change_report.loc[change_report['status'] == 'removed', 'section'])
+    added = set(change_report.loc[change_report['status'] == 'added', 'section'])
+    assert len(removed) > 0 and all(section.startswith('23(11)') for section in removed)
+    assert len(added) > 0 and all(section.startswith('23(13)') or section.startswith('23(14)') or section.startswith('23(15)') or section.startswith('23(16)') or section.startswith('23(17)') for section in added)
+    # every row is covered by a chunk
+    regulation_index = RegulationIndex(df, index_checker)
+    covered = set()
+    for section in new_sectioned_df['section']:
+        covered.update(get_row_positions(section, regulation_index))
+    assert covered == set(range(len(df)))
+
+
+def test_invalidate_checkpoint(tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.jsonl')
+    with open(checkpoint_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'section': '23(1)', 'summary': 'a', 'questions': []}) + '\n')
+        f.write(json.dumps({'section': '23(2)', 'summary': 'b', 'questions': []}) + '\n')
+        f.write('{"section": "23(3)", "sum') # partially written line
+    change_report = pd.DataFrame([['23(1)', 'changed', 10, [], []], ['23(2)', 'unchanged', 10, [], []]], columns=['section', 'status', 'token_count', 'changed_lines', 'row_positions'])
+    invalidate_checkpoint(checkpoint_file, change_report)
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry['section'] for entry in entries] == ['23(2)']
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import pandas as pd
+
+from src.instrumentation import stage, recording, request_context, attach_sink, detach_sink, JsonLinesSink, _NULL_STAGE
+from src.valid_index import get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe
+from src.tree_tools import Tree, split_tree
+from src.fake_openai import FakeOpenAI, FakeAsyncOpenAI
+from src.embeddings import get_embeddings, EmbeddingIndex
+from src.summarise_and_question import generate_summaries_and_questions
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+
+
+def test_stage_without_sink_does_nothing():
+    assert stage('parse') is _NULL_STAGE
+    with stage('parse') as s:
+        s.add('rows', 10)
+        s.add_usage(None)
+
+
+def test_recorder_aggregates_stages_and_requests(tmp_path):
+    with recording(prices={'gpt-4': (0.03, 0.06)}) as recorder:
+        for i in range(3):
+            with request_context(f'request-{i}'):
+                with stage('retrieve') as s:
+                    s.add('results', 2)
+                with stage('complete', model='gpt-4') as s:
+                    s.add('prompt_tokens', 1000)
+                    s.add('completion_tokens', 500)
+        try:
+            with stage('embed'):
+                raise ValueError('failed')
+        except ValueError:
+            pass
+    # the recorder is detached at the end of the context
+    assert stage('parse') is _NULL_STAGE
+
+    run_report = recorder.run_report()
+    assert run_report['stages']['retrieve']['calls'] == 3
+    assert run_report['stages']['retrieve']['counters'] == {'results': 6}
+    assert run_report['stages']['embed']['errors'] == 1
+    assert run_report['prompt_tokens'] == 3000
+    assert run_report['completion_tokens'] == 1500
+    assert abs(run_report['cost'] - 3 * (0.03 + 0.03)) < 1e-9
+    assert sorted(recorder.request_ids()) == ['request-0', 'request-1', 'request-2']
+    request_report = recorder.request_report('request-1')
+    assert request_report['stages']['complete']['calls'] == 1
+    assert 'embed' not in request_report['stages']
+
+    path = str(tmp_path / 'telemetry.jsonl')
+    recorder.export_json_lines(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['type'] for line in lines] == ['run', 'request', 'request', 'request']
+    assert lines[1]['request_id'] == 'request-0'
+
+
+def test_json_lines_sink(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    sink = attach_sink(JsonLinesSink(path))
+    try:
+        with request_context() as request_id:
+            with stage('render', section='23(1)'):
+                pass
+    finally:
+        detach_sink(sink)
+        sink.close()
+    with open(path, 'r', encoding='utf-8') as f:
+        events = [json.loads(line) for line in f]
+    assert len(events) == 1
+    assert events[0]['stage'] == 'render'
+    assert events[0]['request_id'] == request_id
+    assert events[0]['attributes'] == {'section': '23(1)'}
+
+
+def test_pipeline_stages_are_instrumented(tmp_path):
+    index_checker = get_banking_act_index()
+    file_list = ['./test/data/reg23_sections_10_12.txt']
+    with recording() as recorder:
+        df, non_text = read_processed_regs_into_dataframe(file_list, index_checker, non_text_labels)
+        tree = Tree.from_frame('BA', df, index_checker)
+        sectioned_df = split_tree(tree.root, df, 1000, index_checker)
+        embeddings = get_embeddings(sectioned_df['text'][:5], client=FakeOpenAI(embedding_dimension=8))
+        index = EmbeddingIndex(pd.DataFrame({'section': sectioned_df['section'][:5], 'Embedding': list(embeddings)}))
+        index.search(embeddings[0], threshold=0.5)
+        client = FakeAsyncOpenAI()
+        asyncio.run(generate_summaries_and_questions(sectioned_df[:2], 'gpt-4', str(tmp_path / 'checkpoint.jsonl'), client=client))
+    stages = recorder.run_report()['stages']
+    for name in ['parse', 'full_reference', 'tree', 'split', 'render', 'tokenize', 'embed', 'retrieve', 'complete']:
+        assert stages[name]['calls'] > 0, name
+    assert stages['parse']['counters']['rows'] == len(df)
+    assert stages['split']['counters']['sections'] == len(sectioned_df)
+    assert stages['embed']['counters']['texts'] == 5
+    assert stages['complete']['calls'] == 4
+    assert recorder.run_report()['completion_tokens'] > 0
+
+
+def test_async_requests_are_kept_apart():
+    async def handle(request_id):
+        with request_context(request_id):
+            for _ in range(3):
+                with stage('retrieve'):
+                    await asyncio.sleep(0)
+
+    async def run():
+        await asyncio.gather(*[handle(f'request-{i}') for i in range(5)])
+
+    with recording() as recorder:
+        asyncio.run(run())
+    assert all(recorder.request_report(f'request-{i}')['stages']['retrieve']['calls'] == 3 for i in range(5))
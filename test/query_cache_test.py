@@ -0,0 +1,113 @@
+import time
+import numpy as np
+import pandas as pd
+
+from src.embeddings import EmbeddingIndex
+from src.query_cache import QueryCache, query_key
+
+
+class _CountingIndex():
+    def __init__(self, index):
+        self.index = index
+        self.version = index.version
+        self.searches = 0
+
+    def search(self, question_embedding, threshold = 0.15, top_k = None):
+        self.searches += 1
+        return self.index.search(question_embedding, threshold=threshold, top_k=top_k)
+
+
+class _Embedder():
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.calls = []
+
+    def __call__(self, question):
+        self.calls.append(question)
+        return self.embeddings[query_key(question)]
+
+
+def _index_and_embedder():
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((50, 16)).astype(np.float32)
+    df = pd.DataFrame({'section': [f'23({i})' for i in range(50)], 'Embedding': list(embeddings)})
+    question = embeddings[3] + 0.01 * rng.standard_normal(16).astype(np.float32)
+    similar_question = question + 0.01 * rng.standard_normal(16).astype(np.float32)
+    embedder = _Embedder({
+        'what is credit risk?': question,
+        'what exactly is credit risk?': similar_question,
+        'something unrelated': embeddings[40],
+    })
+    return _CountingIndex(EmbeddingIndex(df)), embedder, df
+
+
+def test_exact_tier():
+    index, embedder, df = _index_and_embedder()
+    cache = QueryCache()
+    results = cache.search('What is credit risk?', index, threshold=0.2, get_embedding=embedder)
+    assert results.iloc[0]['section'] == '23(3)'
+    again = cache.search('  what IS credit   risk? ', index, threshold=0.2, get_embedding=embedder)
+    assert again.equals(results)
+    assert len(embedder.calls) == 1
+    assert index.searches == 1
+    assert cache.statistics['exact_hits'] == 1
+    # the cached results are copies
+    again['section'] = 'changed'
+    assert cache.search('what is credit risk?', index, threshold=0.2, get_embedding=embedder).iloc[0]['section'] == '23(3)'
+
+    # different search parameters are cached separately but the embedding is reused
+    cache.search('what is credit risk?', index, threshold=0.2, top_k=1, get_embedding=embedder)
+    assert len(embedder.calls) == 1
+    assert cache.statistics['embedding_hits'] == 1
+
+
+def test_semantic_tier():
+    index, embedder, df = _index_and_embedder()
+    cache = QueryCache(semantic_distance=0.05)
+    results = cache.search('what is credit risk?', index, threshold=0.2, get_embedding=embedder)
+    similar = cache.search('what exactly is credit risk?', index, threshold=0.2, get_embedding=embedder)
+    assert similar.equals(results)
+    assert index.searches == 1
+    assert len(embedder.calls) == 2
+    assert cache.statistics['semantic_hits'] == 1
+
+    cache.search('something unrelated', index, threshold=0.2, get_embedding=embedder)
+    assert index.searches == 2
+
+    cache = QueryCache(semantic_distance=0)
+    cache.search('what is credit risk?', index, threshold=0.2, get_embedding=embedder)
+    cache.search('what exactly is credit risk?', index, threshold=0.2, get_embedding=embedder)
+    assert index.searches == 4
+
+
+def test_eviction_and_expiry():
+    index, embedder, df = _index_and_embedder()
+    cache = QueryCache(max_entries=1, semantic_distance=0)
+    cache.search('what is credit risk?', index, get_embedding=embedder)
+    cache.search('something unrelated', index, get_embedding=embedder)
+    assert len(cache) == 1
+    cache.search('what is credit risk?', index, get_embedding=embedder)
+    assert index.searches == 3
+
+    cache = QueryCache(ttl_seconds=0.01)
+    cache.search('what is credit risk?', index, get_embedding=embedder)
+    time.sleep(0.02)
+    cache.search('what is credit risk?', index, get_embedding=embedder)
+    assert index.searches == 5
+    assert len(embedder.calls) == 5
+
+
+def test_index_rebuild_invalidates_results():
+    index, embedder, df = _index_and_embedder()
+    cache = QueryCache()
+    cache.search('what is credit risk?', index, get_embedding=embedder)
+    rebuilt_index = _CountingIndex(EmbeddingIndex(df))
+    assert rebuilt_index.version != index.version
+    cache.search('what is credit risk?', rebuilt_index, get_embedding=embedder)
+    assert rebuilt_index.searches == 1
+    assert len(embedder.calls) == 1 # the question embedding is still cached
+    assert cache.statistics['invalidations'] == 1
+
+    cache.invalidate()
+    cache.search('what is credit risk?', rebuilt_index, get_embedding=embedder)
+    assert rebuilt_index.searches == 2
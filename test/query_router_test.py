@@ -0,0 +1,51 @@
+from src.valid_index import get_banking_act_index
+from src.file_tools import read_processed_regs_into_dataframe, RegulationIndex
+from src.tree_tools import Tree
+from src.instrumentation import recording
+from src.query_router import ReferenceRouter
+
+non_text_labels = ['Table', 'Formula', 'Example', 'Definition']
+
+
+def _router():
+    index_checker = get_banking_act_index()
+    df, _ = read_processed_regs_into_dataframe(['./test/data/reg23_sections_10_12.txt'], index_checker, non_text_labels)
+    regulation_index = RegulationIndex(df, index_checker)
+    return ReferenceRouter(Tree.from_frame('BA', df, index_checker), regulation_index), regulation_index
+
+
+def test_find_references():
+    router, _ = _router()
+    assert router.find_references('what does 23(11)(b)(ii) say?') == (['23(11)(b)(ii)'], [])
+    # 23(11)(b)(ii)(A) is part of 23(11)(b) and 23(5) is not in this part of the regulation
+    assert router.find_references('compare 23(11)(b)(ii)(A) with 23(11)(b) and 23(5)') == (['23(11)(b)'], ['23(5)'])
+    # the whole regulation is not a section
+    assert router.find_references('what does regulation 23 say about netting?') == ([], [])
+
+
+def test_route():
+    router, regulation_index = _router()
+    results = router.route('Please explain 23(11)(a)(iii) and 23(10)(b)')
+    assert list(results['section']) == ['23(11)(a)(iii)', '23(10)(b)']
+    assert results['text'].iloc[0] == regulation_index.get_regulation_detail('23(11)(a)(iii)')
+    assert (results['cosine_distance'] == 0.0).all()
+    assert router.route('what are the minimum requirements for the IRB approach?') is None
+
+
+def test_search_skips_retrieval_for_cited_sections():
+    router, _ = _router()
+    retrieved = []
+    def retrieve(question):
+        retrieved.append(question)
+        return 'retrieved'
+
+    with recording() as recorder:
+        results, route = router.search('what does 23(10)(a) say', retrieve)
+    assert route == 'reference'
+    assert list(results['section']) == ['23(10)(a)']
+    assert retrieved == []
+    assert recorder.run_report()['stages']['retrieve']['counters'] == {'results': 1}
+    assert 'embed' not in recorder.run_report()['stages']
+
+    assert router.search('what does 23(99) say', retrieve) == ('retrieved', 'retrieval')
+    assert retrieved == ['what does 23(99) say']
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import time
+import openai
+import pandas as pd
+
+from src.summarise_and_question import generate_summaries_and_questions, read_checkpoint, RateLimiter
+
+
+class _FakeMessage():
+    def __init__(self, content):
+        self.content = content
+
+class _FakeChoice():
+    def __init__(self, content, finish_reason):
+        self.message = _FakeMessage(content)
+        self.finish_reason = finish_reason
+
+class _FakeResponse():
+    def __init__(self, content, finish_reason = 'stop'):
+        self.choices = [_FakeChoice(content, finish_reason)]
+
+class _FakeCompletions():
+    # The summary of a text is 'summary of <text>' and the questions are 'questions for <summary>'. The first
+    # failures_per_text completions for any text in fail_texts fail, alternating between a transport error and a
+    # truncated completion
+    def __init__(self, fail_texts = [], failures_per_text = 0):
+        self.calls = []
+        self.failures_remaining = {text: failures_per_text for text in fail_texts}
+
+    async def create(self, model, temperature, max_tokens, messages):
+        user_content = messages[1]['content']
+        self.calls.append(user_content)
+        await asyncio.sleep(0)
+        remaining = self.failures_remaining.get(user_content, 0)
+        if remaining > 0:
+            self.failures_remaining[user_content] -= 1
+            if remaining % 2 == 0:
+                raise openai.APIConnectionError(request=None)
+            return _FakeResponse('truncated', finish_reason='length')
+        if user_content.startswith('summary of '):
+            return _FakeResponse('questions for ' + user_content)
+        return _FakeResponse('summary of ' + user_content)
+
+class _FakeChat():
+    def __init__(self, completions):
+        self.completions = completions
+
+class _FakeAsyncClient():
+    def __init__(self, **kwargs):
+        self.chat = _FakeChat(_FakeCompletions(**kwargs))
+
+
+def _sectioned_df():
+    return pd.DataFrame({
+        'section': ['23(1)', '23(2)', '23(3)', '23(4)'],
+        'text': ['text 1', 'text 2', '', 'text 4'],
+        'token_count': [2, 2, 0, 2],
+    })
+
+
+def test_generate_summaries_and_questions(tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.jsonl')
+    client = _FakeAsyncClient(fail_texts = ['text 2'], failures_per_text = 2)
+    df = asyncio.run(generate_summaries_and_questions(_sectioned_df(), 'gpt-4', checkpoint_file, client = client, retry_wait_seconds = 0))
+    assert list(df['section']) == ['23(1)', '23(2)', '23(3)', '23(4)']
+    assert df.iloc[1]['summary'] == 'summary of text 2'
+    assert df.iloc[1]['questions'] == 'questions for summary of text 2'
+    assert df.iloc[2]['summary'] == ''
+    assert len(read_checkpoint(checkpoint_file)) == 4
+
+    # a second run with the same checkpoint file does not call the API at all
+    client = _FakeAsyncClient()
+    df = asyncio.run(generate_summaries_and_questions(_sectioned_df(), 'gpt-4', checkpoint_file, client = client))
+    assert len(df) == 4
+    assert client.chat.completions.calls == []
+
+
+def test_generate_summaries_and_questions_resumes(tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.jsonl')
+    with open(checkpoint_file, 'w', encoding = 'utf-8') as f:
+        f.write(json.dumps({'section': '23(1)', 'summary': 'old summary', 'questions': 'old questions'}) + '\n')
+        f.write('{"section": "23(2)", "summ') # crashed during a write
+
+    # text 4 keeps failing so it is not added to the checkpoint and will be retried in the next run
+    client = _FakeAsyncClient(fail_texts = ['text 4'], failures_per_text = 10)
+    df = asyncio.run(generate_summaries_and_questions(_sectioned_df(), 'gpt-4', checkpoint_file, client = client, max_retries = 2, retry_wait_seconds = 0))
+    assert list(df['section']) == ['23(1)', '23(2)', '23(3)']
+    assert df.iloc[0]['summary'] == 'old summary'
+    assert 'text 1' not in client.chat.completions.calls
+    assert client.chat.completions.calls.count('text 4') == 3
+    assert '23(4)' not in read_checkpoint(checkpoint_file)
+
+    # the torn line was removed so the records added after it can be read back
+    client = _FakeAsyncClient()
+    df = asyncio.run(generate_summaries_and_questions(_sectioned_df(), 'gpt-4', checkpoint_file, client = client, max_retries = 2, retry_wait_seconds = 0))
+    assert list(df['section']) == ['23(1)', '23(2)', '23(3)', '23(4)']
+    assert client.chat.completions.calls.count('text 4') == 1
+    assert sorted(read_checkpoint(checkpoint_file)) == ['23(1)', '23(2)', '23(3)', '23(4)']
+    with open(checkpoint_file, 'r', encoding = 'utf-8') as f:
+        assert all(json.loads(line) for line in f)
+
+
+def test_rate_limiter():
+    async def acquire_all():
+        rate_limiter = RateLimiter(requests_per_minute = 2, tokens_per_minute = 1000, window_seconds = 0.2)
+        start = time.monotonic()
+        for _ in range(3):
+            await rate_limiter.acquire(10)
+        return time.monotonic() - start
+    assert asyncio.run(acquire_all()) >= 0.19
+
+    async def acquire_tokens():
+        rate_limiter = RateLimiter(requests_per_minute = 100, tokens_per_minute = 100, window_seconds = 0.2)
+        start = time.monotonic()
+        await rate_limiter.acquire(60)
+        await rate_limiter.acquire(60)
+        return time.monotonic() - start
+    assert asyncio.run(acquire_tokens()) >= 0.19
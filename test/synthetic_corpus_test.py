@@ -0,0 +1,94 @@
+import re
+import pytest
+
+from src.valid_index import ValidIndex, get_banking_act_index
+from src.file_tools import process_regulations
+from src.tree_tools import Tree, split_tree
+from src.synthetic_corpus import SyntheticCorpusGenerator, generate_synthetic_corpus, get_reference_sequence
+
+non_text_labels = ['Table', 'Formula']
+
+
+def test_get_reference_sequence():
+    index_checker = get_banking_act_index()
+    patterns = index_checker.get_compiled_patterns()
+    assert get_reference_sequence(patterns[1])[:3] == ['(1)', '(2)', '(3)']
+    assert get_reference_sequence(patterns[2])[:3] == ['(a)', '(b)', '(c)']
+    assert get_reference_sequence(patterns[3]) == ['(i)', '(ii)', '(iii)', '(iv)', '(v)', '(vi)', '(vii)', '(viii)', '(ix)',
+                                                   '(x)', '(xi)', '(xii)', '(xiii)', '(xiv)', '(xv)', '(xvi)', '(xvii)', '(xviii)']
+    assert get_reference_sequence(patterns[4])[:3] == ['(A)', '(B)', '(C)']
+    assert get_reference_sequence(patterns[6])[:3] == ['(aa)', '(bb)', '(cc)']
+    with pytest.raises(ValueError):
+        get_reference_sequence(re.compile(r'^[A-Z]\.\d+'))
+
+
+def test_generated_corpus_is_well_formed(tmp_path):
+    index_checker = get_banking_act_index()
+    file_list = generate_synthetic_corpus(index_checker, str(tmp_path), number_of_files=2, sections_per_file=5, seed=1)
+    assert len(file_list) == 2
+    text = ''.join(open(file, encoding='utf-8').read() for file in file_list)
+    assert '(#Heading)' in text
+    assert re.search(r'\(synthetic_\d{4}\.pdf; pg \d+\)', text)
+    for line in text.split('\n'):
+        indent = len(line) - len(line.lstrip(' '))
+        assert indent % 4 == 0
+
+    df, non_text = process_regulations(file_list, index_checker, non_text_labels)
+    assert len(df) > 0
+    assert df['Heading'].sum() >= 10
+    assert all(index_checker.is_valid_reference(reference) for reference in df['full_reference'])
+    assert df['Indent'].max() >= 5 # deep enough to include the two-letter references
+    assert any('(aa)' in reference for reference in df['full_reference'])
+    assert sorted(set(df.loc[df['Indent'] == 0, 'Reference']) - {''}) == sorted(f'({i})' for i in range(1, 11))
+
+    tree = Tree.from_frame('BA', df, index_checker)
+    assert len(tree.nodes) == len(set(df['full_reference']) | {ancestor for reference in df['full_reference'] for ancestor in _ancestors(reference, index_checker)})
+    chunked_df = split_tree(tree.root, df, 500, index_checker)
+    assert len(chunked_df) > 0
+
+
+def _ancestors(reference, index_checker):
+    components = index_checker.split_reference(reference)
+    return [''.join(components[:i]) for i in range(1, len(components))]
+
+
+def test_generated_corpus_non_text_blocks(tmp_path):
+    index_checker = get_banking_act_index()
+    file_list = generate_synthetic_corpus(index_checker, str(tmp_path), number_of_files=1, sections_per_file=10, non_text_probability=0.2)
+    df, non_text = process_regulations(file_list, index_checker, non_text_labels)
+    assert len(non_text['Table']) > 0 and len(non_text['Formula']) > 0
+    assert not df['Text'].str.startswith('#').any()
+
+
+def test_generator_is_deterministic(tmp_path):
+    index_checker = get_banking_act_index()
+    first = list(SyntheticCorpusGenerator(index_checker, seed=7).generate_lines(5))
+    second = list(SyntheticCorpusGenerator(index_checker, seed=7).generate_lines(5))
+    third = list(SyntheticCorpusGenerator(index_checker, seed=8).generate_lines(5))
+    assert first == second
+    assert first != third
+
+
+def test_generator_options():
+    index_checker = get_banking_act_index()
+    lines = list(SyntheticCorpusGenerator(index_checker, max_depth=2, fan_out=2, words_per_line=(3, 3)).generate_lines(3))
+    references = [line.strip().split(' ')[0] for line in lines if line.strip().startswith('(')]
+    assert max((len(line) - len(line.lstrip(' '))) // 4 for line in lines) <= 1
+    assert set(references) <= {'(1)', '(2)', '(3)', '(a)', '(b)'}
+
+    other_index = ValidIndex([r'^A', r'^\([A-Z]\)', r'^\(\d+\)'])
+    lines = list(SyntheticCorpusGenerator(other_index, seed=3).generate_lines(2))
+    assert lines[0].startswith('(A) ')
+
+
+def test_corpus_for_other_index_parses(tmp_path):
+    # the text must not start with words like 'A' or 'Any' that match the first pattern
+    other_index = ValidIndex([r'^A', r'^\([A-Z]\)', r'^\(\d+\)'])
+    file_list = generate_synthetic_corpus(other_index, str(tmp_path), number_of_files=2, sections_per_file=5, seed=3, text_line_probability=0.8)
+    df, _ = process_regulations(file_list, other_index, non_text_labels, reference_prefix='A')
+    assert len(df) > 0
+    assert (df['Reference'] == '').sum() > 0
+    assert all(other_index.is_valid_reference(reference) for reference in df['full_reference'])
+    assert df['full_reference'].iloc[0] == 'A(A)'
+    tree = Tree.from_frame('other', df, other_index)
+    assert 'A(B)(1)' in tree.nodes
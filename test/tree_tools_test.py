@@ -1,7 +1,9 @@
 import pytest
+import pandas as pd
 from src.valid_index import ValidIndex, get_banking_act_index
-from src.tree_tools import TreeNode, Tree, split_tree, build_tree_for_regulation
-from src.file_tools import process_lines, add_full_reference
+from src.tree_tools import TreeNode, Tree, split_tree, build_tree_for_regulation, get_subtree_token_counts
+from src.file_tools import process_lines, add_full_reference, RegulationIndex
+from src.embeddings import num_tokens_from_string
 
 
 class TestTree:
@@ -52,6 +54,30 @@ class TestTree:
         tree.add_to_tree(sub_index, heading_text='Some less deep heading here')
         assert tree.get_node(sub_index).heading_text == 'Some less deep heading here'
 
+    def test_from_frame(self):
+        df = pd.DataFrame({
+            'Indent':    [0, 1, 2, 1],
+            'Reference': ['(1)', '(a)', '(i)', '(b)'],
+            'Text':      ['Heading one', 'Heading a', 'text i', 'text b'],
+            'Heading':   [True, True, False, False],
+        })
+        add_full_reference(df, self.index_checker, '23')
+        tree = Tree.from_frame("BA", df, self.index_checker)
+        assert tree.get_node('23(1)').heading_text == 'Heading one'
+        assert tree.get_node('23(1)(a)(i)').heading_text == ''
+        assert tree.get_node('23(1)').children_by_name['(a)'] is tree.get_node('23(1)(a)')
+        assert [child.name for child in tree.get_node('23(1)').children] == ['(a)', '(b)']
+        with pytest.raises(ValueError):
+            tree.get_node('23(2)')
+
+        df.loc[3, 'full_reference'] = '23(1)(A)'
+        with pytest.raises(ValueError):
+            Tree.from_frame("BA", df, self.index_checker)
+
+        # build_tree_for_regulation does not raise but stops at the row with the error
+        tree = build_tree_for_regulation("BA", df, self.index_checker)
+        assert len(tree.nodes) == 4
+
 
 def test_split_tree():
 
@@ -89,3 +115,14 @@ def test_split_tree():
     assert chunked_df.iloc[2]['section'] == '23(3)(b)(i)'
     assert chunked_df.iloc[6]['section'] == '23(3)(e)(viii)(A)(iii)'
 
+    # the subtree token counts add up the tokens in each row
+    regulation_index = RegulationIndex(df, ba_index)
+    subtree_counts = get_subtree_token_counts(tree.root, regulation_index)
+    assert subtree_counts[tree.root][1] == len(df)
+    leaf = tree.get_node('23(3)(a)(i)')
+    assert subtree_counts[leaf] == (num_tokens_from_string(regulation_index.render_row(3)), 1)
+
+    # reusing the RegulationIndex for different token limits gives the same result as building it each time
+    for token_limit in [125, 250, 10000]:
+        assert split_tree(tree.root, df, token_limit, ba_index, regulation_index).equals(split_tree(tree.root, df, token_limit, ba_index))
+    assert len(split_tree(tree.root, df, 10000, ba_index, regulation_index)) == 1
@@ -30,6 +30,14 @@ class TestValidIndex:
         assert self.index_banking_act.extract_valid_reference('23(10)') == '23(10)'
         assert self.index_banking_act.extract_valid_reference('23 subregulation (1)(a)(iv) hello (I) ') == '23(1)(a)(iv)(I)' # text at the end
 
+    def test_extract_valid_references(self):
+        assert self.index_banking_act.extract_valid_references('what does 23(5)(b)(i) say?') == ['23(5)(b)(i)']
+        assert self.index_banking_act.extract_valid_references('compare 23 (6)(a) with 23(5)(b) and 23(6)(a)') == ['23(6)(a)', '23(5)(b)']
+        assert self.index_banking_act.extract_valid_references('See 23(11)(b)(ii)(A).') == ['23(11)(b)(ii)(A)']
+        assert self.index_banking_act.extract_valid_references('regulation 23 (a) exposures') == ['23']
+        assert self.index_banking_act.extract_valid_references('R230 million and 123(5)') == []
+        assert self.index_banking_act.extract_valid_references('(5)(b) on its own') == []
+
     def test_split_reference(self):
         long_reference = '23(1)(a)(iv)(I)(i)(cc)(iii)(d)'
         components = self.index_banking_act.split_reference(long_reference)
@@ -142,3 +150,26 @@ class TestValidIndex:
         # index, string = self.index_banking_act._extract_reference_from_string(heading_on_exclusion_list)
         # assert index == heading_on_exclusion_list
         # assert string == ""
+
+    def test_split_references(self):
+        references = ['23(1)(a)', '23(15)(d)(ii)', '23(1)(a)']
+        components = self.index_banking_act.split_references(references)
+        assert components == [['23', '(1)', '(a)'], ['23', '(15)', '(d)', '(ii)'], ['23', '(1)', '(a)']]
+        # the memoised result is not shared with the caller
+        components[0].append('(iv)')
+        assert self.index_banking_act.split_reference('23(1)(a)') == ['23', '(1)', '(a)']
+        with pytest.raises(ValueError):
+            self.index_banking_act.split_references(['23(1)', '23(1)(c)(xviii)(A)(A)(cc)'])
+
+    def test_memo_evicts_least_recently_used(self):
+        index_checker = ValidIndex(self.index_banking_act.index_patterns, memo_size=2)
+        index_checker.split_reference('23(1)')
+        index_checker.split_reference('23(2)')
+        index_checker.split_reference('23(1)')
+        index_checker.split_reference('23(3)')
+        assert list(index_checker._split_reference_memo) == ['23(1)', '23(3)']
+        index_checker.is_valid_reference('23(1)')
+        index_checker.is_valid_reference('23(x)')
+        index_checker.is_valid_reference('23(1)')
+        index_checker.is_valid_reference('23(2)')
+        assert list(index_checker._valid_reference_memo) == ['23(1)', '23(2)']